@@ -1 +1,4 @@
-from .augmenters import Elastic2D, Elastic3D
+from .augmenters import Elastic2D, Elastic3D, ScaleShift, Gamma, \
+    GaussianNoise, Flip
+from .pipeline import AugmentationPipeline
+from .field_bank import DisplacementFieldBank
@@ -1,26 +1,121 @@
-from .elastic_deformation import elastic_transform_2d, elastic_transform_3d
+from .elastic_deformation import get_displacement_field, warp_batch
+from .field_bank import DisplacementFieldBank
+from MultiPlanarUNet.interpolation.sample_grid import displace_grid
+from MultiPlanarUNet.utils.rng import get_rng
 import numpy as np
 
 
+def _sample_axes(batch_x):
+    """ The axes of the batch array 'batch_x' other than the batch axis """
+    return tuple(range(1, batch_x.ndim))
+
+
+def _expand(values, batch_x):
+    """ Reshape per-element 'values' to broadcast against 'batch_x' """
+    return np.reshape(values, (-1,) + (1,) * (batch_x.ndim - 1))
+
+
 class Augmenter(object):
     """
-    Not yet implemented
+    Augmenter base class
+
+    Augmenters operate on whole batches: images 'batch_x' of shape
+    [batch_size, *spatial_shape, n_channels] (float32) and labels 'batch_y'
+    of shape [batch_size, *spatial_shape]. Each element is augmented with
+    probability apply_prob, all selected elements are transformed at once and
+    the batch arrays are modified in place (typically the pooled batch
+    buffers of the sequence). Sub-classes implement augment().
     """
-    def __init__(self):
-        pass
+    def __init__(self, apply_prob=1.0, aug_weight=None):
+        """
+        Args:
+            apply_prob: Apply the transformation to each element only with
+                        some probability. Otherwise, leave it untransformed.
+            aug_weight: If a list of weights of len(batch_x) elements is passed
+                        the aug_weight will replace the passed weight at index
+                        i if image i in batch_x is transformed.
+                        This allows for assigning a different weight to images
+                        that were augmented versus real images.
+                        None to keep the passed weights.
+        """
+        if apply_prob > 1 or apply_prob < 0:
+            raise ValueError("Apply probability is invalid with value %3.f" % apply_prob)
+        self.apply_prob = apply_prob
+        self.weight = aug_weight
+        self.__name__ = type(self).__name__
+
+    @staticmethod
+    def _sample_param(param, rng=None, size=None):
+        if isinstance(param, (list, tuple)):
+            return get_rng(rng).uniform(param[0], param[1], size=size)
+        elif size is not None:
+            return np.full(size, param, dtype=np.float64)
+        else:
+            return param
+
+    @staticmethod
+    def _check_range(param, name):
+        if isinstance(param, (list, tuple)):
+            if len(param) != 2:
+                raise ValueError("Invalid list of %ss specified '%s'. "
+                                 "Should be 2 numbers." % (name, param))
+            if param[1] < param[0]:
+                raise ValueError("%s upper is smaller than %s lower (%s)"
+                                 % (name, name, param))
+
+    def __call__(self, batch_x, batch_y, batch_w=None, bg_values=None,
+                 rng=None):
+        """
+        Augment the elements of a batch, each with probability apply_prob
+
+        Args:
+            batch_x:   Batch of images, ndarray [batch_size, *spatial, C]
+            batch_y:   Batch of labels, ndarray [batch_size, *spatial]
+            batch_w:   Optional sample weights, elements augmented are set to
+                       aug_weight (if not None)
+            bg_values: Optional list of the background value (scalar or one
+                       per channel) of each element
+            rng:       Optional np.random.Generator, see utils.rng.get_rng
+
+        Returns:
+            batch_x, batch_y (and batch_w if passed), modified in place
+        """
+        rng = get_rng(rng)
+        inds = np.nonzero(rng.random(len(batch_x)) <= self.apply_prob)[0]
+        if len(inds):
+            self.augment(batch_x, batch_y, inds, bg_values, rng)
+            if batch_w is not None and self.weight is not None:
+                for i in inds:
+                    batch_w[i] = self.weight
 
-    def __call__(self, batch_x, batch_y):
-        pass
+        if batch_w is not None:
+            return batch_x, batch_y, batch_w
+        else:
+            return batch_x, batch_y
+
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        """
+        Transform elements 'inds' of batch_x and batch_y in place
+        """
+        raise NotImplementedError
+
+    def __str__(self):
+        return "%s(apply_prob=%.3f)" % (self.__name__, self.apply_prob)
+
+    def __repr__(self):
+        return str(self)
 
 
 class Elastic(Augmenter):
     """
     2D and 3D random elastic deformations augmenter base class
 
-    Applies either Elastic2D or Elastic3D to every element of a batch of images
+    Applies 2D or 3D random elastic deformations to the elements of a batch
+    of images, see elastic_deformation.warp_batch
     """
     def __init__(self, alpha, sigma, apply_prob,
-                 transformer_func, aug_weight=0.33):
+                 ndim, aug_weight=0.33, field_method="coarse",
+                 field_bank=None):
         """
         Args:
             alpha: A number of tuple/list of two numbers specifying a range
@@ -31,16 +126,24 @@ class Elastic(Augmenter):
                    The sigma value determines the smoothness of the deformation
             apply_prob: Apply the transformation only with some probability
                         Otherwise, return the image untransformed
-            transformer_func: The deformation function, either Elastic2D or
-                              Elastic3D
+            ndim: The number of spatial dimensions, 2 or 3
             aug_weight: If a list of weights of len(batch_x) elements is passed
                         the aug_weight will replace the passed weight at index
                         i if image i in batch_x is transformed.
                         This allows for assigning a different weight to images
                         that were augmented versus real images.
+            field_method: 'coarse' or 'full', how the displacement fields are
+                          generated, see
+                          elastic_deformation.get_displacement_field
+            field_bank: Draw the displacement fields from a
+                        DisplacementFieldBank of precomputed fields instead
+                        of generating new fields for each sample. An integer
+                        (the number of fields per (shape, sigma)) or a
+                        dictionary of DisplacementFieldBank arguments.
+                        None to disable.
         """
         # Initialize base
-        super().__init__()
+        super().__init__(apply_prob, aug_weight)
 
         if isinstance(alpha, (list, tuple)):
             if len(alpha) != 2:
@@ -54,15 +157,18 @@ class Elastic(Augmenter):
                                  "Should be 2 numbers." % sigma)
             if sigma[1] <= sigma[0]:
                 raise ValueError("Sigma upper is smaller than sigma lower (%s)" % sigma)
-        if apply_prob > 1 or apply_prob < 0:
-            raise ValueError("Apply probability is invalid with value %3.f" % apply_prob)
 
         self._alpha = alpha
         self._sigma = sigma
-        self.apply_prob = apply_prob
-        self.trans_func = transformer_func
-        self.weight = aug_weight
-        self.__name__ = "Elastic"
+        self.ndim = ndim
+        self.field_method = field_method
+        if isinstance(field_bank, dict):
+            field_bank = DisplacementFieldBank(method=field_method,
+                                               **field_bank)
+        elif field_bank:
+            field_bank = DisplacementFieldBank(size=field_bank,
+                                               method=field_method)
+        self.field_bank = field_bank or None
 
     @property
     def alpha(self):
@@ -70,10 +176,7 @@ class Elastic(Augmenter):
         Return a randomly sampled alpha value in the range [alpha[0], alpha[1]]
         or return the integer/float alpha if alpha is not a list
         """
-        if isinstance(self._alpha, (list, tuple)):
-            return np.random.uniform(self._alpha[0], self._alpha[1], 1)[0]
-        else:
-            return self._alpha
+        return self._sample_param(self._alpha)
 
     @property
     def sigma(self):
@@ -81,46 +184,69 @@ class Elastic(Augmenter):
         Return a randomly sampled sigma value in the range [sigma[0], sigma[1]]
         or return the integer/float sigma if sigma is not a list
         """
-        if isinstance(self._sigma, (list, tuple)):
-            return np.random.uniform(self._sigma[0], self._sigma[1], 1)[0]
-        else:
-            return self._sigma
+        return self._sample_param(self._sigma)
 
-    def __call__(self, batch_x, batch_y, batch_w=None, bg_values=None):
+    def get_fields(self, shape, rng):
         """
-        Deform all images in a batch of images (using linear intrp) and
-        corresponding labels (using nearest intrp)
+        Returns random displacement fields for a sample of spatial shape
+        'shape', from the field bank if set
         """
-        # Only augment some of the images (determined by apply_prob)
-        augment_mask = np.random.rand(len(batch_x)) <= self.apply_prob
+        alpha = self._sample_param(self._alpha, rng)
+        sigma = self._sample_param(self._sigma, rng)
+        if self.field_bank is not None:
+            return self.field_bank.get(shape, alpha, sigma, rng=rng)
+        return get_displacement_field(shape, alpha, sigma, rng=rng,
+                                      method=self.field_method)
 
-        if bg_values is None:
-            bg_values = [None] * len(batch_x)
-
-        augmented_x, augmented_y = [], []
-        for i, (augment, x, y, bg_val) in enumerate(zip(augment_mask,
-                                                        batch_x, batch_y,
-                                                        bg_values)):
-            if augment:
-                x, y = self.trans_func(x, y, self.alpha, self.sigma, bg_val)
-                if batch_w is not None:
-                    batch_w[i] = self.weight
-            augmented_x.append(x)
-            augmented_y.append(y)
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        """
+        Deform the selected images (using linear intrp) and corresponding
+        labels (using nearest intrp), all at once
+        """
+        shape = batch_x.shape[1:self.ndim+1]
+        fields = [self.get_fields(shape, rng) for _ in inds]
+        fields = [np.stack(f) for f in zip(*fields)]
 
-        if batch_w is not None:
-            return augmented_x, augmented_y, batch_w
+        # Points mapped outside the images are set to the BG value of each
+        # image (and channel)
+        n_channels = batch_x.shape[-1]
+        if bg_values is None:
+            bg = 0.
         else:
-            return augmented_x, augmented_y
+            bg = np.stack([np.broadcast_to(np.asarray(bg_values[i],
+                                                      dtype=np.float32),
+                                           (n_channels,)) for i in inds])
+        batch_x[inds] = warp_batch(batch_x[inds], fields, "linear",
+                                   fill_value=bg)
+        batch_y[inds] = warp_batch(batch_y[inds], fields, "nearest",
+                                   fill_value=0)
+
+    def deform_grid(self, mgrid, rng=None):
+        """
+        Deform the sampling grid 'mgrid' of a single sample (see
+        MultiPlanarUNet.interpolation.sample_grid.displace_grid) with
+        probability apply_prob, so that the image and labels interpolated at
+        the returned grid equal the deformed sample (with displacements in
+        units of the sample pixels/voxels), interpolated only once.
+
+        Returns:
+            The (possibly) deformed grid and a boolean, whether it was
+            deformed
+        """
+        rng = get_rng(rng)
+        if rng.random() > self.apply_prob:
+            return mgrid, False
+        shape = [n for n in mgrid[0].shape if n > 1]
+        fields = self.get_fields(shape, rng)
+        return displace_grid(mgrid, fields), True
 
     def __str__(self):
-        return "%s(alpha=%s, sigma=%s, apply_prob=%.3f)" % (
-            self.__name__, self._alpha, self._sigma, self.apply_prob
+        bank = "" if self.field_bank is None else \
+            ", field_bank=%i" % self.field_bank.size
+        return "%s(alpha=%s, sigma=%s, apply_prob=%.3f%s)" % (
+            self.__name__, self._alpha, self._sigma, self.apply_prob, bank
         )
 
-    def __repr__(self):
-        return str(self)
-
 
 class Elastic2D(Elastic):
     """
@@ -128,13 +254,13 @@ class Elastic2D(Elastic):
 
     See docstring of Elastic (base class)
     """
-    def __init__(self, alpha, sigma, apply_prob):
+    def __init__(self, alpha, sigma, apply_prob, field_method="coarse",
+                 field_bank=None):
         """
         See docstring of Elastic (base class)
         """
-        super().__init__(alpha, sigma, apply_prob,
-                         transformer_func=elastic_transform_2d)
-        self.__name__ = "Elastic2D"
+        super().__init__(alpha, sigma, apply_prob, ndim=2,
+                         field_method=field_method, field_bank=field_bank)
 
 
 class Elastic3D(Elastic):
@@ -143,15 +269,152 @@ class Elastic3D(Elastic):
 
     See docstring of Elastic (base class)
     """
-    def __init__(self, alpha, sigma, apply_prob):
+    def __init__(self, alpha, sigma, apply_prob, field_method="coarse",
+                 field_bank=None):
         """
         See docstring of Elastic (base class)
         """
-        super().__init__(alpha, sigma, apply_prob,
-                         transformer_func=elastic_transform_3d)
-        self.__name__ = "Elastic3D"
+        super().__init__(alpha, sigma, apply_prob, ndim=3,
+                         field_method=field_method, field_bank=field_bank)
+
+
+class ScaleShift(Augmenter):
+    """
+    Random intensity scaling and shifting of images:
+
+        x -> scale * x + shift * std(x)
+
+    with scale and shift sampled for each element. The shift is in units of
+    the standard deviation of the element, so that the augmentation does not
+    depend on the intensity range of the images.
+    """
+    def __init__(self, scale=(0.9, 1.1), shift=(-0.1, 0.1), apply_prob=0.5,
+                 aug_weight=None):
+        """
+        Args:
+            scale: A number or tuple/list of two numbers specifying a range
+                   of scale factors to sample from
+            shift: A number or tuple/list of two numbers specifying a range
+                   of shifts (in standard deviations) to sample from
+            apply_prob, aug_weight: See Augmenter
+        """
+        super().__init__(apply_prob, aug_weight)
+        self._check_range(scale, "scale")
+        self._check_range(shift, "shift")
+        self._scale = scale
+        self._shift = shift
+
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        # Identity parameters for the remaining elements, so that the whole
+        # batch is transformed in place at once
+        scale = np.ones(len(batch_x), dtype=np.float32)
+        shift = np.zeros(len(batch_x), dtype=np.float32)
+        scale[inds] = self._sample_param(self._scale, rng, size=len(inds))
+        shift[inds] = self._sample_param(self._shift, rng, size=len(inds)) * \
+            batch_x[inds].std(axis=_sample_axes(batch_x))
+        batch_x *= _expand(scale, batch_x)
+        batch_x += _expand(shift, batch_x)
+
+    def __str__(self):
+        return "%s(scale=%s, shift=%s, apply_prob=%.3f)" % (
+            self.__name__, self._scale, self._shift, self.apply_prob
+        )
+
+
+class Gamma(Augmenter):
+    """
+    Random gamma transformation of images. Each element is min-max scaled to
+    [0, 1], raised to the power gamma and scaled back to its original range.
+    """
+    def __init__(self, gamma=(0.7, 1.5), apply_prob=0.5, aug_weight=None):
+        """
+        Args:
+            gamma: A number or tuple/list of two numbers specifying a range
+                   of gamma values to sample from
+            apply_prob, aug_weight: See Augmenter
+        """
+        super().__init__(apply_prob, aug_weight)
+        self._check_range(gamma, "gamma")
+        self._gamma = gamma
+
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        gamma = self._sample_param(self._gamma, rng, size=len(inds))
+        x = batch_x[inds]
+        axes = _sample_axes(x)
+        low = x.min(axis=axes, keepdims=True)
+        span = x.max(axis=axes, keepdims=True) - low
+        span[span == 0] = 1
+        x -= low
+        x /= span
+        np.power(x, _expand(gamma, x).astype(np.float32), out=x)
+        x *= span
+        x += low
+        batch_x[inds] = x
+
+    def __str__(self):
+        return "%s(gamma=%s, apply_prob=%.3f)" % (
+            self.__name__, self._gamma, self.apply_prob
+        )
+
+
+class GaussianNoise(Augmenter):
+    """
+    Adds random Gaussian noise to images. The noise standard deviation is
+    sampled for each element, in units of the standard deviation of the
+    element.
+    """
+    def __init__(self, sigma=(0., 0.05), apply_prob=0.5, aug_weight=None):
+        """
+        Args:
+            sigma: A number or tuple/list of two numbers specifying a range
+                   of noise standard deviations to sample from
+            apply_prob, aug_weight: See Augmenter
+        """
+        super().__init__(apply_prob, aug_weight)
+        self._check_range(sigma, "sigma")
+        self._sigma = sigma
+
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        sd = self._sample_param(self._sigma, rng, size=len(inds)) * \
+            batch_x[inds].std(axis=_sample_axes(batch_x))
+        noise = rng.standard_normal((len(inds),) + batch_x.shape[1:],
+                                    dtype=np.float32)
+        noise *= _expand(sd, noise).astype(np.float32)
+        batch_x[inds] += noise
+
+    def __str__(self):
+        return "%s(sigma=%s, apply_prob=%.3f)" % (
+            self.__name__, self._sigma, self.apply_prob
+        )
+
+
+class Flip(Augmenter):
+    """
+    Random flips of images and labels. Each of the spatial axes 'axes' of a
+    selected element is flipped with probability 0.5.
+    """
+    def __init__(self, axes=None, apply_prob=0.5, aug_weight=None):
+        """
+        Args:
+            axes: List of spatial axes (0-indexed, excluding the batch axis)
+                  to flip, all spatial axes if None
+            apply_prob, aug_weight: See Augmenter
+        """
+        super().__init__(apply_prob, aug_weight)
+        self.axes = None if axes is None else [int(a) for a in axes]
+
+    def augment(self, batch_x, batch_y, inds, bg_values, rng):
+        ndim = batch_y.ndim - 1
+        for axis in (self.axes if self.axes is not None else range(ndim)):
+            if axis >= ndim:
+                raise ValueError("Cannot flip axis %i of %iD samples"
+                                 % (axis, ndim))
+            flip = inds[rng.random(len(inds)) < 0.5]
+            if len(flip):
+                batch_x[flip] = np.flip(batch_x[flip], axis=axis + 1)
+                batch_y[flip] = np.flip(batch_y[flip], axis=axis + 1)
 
     def __str__(self):
-        return "Elastic3D(alpha=%s, sigma=%s, apply_prob=%.3f)" % (
-            self._alpha, self._sigma, self.apply_prob
+        return "%s(axes=%s, apply_prob=%.3f)" % (
+            self.__name__, self.axes, self.apply_prob
         )
@@ -1,73 +1,223 @@
+"""
+Random elastic deformations of 2D and 3D images and labels.
+
+The displacement fields of [Simard2003]_ are Gaussian smoothed (sigma)
+uniform [-1, 1] noise scaled by alpha, one field per axis. Away from the
+image borders each such field is (close to) a stationary Gaussian random
+field with
+
+    variance:    alpha**2 / 3 * (2 * sqrt(pi) * sigma)**(-ndim)
+    correlation: exp(-r**2 / (4 * sigma**2)) at distance r
+
+By default the fields are instead generated on a coarse control grid of
+spacing h = sigma / 2 (see get_displacement_field): the noise is drawn with
+variance 1 / (3 * h**ndim) on the control points (the variance of the mean
+of the full resolution noise over a control grid cell), smoothed with a
+Gaussian of sigma / h = 2 control points and interpolated to full resolution
+(cubic B-spline or linear). The variance and correlation of the fields above
+are preserved up to the interpolation error, while the Gaussian filters run
+on h**ndim times fewer points.
+
+[Simard2003] Simard, Steinkraus and Platt, "Best Practices for
+Convolutional Neural Networks applied to Visual Document Analysis", in
+Proc. of the International Conference on Document Analysis and
+Recognition, 2003.
+"""
+
+import itertools
 import numpy as np
-from MultiPlanarUNet.interpolation import RegularGridInterpolator
+from functools import lru_cache
+from MultiPlanarUNet.utils.rng import get_rng
 from scipy.ndimage.filters import gaussian_filter
 
 
-def elastic_transform_2d(image, labels, alpha, sigma, bg_val=0.0):
+def _bspline3(x):
+    """ Cubic B-spline kernel """
+    x = np.abs(x)
+    return np.where(x < 1, 2/3 - x**2 + x**3 / 2,
+                    np.where(x < 2, (2 - x)**3 / 6, 0.))
+
+
+@lru_cache(maxsize=64)
+def _upsampling_matrix(n_out, n_control, spacing, order):
     """
-    Elastic deformation of images as described in [Simard2003]_.
-    [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
-    Convolutional Neural Networks applied to Visual Document Analysis", in
-    Proc. of the International Conference on Document Analysis and
-    Recognition, 2003.
+    Returns the [n_out, n_control] matrix interpolating values at control
+    points 0, spacing, 2*spacing, ... to the points 0, 1, ..., n_out-1, with
+    a linear (order 1) or cubic B-spline (order 3) interpolant
+    """
+    x = np.arange(n_out)[:, None] / spacing - np.arange(n_control)[None]
+    if order == 1:
+        return np.maximum(1 - np.abs(x), 0).astype(np.float32)
+    elif order == 3:
+        # Spline coefficients of the control values (zero outside the grid)
+        # are obtained with the inverse of the collocation matrix
+        ctrl = np.arange(n_control)
+        collocation = _bspline3(ctrl[:, None] - ctrl[None])
+        mat = _bspline3(x).dot(np.linalg.inv(collocation))
+        # The weights decay exponentially away from each point, drop the
+        # negligible (and slow, denormal in float32) ones
+        mat[np.abs(mat) < 1e-7] = 0.
+        return mat.astype(np.float32)
+    else:
+        raise ValueError("Invalid interpolation order %s, must be "
+                         "1 or 3" % order)
 
-    Modified from:
-    https://gist.github.com/chsasank/4d8f68caf01f041a6453e67fb30f8f5a
 
-    Modified to take 3 and 4 dimensional inputs
-    Deforms both the image and corresponding label file
-    image tri-linear interpolated
-    Label volumes nearest neighbour interpolated
+def get_displacement_field(shape, alpha, sigma, rng=None, method="coarse",
+                           order=3):
     """
-    if image.ndim == 2:
-        image = np.expand_dims(image, axis=-1)
-    shape = image.shape[:2]
-    channels = image.shape[-1]
-    dtype = image.dtype
+    Returns random elastic displacement fields (see module docstring), one
+    per axis of an image of spatial shape 'shape'.
+
+    Args:
+        shape:  Spatial shape of the image, tuple of 2 or 3 integers
+        alpha:  Strength of the deformation
+        sigma:  Smoothness of the deformation, in voxels
+        rng:    Optional np.random.Generator (see utils.rng.get_rng)
+        method: 'coarse': generated on a control grid of spacing sigma/2 and
+                          interpolated to full resolution
+                'full':   Gaussian filters applied at full resolution
+        order:  Interpolation order of the 'coarse' method, 1 (linear) or 3
+                (cubic B-spline)
 
-    # Define coordinate system
-    coords = np.arange(shape[0]), np.arange(shape[1])
+    Returns:
+        A list of len(shape) float32 ndarrays of shape 'shape'
+    """
+    rng = get_rng(rng)
+    shape = tuple(int(s) for s in shape)
+    spacing = sigma / 2.
+    if method == "full" or spacing <= 1:
+        return [(gaussian_filter((rng.random(shape) * 2 - 1), sigma,
+                                 mode="constant", cval=0.) * alpha
+                 ).astype(np.float32) for _ in shape]
+    elif method != "coarse":
+        raise ValueError("Invalid displacement field method '%s', must be "
+                         "'coarse' or 'full'" % method)
 
-    # Initialize interpolators
-    im_intrps = []
-    for i in range(channels):
-        im_intrps.append(RegularGridInterpolator(coords, image[..., i],
-                                                 method="linear",
-                                                 bounds_error=False,
-                                                 fill_value=bg_val,
-                                                 dtype=np.float32))
+    # Control grid covering the image, noise of the variance of the mean of
+    # the full resolution noise over a control grid cell
+    n_control = tuple(int(np.floor((s - 1) / spacing)) + 2 for s in shape)
+    noise_scale = spacing ** (-len(shape) / 2.)
+    mats = [_upsampling_matrix(s, n, spacing, order)
+            for s, n in zip(shape, n_control)]
 
-    # Get random elastic deformations
-    dx = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma,
-                         mode="constant", cval=0.) * alpha
-    dy = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma,
-                         mode="constant", cval=0.) * alpha
+    fields = []
+    for _ in shape:
+        coarse = gaussian_filter((rng.random(n_control) * 2 - 1) * noise_scale,
+                                 sigma / spacing, mode="constant", cval=0.)
+        field = coarse.astype(np.float32) * alpha
+        # Separable interpolation, one axis at a time
+        for axis, mat in enumerate(mats):
+            field = np.moveaxis(np.tensordot(mat, field, axes=([1], [axis])),
+                                0, axis)
+        fields.append(field)
+    return fields
+
+
+def warp_batch(values, fields, method="linear", fill_value=0.):
+    """
+    Resample each element of the batch 'values' at its grid indices plus the
+    displacement 'fields' (all elements at once).
+
+    Args:
+        values:     ndarray of shape [k, *shape, (channels)]
+        fields:     List of len(shape) ndarrays of shape [k, *shape], the
+                    displacements along each axis in voxels
+        method:     'linear' or 'nearest'
+        fill_value: Value of points outside the grid, a number or an array of
+                    shape [k, (channels)] of values per element (and
+                    channel)
+
+    Returns:
+        ndarray of shape values.shape, of dtype float32 ('linear') or
+        values.dtype ('nearest')
+    """
+    if method not in ("linear", "nearest"):
+        raise ValueError("Invalid method '%s', must be 'linear' or "
+                         "'nearest'" % method)
+    ndim = len(fields)
+    k, shape = values.shape[0], values.shape[1:ndim+1]
+    trailing = values.shape[ndim+1:]
+    expand = (Ellipsis,) + (None,) * len(trailing)
+    n = int(np.prod(shape))
+    flat = values.reshape((k * n,) + trailing)
+    strides = [int(np.prod(shape[a+1:])) for a in range(ndim)]
+
+    # Indices into 'flat' of the lower (linear) or nearest (nearest) grid
+    # point along each axis and the distances to the lower grid points
+    # Points on the grid border are inside, as in RegularGridInterpolator
+    out_of_bounds = np.zeros((k,) + shape, dtype=np.bool_)
+    index = (np.arange(k, dtype=np.int64) * n).reshape((k,) + (1,) * ndim)
+    dists = []
+    for axis, (field, s) in enumerate(zip(fields, shape)):
+        coords = np.arange(s, dtype=np.float32).reshape(
+            [-1 if j == axis else 1 for j in range(ndim)]) + \
+            np.asarray(field, dtype=np.float32)
+        out_of_bounds |= (coords < 0) | (coords > s - 1)
+        if method == "nearest":
+            inds = np.clip(np.ceil(coords - 0.5), 0, s - 1)
+        else:
+            # All in float32, the distances are the interpolation weights
+            inds = np.clip(np.floor(coords), 0, max(s - 2, 0))
+            dist = np.clip(coords - inds, 0, 1) if s > 1 \
+                else np.zeros_like(coords)
+            dists.append((1 - dist, dist))
+        index = index + inds.astype(np.int64) * strides[axis]
 
-    # Define sample points
-    x, y = np.mgrid[0:shape[0], 0:shape[1]]
-    indices = np.reshape(x + dx, (-1, 1)), \
-              np.reshape(y + dy, (-1, 1))
+    if method == "nearest":
+        out = np.take(flat, index, axis=0)
+    else:
+        # Weighted sum of the values at the 2**ndim corners of each cell
+        out = np.zeros((k,) + shape + trailing, dtype=np.float32)
+        for corner in itertools.product((0, 1), repeat=ndim):
+            weight = dists[0][corner[0]]
+            for axis in range(1, ndim):
+                weight = weight * dists[axis][corner[axis]]
+            offset = sum(upper * strides[axis]
+                         for axis, upper in enumerate(corner)
+                         if shape[axis] > 1)
+            vals = np.take(flat, index + offset, axis=0).astype(np.float32,
+                                                                copy=False)
+            vals *= weight[expand]
+            out += vals
 
-    # Interpolate all image channels
-    image = np.empty(shape=image.shape, dtype=dtype)
-    for i, intrp in enumerate(im_intrps):
-        image[..., i] = intrp(indices).reshape(shape)
+    # Set points outside the grid to the fill value(s)
+    fill_value = np.asarray(fill_value, dtype=out.dtype)
+    if fill_value.ndim:
+        fill_value = fill_value.reshape((k,) + (1,) * ndim + trailing)
+    np.copyto(out, fill_value, where=out_of_bounds[expand])
+    return out
+
+
+def _elastic_transform(image, labels, alpha, sigma, bg_val, rng, ndim,
+                       field_method):
+    if image.ndim == ndim:
+        image = np.expand_dims(image, axis=-1)
+    shape = image.shape[:ndim]
+    channels = image.shape[-1]
+
+    # Get random elastic deformations
+    fields = get_displacement_field(shape, alpha, sigma, rng=rng,
+                                    method=field_method)
+    fields = [f[None] for f in fields]
+
+    # Interpolate all image channels at once
+    bg_val = np.broadcast_to(np.asarray(bg_val, dtype=np.float32),
+                             (1, channels))
+    image = warp_batch(image[None], fields, "linear",
+                       fill_value=bg_val)[0].astype(image.dtype, copy=False)
 
     # Interpolate labels
     if labels is not None:
-        lab_intrp = RegularGridInterpolator(coords, labels,
-                                            method="nearest",
-                                            bounds_error=False,
-                                            fill_value=0,
-                                            dtype=np.uint8)
-
-        labels = lab_intrp(indices).reshape(shape).astype(labels.dtype)
+        labels = warp_batch(labels[None], fields, "nearest",
+                            fill_value=0)[0]
 
     # Interpolate and return in image shape
     return image, labels
 
 
-def elastic_transform_3d(image, labels, alpha, sigma, bg_val=0.0):
+def elastic_transform_2d(image, labels, alpha, sigma, bg_val=0.0, rng=None,
+                         field_method="coarse"):
     """
     Elastic deformation of images as described in [Simard2003]_.
     [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
@@ -82,53 +232,33 @@ def elastic_transform_3d(image, labels, alpha, sigma, bg_val=0.0):
     Deforms both the image and corresponding label file
     image tri-linear interpolated
     Label volumes nearest neighbour interpolated
+    bg_val may be a single value or a value per image channel
+    rng is an optional np.random.Generator (see utils.rng.get_rng)
+    field_method is passed to get_displacement_field
     """
-    if image.ndim == 3:
-        image = np.expand_dims(image, axis=-1)
-    shape = image.shape[:3]
-    channels = image.shape[-1]
-    dtype = image.dtype
+    return _elastic_transform(image, labels, alpha, sigma, bg_val, rng,
+                              ndim=2, field_method=field_method)
 
-    # Define coordinate system
-    coords = np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2])
 
-    # Initialize interpolators
-    im_intrps = []
-    for i in range(channels):
-        im_intrps.append(RegularGridInterpolator(coords, image[..., i],
-                                                 method="linear",
-                                                 bounds_error=False,
-                                                 fill_value=bg_val,
-                                                 dtype=np.float32))
-
-    # Get random elastic deformations
-    dx = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma,
-                         mode="constant", cval=0.) * alpha
-    dy = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma,
-                         mode="constant", cval=0.) * alpha
-    dz = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma,
-                         mode="constant", cval=0.) * alpha
-
-    # Define sample points
-    x, y, z = np.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
-    indices = np.reshape(x + dx, (-1, 1)), \
-              np.reshape(y + dy, (-1, 1)), \
-              np.reshape(z + dz, (-1, 1))
-
-    # Interpolate all image channels
-    image = np.empty(shape=image.shape, dtype=dtype)
-    for i, intrp in enumerate(im_intrps):
-        image[..., i] = intrp(indices).reshape(shape)
-
-    # Interpolate labels
-    if labels is not None:
-        lab_intrp = RegularGridInterpolator(coords, labels,
-                                            method="nearest",
-                                            bounds_error=False,
-                                            fill_value=0,
-                                            dtype=np.uint8)
+def elastic_transform_3d(image, labels, alpha, sigma, bg_val=0.0, rng=None,
+                         field_method="coarse"):
+    """
+    Elastic deformation of images as described in [Simard2003]_.
+    [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
+    Convolutional Neural Networks applied to Visual Document Analysis", in
+    Proc. of the International Conference on Document Analysis and
+    Recognition, 2003.
 
-        labels = lab_intrp(indices).reshape(shape).astype(labels.dtype)
+    Modified from:
+    https://gist.github.com/chsasank/4d8f68caf01f041a6453e67fb30f8f5a
 
-    # Interpolate and return in image shape
-    return image, labels
+    Modified to take 3 and 4 dimensional inputs
+    Deforms both the image and corresponding label file
+    image tri-linear interpolated
+    Label volumes nearest neighbour interpolated
+    bg_val may be a single value or a value per image channel
+    rng is an optional np.random.Generator (see utils.rng.get_rng)
+    field_method is passed to get_displacement_field
+    """
+    return _elastic_transform(image, labels, alpha, sigma, bg_val, rng,
+                              ndim=3, field_method=field_method)
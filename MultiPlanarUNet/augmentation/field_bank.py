@@ -0,0 +1,214 @@
+"""
+Bank of precomputed elastic displacement fields.
+
+The displacement fields of get_displacement_field do not depend on the image
+and are linear in alpha. The bank stores 'size' unit-alpha fields for each
+(shape, sigma) in use (sigma rounded to a multiple of 'sigma_step') and
+returns a stored field under a random transformation scaled by alpha. The
+components of a field are independent, identically distributed and
+isotropic random fields, so each transformation (flips of the spatial axes,
+transposition of equally sized spatial axes, permutation and negation of the
+components) gives another sample of the same distribution. A background
+thread replaces the stored fields with new ones continuously.
+
+Each set of fields takes size * ndim * prod(shape) * 4 bytes (e.g. 8 MB for
+size 16 and shape [256, 256], 48 MB for shape [64, 64, 64]), the total size
+of the bank is capped at max_mb by evicting the least used sets.
+
+The bank lives in each process: a bank inherited by a forked process keeps
+its fields, but is refreshed from a new seed by a thread of its own. Note
+that deformations drawn from the bank depend on its contents at the time,
+not only on the passed np.random.Generator.
+"""
+
+import os
+import numpy as np
+from threading import Thread, Event, Lock
+from MultiPlanarUNet.utils.rng import get_rng, new_seed
+from MultiPlanarUNet.logging import ScreenLogger
+from .elastic_deformation import get_displacement_field
+
+_init_lock = Lock()
+
+
+class DisplacementFieldBank(object):
+    """
+    Thread-safe bank of unit-alpha displacement fields, see module docstring
+    """
+    def __init__(self, size=16, sigma_step=5.0, max_mb=512,
+                 method="coarse", refresh_interval=0.1, seed=None,
+                 logger=None):
+        """
+        Args:
+            size:             Number of fields stored per (shape, sigma)
+            sigma_step:       Sigma values are rounded to multiples of
+                              sigma_step, each giving a separate set of
+                              fields
+            max_mb:           Maximum total size of the stored fields in MB
+                              (per process). The least used sets of fields
+                              are evicted to make room for a new set, None
+                              for no limit.
+            method:           Field generation method, see
+                              get_displacement_field
+            refresh_interval: Seconds between the replacement of two stored
+                              fields by the background thread, None to
+                              disable refreshing
+            seed:             Integer seed of the stored fields
+            logger:           A MultiPlanarUNet logger object
+        """
+        if int(size) < 1:
+            raise ValueError("Field bank size must be at least 1, "
+                             "got %s" % size)
+        if sigma_step <= 0:
+            raise ValueError("sigma_step must be positive, got %s"
+                             % sigma_step)
+        self.logger = logger or ScreenLogger()
+        self.size = int(size)
+        self.sigma_step = float(sigma_step)
+        self.max_mb = max_mb
+        self.method = method
+        self.refresh_interval = refresh_interval
+        self.seed = new_seed() if seed is None else int(seed)
+        self.fields = {}
+
+        # Number of fields drawn from each set, see _add_fields
+        self._uses = {}
+
+        # Per-process lock, generator and refresh thread, see _get_workers
+        self._pid = None
+        self._lock = None
+        self._rng = None
+        self._stop_event = None
+        self._positions = {}
+
+    def __str__(self):
+        return ("DisplacementFieldBank(size=%i, sigma_step=%s, max_mb=%s, "
+                "method=%s, refresh_interval=%s, %i field sets, %.1f MB)" % (
+            self.size, self.sigma_step, self.max_mb, self.method,
+            self.refresh_interval, len(self.fields), self.nbytes / 1024 ** 2
+        ))
+
+    def __repr__(self):
+        return str(self)
+
+    def __getstate__(self):
+        # Locks, generators and threads are re-created in each process
+        state = self.__dict__.copy()
+        state.update({"_pid": None, "_lock": None, "_rng": None,
+                      "_stop_event": None})
+        return state
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for fields in self.fields.values()
+                   for field in fields for f in field)
+
+    def _key(self, shape, sigma):
+        sigma = max(round(sigma / self.sigma_step), 1) * self.sigma_step
+        return tuple(int(s) for s in shape), sigma
+
+    def _new_field(self, key, rng):
+        shape, sigma = key
+        return get_displacement_field(shape, 1., sigma, rng=rng,
+                                      method=self.method)
+
+    def _add_fields(self, key):
+        """
+        Fill the set of fields of 'key', first evicting the least used sets
+        if the bank would exceed max_mb. Must be called with the lock held.
+        """
+        fields = [self._new_field(key, self._rng) for _ in range(self.size)]
+        set_bytes = sum(f.nbytes for field in fields for f in field)
+        if self.max_mb is not None:
+            max_bytes = self.max_mb * 1024 ** 2
+            while self.fields and self.nbytes + set_bytes > max_bytes:
+                evict = min(self.fields, key=lambda k: self._uses.get(k, 0))
+                del self.fields[evict]
+                self._uses.pop(evict, None)
+                self._positions.pop(evict, None)
+                self.logger("DisplacementFieldBank: evicted fields of shape "
+                            "%s, sigma %s" % evict)
+        self.fields[key] = fields
+        self.logger("DisplacementFieldBank: added %i fields of shape %s, "
+                    "sigma %s (%.1f MB), total %.1f MB in %i sets" % (
+            self.size, key[0], key[1], set_bytes / 1024 ** 2,
+            self.nbytes / 1024 ** 2, len(self.fields)
+        ))
+
+    def _get_workers(self):
+        """
+        Returns the lock of this process, starting the refresh thread on
+        first use in each process
+        """
+        with _init_lock:
+            if self._pid != os.getpid():
+                # Fields inherited from a parent process are refreshed from
+                # a seed of this process
+                seed = self.seed if self._pid is None else new_seed()
+                self._lock = Lock()
+                self._rng = np.random.default_rng(seed)
+                self._stop_event = Event()
+                if self.refresh_interval is not None:
+                    Thread(target=self._refresh,
+                           args=(np.random.default_rng([seed, 1]),
+                                 self._stop_event),
+                           daemon=True).start()
+                self._pid = os.getpid()
+        return self._lock
+
+    def _refresh(self, rng, stop_event):
+        """ Replace the stored fields one at a time, oldest first """
+        while not stop_event.wait(self.refresh_interval):
+            with self._lock:
+                keys = list(self.fields)
+            for key in keys:
+                field = self._new_field(key, rng)
+                with self._lock:
+                    if key not in self.fields:
+                        # Evicted since listed
+                        continue
+                    pos = self._positions.get(key, 0)
+                    self.fields[key][pos] = field
+                    self._positions[key] = (pos + 1) % self.size
+                if stop_event.wait(self.refresh_interval):
+                    return
+
+    def stop(self):
+        """ Stop the refresh thread of this process """
+        if self._pid == os.getpid():
+            self._stop_event.set()
+            self._pid = None
+
+    def get(self, shape, alpha, sigma, rng=None):
+        """
+        Returns displacement fields of strength 'alpha' and smoothness
+        'sigma' of an image of spatial shape 'shape' (see
+        get_displacement_field), drawn from the bank with random numbers from
+        the np.random.Generator 'rng'. The first call for a (shape, sigma)
+        fills its set of fields (see max_mb).
+
+        Returns:
+            A list of len(shape) float32 ndarrays of shape 'shape'
+        """
+        rng = get_rng(rng)
+        lock = self._get_workers()
+        key = self._key(shape, sigma)
+        with lock:
+            if key not in self.fields:
+                self._add_fields(key)
+            self._uses[key] = self._uses.get(key, 0) + 1
+            field = self.fields[key][rng.integers(self.size)]
+        ndim = len(field)
+
+        # Flip the spatial axes and transpose equally sized spatial axes
+        flip = tuple(np.nonzero(rng.random(ndim) < 0.5)[0])
+        axes = np.arange(ndim)
+        for size in set(key[0]):
+            same = np.nonzero(np.asarray(key[0]) == size)[0]
+            axes[same] = rng.permutation(same)
+
+        # Permute and negate the components, scale by alpha
+        components = rng.permutation(ndim)
+        signs = np.where(rng.random(ndim) < 0.5, -alpha, alpha)
+        return [np.flip(field[c], flip).transpose(axes) * np.float32(s)
+                for c, s in zip(components, signs)]
@@ -0,0 +1,93 @@
+"""
+Composed batch augmentation stage of the sequences.
+
+The augmenters (see augmenters.Augmenter) are applied in order to whole
+batch arrays in place, so each added augmenter costs one pass over the
+batch. The time spent in each augmenter is recorded per pipeline and, if a
+BatchStats object is passed, per batch under the stage 'aug_<name>' (see
+MultiPlanarUNet.sequences.sampling_stats).
+"""
+
+import time
+from threading import Lock
+
+
+class AugmentationPipeline(object):
+    """
+    Applies a list of augmenters in order to batches in place and records
+    the time spent in each augmenter
+    """
+    def __init__(self, augmenters):
+        """
+        Args:
+            augmenters: List of Augmenter objects
+        """
+        self.augmenters = list(augmenters or [])
+
+        # Unique stage names, e.g. 'aug_elastic2d', 'aug_flip', 'aug_flip_1'
+        self.stages = []
+        for aug in self.augmenters:
+            stage = "aug_" + getattr(aug, "__name__", type(aug).__name__).lower()
+            name, i = stage, 1
+            while name in self.stages:
+                name = "%s_%i" % (stage, i)
+                i += 1
+            self.stages.append(name)
+
+        self.lock = Lock()
+        self.reset_timings()
+
+    def __len__(self):
+        return len(self.augmenters)
+
+    def __iter__(self):
+        return iter(self.augmenters)
+
+    def __str__(self):
+        return "AugmentationPipeline(%s)" % self.augmenters
+
+    def __repr__(self):
+        return str(self)
+
+    def reset_timings(self):
+        with self.lock:
+            self.n_calls = 0
+            self.times = dict.fromkeys(self.stages, 0.)
+
+    def get_timings(self):
+        """
+        Returns a dictionary mapping each stage name to the mean time spent
+        in the augmenter per batch (in ms) since the last reset
+        """
+        with self.lock:
+            n = max(self.n_calls, 1)
+            return {s: 1000 * t / n for s, t in self.times.items()}
+
+    def __call__(self, batch_x, batch_y, batch_w, bg_values, rng=None,
+                 stats=None):
+        """
+        Apply all augmenters to the batch (see Augmenter.__call__)
+
+        Args:
+            batch_x, batch_y, batch_w, bg_values, rng: See Augmenter.__call__
+            stats: Optional BatchStats object of the batch
+
+        Returns:
+            batch_x, batch_y, batch_w
+        """
+        times = []
+        for aug in self.augmenters:
+            t0 = time.perf_counter()
+            out = aug(batch_x=batch_x, batch_y=batch_y, batch_w=batch_w,
+                      bg_values=bg_values, rng=rng)
+            batch_x, batch_y = out[:2]
+            batch_w = out[2] if len(out) == 3 else batch_w
+            times.append(time.perf_counter() - t0)
+        with self.lock:
+            self.n_calls += 1
+            for stage, t in zip(self.stages, times):
+                self.times[stage] += t
+        if stats is not None:
+            for stage, t in zip(self.stages, times):
+                stats.add_time(stage, t)
+        return batch_x, batch_y, batch_w
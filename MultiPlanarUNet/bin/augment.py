@@ -0,0 +1,199 @@
+"""
+Offline augmentation script
+
+Creates an augmented dataset (for the aug_data group of the hyperparameter
+file) from a dataset folder of images and labels. Each volume is loaded,
+augmented and written by a worker of a process pool, one volume at a time.
+
+Usage:
+mp augment --data_dir ./data_folder/train --out_dir ./data_folder/aug
+"""
+
+import os
+import json
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+DEFAULT_AUGMENTERS = json.dumps([
+    {"cls_name": "Elastic3D",
+     "kwargs": {"alpha": [0, 450], "sigma": [12, 25], "apply_prob": 1.0}},
+    {"cls_name": "ScaleShift", "kwargs": {"apply_prob": 0.5}},
+    {"cls_name": "Gamma", "kwargs": {"apply_prob": 0.5}}
+])
+
+# Augmenters of each worker process, see _init_worker
+_augmenters = None
+
+
+def get_argparser():
+    parser = ArgumentParser(description="Create an augmented dataset from "
+                                        "the images and labels of a "
+                                        "dataset folder.")
+    parser.add_argument("--data_dir", type=str, required=True,
+                        help="Path to the dataset folder storing the "
+                             "'images' and 'labels' sub-folders")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="Output folder, the augmented images and labels "
+                             "are stored in its 'images' and 'labels' "
+                             "sub-folders")
+    parser.add_argument("--img_subdir", type=str, default="images",
+                        help="Image sub-folder of --data_dir "
+                             "(default=images)")
+    parser.add_argument("--label_subdir", type=str, default="labels",
+                        help="Label sub-folder of --data_dir "
+                             "(default=labels)")
+    parser.add_argument("--n_copies", type=int, default=1,
+                        help="Number of augmented copies of each image "
+                             "(default=1)")
+    parser.add_argument("--augmenters", type=str, default=DEFAULT_AUGMENTERS,
+                        help="JSON list of augmenters of the format used in "
+                             "the 'augmenters' list of the hyperparameter "
+                             "file, applied in order to each volume "
+                             "(default=%s)" % DEFAULT_AUGMENTERS.replace("%",
+                                                                         "%%"))
+    parser.add_argument("--sample_weight", type=float, default=0.33,
+                        help="Sample weight of the augmented dataset, written "
+                             "to the manifest (default=0.33)")
+    parser.add_argument("--bg_value", type=str, default="1pct",
+                        help="Image value of points mapped outside the image "
+                             "by the elastic augmenters, a number or a "
+                             "percentile of the format '<number>pct' "
+                             "(default=1pct)")
+    parser.add_argument("--num_workers", type=int, default=4,
+                        help="Number of worker processes (default=4)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed of the augmentations. Copy k of image i is "
+                             "a function of (seed, k, i) only.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Overwrite existing files in --out_dir")
+    return parser
+
+
+def _init_worker(aug_dicts):
+    """ Create the augmenters once in each worker process """
+    from MultiPlanarUNet.augmentation import augmenters
+    global _augmenters
+    _augmenters = [augmenters.__dict__[aug["cls_name"]](**aug["kwargs"])
+                   for aug in aug_dicts]
+
+
+def _parse_bg_value(bg_value):
+    try:
+        return float(bg_value)
+    except ValueError:
+        return bg_value
+
+
+def _augment_volume(task):
+    """
+    Load, augment and save one image and its labels (in a worker process)
+    """
+    import numpy as np
+    import nibabel as nib
+    from MultiPlanarUNet.image import ImagePair
+    from MultiPlanarUNet.utils.rng import get_batch_rng
+
+    image = ImagePair(task["source_image"], task["source_labels"])
+    bg_value = image.standardize_bg_val(image.parse_bg_value(task["bg_value"]))
+
+    # Augment the volume as a batch of one, in place
+    batch_x = np.array(image.image[None], dtype=np.float32)
+    batch_y = np.array(image.labels[None])
+    rng = get_batch_rng(task["seed"], epoch=task["copy"], idx=task["index"])
+    for aug in _augmenters:
+        batch_x, batch_y = aug(batch_x, batch_y, bg_values=[bg_value],
+                               rng=rng)
+
+    # Save with the geometry of the source files
+    header = image.image_obj.header.copy()
+    header.set_data_dtype(np.float32)
+    x = batch_x[0] if batch_x.shape[-1] > 1 else batch_x[0, ..., 0]
+    nib.save(nib.Nifti1Image(x, image.image_obj.affine, header),
+             task["image"])
+    header = image.labels_obj.header.copy()
+    header.set_data_dtype(batch_y.dtype)
+    nib.save(nib.Nifti1Image(batch_y[0], image.labels_obj.affine, header),
+             task["labels"])
+    return task
+
+
+def write_manifest(out_dir, tasks, sample_weight, aug_dicts):
+    """
+    Write the aug_data dataset entry of the augmented dataset to
+    out_dir/aug_data.yaml and a list of the augmented volumes to
+    out_dir/manifest.csv
+    """
+    name = os.path.split(out_dir)[-1]
+    with open(os.path.join(out_dir, "aug_data.yaml"), "w") as out_f:
+        out_f.write("# Augmented dataset created by 'mp augment', add to the "
+                    "'datasets' of the\n# aug_data group of the hyperparameter "
+                    "file (and set add_aug: true)\n")
+        out_f.write("%s: {base_dir: %s, img_subdir: images, "
+                    "label_subdir: labels, sample_weight: %s}\n" % (
+            name, out_dir, sample_weight
+        ))
+    with open(os.path.join(out_dir, "manifest.csv"), "w") as out_f:
+        out_f.write("image,labels,source_image,source_labels,copy,seed,"
+                    "sample_weight,augmenters\n")
+        augmenters = "+".join(aug["cls_name"] for aug in aug_dicts)
+        for task in sorted(tasks, key=lambda t: t["image"]):
+            out_f.write("%s,%s,%s,%s,%i,%i,%s,%s\n" % (
+                task["image"], task["labels"], task["source_image"],
+                task["source_labels"], task["copy"], task["seed"],
+                sample_weight, augmenters
+            ))
+
+
+def entry_func(args=None):
+    args = vars(get_argparser().parse_args(args))
+    from MultiPlanarUNet.image import ImagePairLoader
+    from MultiPlanarUNet.logging import ScreenLogger
+    from MultiPlanarUNet.utils.rng import new_seed
+    logger = ScreenLogger()
+
+    out_dir = os.path.abspath(args["out_dir"])
+    if os.path.exists(out_dir) and os.listdir(out_dir) \
+            and not args["overwrite"]:
+        raise OSError("Output directory at '%s' already exists and is not "
+                      "empty. Use --overwrite to overwrite its files."
+                      % out_dir)
+    for sub in ("images", "labels"):
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+
+    # Only the file paths are used, the workers load the volumes
+    data = ImagePairLoader(base_dir=args["data_dir"],
+                           img_subdir=args["img_subdir"],
+                           label_subdir=args["label_subdir"],
+                           logger=logger)
+    aug_dicts = json.loads(args["augmenters"])
+    seed = args["seed"] if args["seed"] is not None else new_seed()
+    tasks = []
+    for i, image in enumerate(data.images):
+        for k in range(args["n_copies"]):
+            # Leading changes to the file name, see cv_split --aug_sub_dir
+            fname = "aug%i_%s" % (k, os.path.split(image.image_path)[-1])
+            tasks.append({
+                "source_image": image.image_path,
+                "source_labels": image.labels_path,
+                "image": os.path.join(out_dir, "images", fname),
+                "labels": os.path.join(out_dir, "labels", fname),
+                "index": i, "copy": k, "seed": seed,
+                "bg_value": _parse_bg_value(args["bg_value"])
+            })
+    logger("Augmenting %i images (%i copies each) with %i workers, "
+           "seed %i" % (len(data), args["n_copies"], args["num_workers"],
+                        seed))
+    logger("Augmenters: %s" % aug_dicts)
+
+    done = []
+    with mp.Pool(args["num_workers"], initializer=_init_worker,
+                 initargs=(aug_dicts,)) as pool:
+        for task in pool.imap_unordered(_augment_volume, tasks):
+            done.append(task)
+            logger("[%i/%i] %s" % (len(done), len(tasks), task["image"]))
+    write_manifest(out_dir, done, args["sample_weight"], aug_dicts)
+    logger("Wrote %s" % os.path.join(out_dir, "aug_data.yaml"))
+
+
+if __name__ == "__main__":
+    entry_func()
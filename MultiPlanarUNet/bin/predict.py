@@ -53,6 +53,19 @@ def get_argparser():
                         help="Do not argmax prediction volume prior to save.")
     parser.add_argument("--on_val", action="store_true",
                         help="Evaluate on the validation set instead of test")
+    parser.add_argument("--pipeline_workers", type=int, default=2,
+                        help="Number of threads mapping view predictions to "
+                             "the image grid while the model predicts on the "
+                             "next view (the next views are sampled ahead by "
+                             "another thread). 0 to run the views "
+                             "sequentially. Peak memory grows with the "
+                             "number of workers: up to pipeline_workers + 1 "
+                             "full per-view prediction volumes plus "
+                             "pipeline_depth + 1 sampled views are held at a "
+                             "time. (default=2)")
+    parser.add_argument("--pipeline_depth", type=int, default=1,
+                        help="Number of views sampled ahead of the model "
+                             "(default=1)")
     parser.add_argument("--wait_for", type=str, default="",
                         help="Waiting for PID to terminate before starting "
                              "training process.")
@@ -85,13 +98,28 @@ def validate_folders(base_dir, out_dir, overwrite):
 def save_nii_files(combined, image, nii_res_dir, save_only_pred):
     from MultiPlanarUNet.utils import create_folders
     import nibabel as nib
+    import numpy as np
     import os
 
     # Extract data if nii files
     try:
         combined = combined.get_data()
     except AttributeError:
-        combined = nib.Nifti1Image(combined, affine=image.affine)
+        pass
+
+    if image.crop_box is not None:
+        # Paste the prediction on the cropped image into the full image grid,
+        # voxels outside the crop box are background
+        bg_class = image.bg_class or 0
+        if combined.ndim == 4 and combined.shape[-1] > 1:
+            # Class probabilities
+            fill = np.eye(combined.shape[-1], dtype=combined.dtype)[bg_class]
+        elif np.issubdtype(combined.dtype, np.integer):
+            fill = bg_class
+        else:
+            fill = 0
+        combined = image.paste_to_full(combined, fill_value=fill)
+    combined = nib.Nifti1Image(combined, affine=image.image_obj.affine)
 
     volumes = [combined, image.image_obj, image.labels_obj]
     labels = ["%s_PRED.nii.gz" % image.id, "%s_IMAGE.nii.gz" % image.id,
@@ -122,6 +150,8 @@ def entry_func(args=None):
     label = args["l"]
     await_PID = args["wait_for"]
     eval_prob = args["eval_prob"]
+    pipeline_workers = args["pipeline_workers"]
+    pipeline_depth = args["pipeline_depth"]
     if analytical and majority:
         raise ValueError("Cannot specify both --analytical and --majority.")
 
@@ -161,8 +191,7 @@ def entry_func(args=None):
                                     create_folders, pred_to_class, set_gpu
     from MultiPlanarUNet.logging import init_result_dicts, save_all
     from MultiPlanarUNet.evaluate import dice_all
-    from MultiPlanarUNet.utils.fusion import predict_volume, map_real_space_pred
-    from MultiPlanarUNet.interpolation.sample_grid import get_voxel_grid_real_space
+    from MultiPlanarUNet.utils.fusion import predict_views, StreamingFusion
 
     # Wait for PID?
     if await_PID:
@@ -238,10 +267,9 @@ def entry_func(args=None):
         fm.load_weights(weights)
         print("\nLoaded weights:\n\n%s\n%s\n---" % tuple(fm.layers[-1].get_weights()))
 
-        # Multi-gpu?
-        if num_GPUs > 1:
-            print("Using multi-GPU model (%i GPUs)" % num_GPUs)
-            fm = multi_gpu_model(fm, gpus=num_GPUs)
+        # The fusion model is applied view by view, see StreamingFusion
+        fusion_weights = fm.get_fusion_weights()
+        del fm
 
     # Evaluate?
     if not predict_mode:
@@ -272,45 +300,34 @@ def entry_func(args=None):
         kwargs.update(hparams["build"])
         seq = image_pair_loader.get_sequencer(views=views, **kwargs)
 
-        # Get voxel grid in real space
-        voxel_grid_real_space = get_voxel_grid_real_space(image)
-
-        # Prepare tensor to store combined prediction
+        # Prepare buffer to fuse the view predictions into, one view at a
+        # time. Analytical and majority fusion sum the views, the fusion
+        # model adds the views weighted per class and applies its activation
         d = image.image.shape[:-1]
-        if not majority:
-            combined = np.empty(shape=(len(views), d[0], d[1], d[2], n_classes),
-                                dtype=np.float32)
+        if not analytical and not majority:
+            W, b, activation = fusion_weights
+            fusion = StreamingFusion(d, n_classes, weights=W, bias=b,
+                                     activation=activation)
         else:
-            combined = np.empty(shape=(d[0], d[1], d[2], n_classes), dtype=np.float32)
-        print("Predicting on brain hyper-volume of shape:", combined.shape)
+            fusion = StreamingFusion(d, n_classes)
+        print("Predicting on brain volume of shape:", fusion.buffer.shape)
 
         # Predict for each view
-        for n_view, v in enumerate(views):
+        # For each view, sample planes from the image in real space (scanner
+        # RAS) coordinates, predict on all planes and map the predictions to
+        # the nearest real space coordinates defined on voxel grid. The
+        # stages of consecutive views overlap, see predict_views.
+        view_preds = predict_views(unet, seq, image, views,
+                                   batch_size=seq.batch_size,
+                                   n_planes="same+20",
+                                   n_workers=pipeline_workers,
+                                   depth=pipeline_depth, method="nearest")
+        for n_view, v, y, pred, mapped_pred in view_preds:
             print("\n[*] (%i/%i) View: %s" % (n_view+1, len(views), v))
-            # for each view, predict on all voxels and map the predictions
-            # back into the original coordinate system
-
-            # Sample planes from the image at grid_real_space grid
-            # in real space (scanner RAS) coordinates.
-            X, y, grid, inv_basis = seq.get_view_from(image.id, v,
-                                                      n_planes="same+20")
-
-            # Predict on volume using model
-            pred = predict_volume(unet, X, axis=2, batch_size=seq.batch_size)
-
-            # Map the real space coordiante predictions to nearest
-            # real space coordinates defined on voxel grid
-            mapped_pred = map_real_space_pred(pred, grid, inv_basis,
-                                              voxel_grid_real_space,
-                                              method="nearest")
-            if not majority:
-                combined[n_view] = mapped_pred
-            else:
-                combined += mapped_pred
-
             if n_classes == 1:
                 # Set to background if outside pred domain
-                combined[n_view][np.isnan(combined[n_view])] = 0.
+                mapped_pred[np.isnan(mapped_pred)] = 0.
+            fusion.add(mapped_pred, n_view)
 
             if not predict_mode and np.random.rand() <= eval_prob:
                 view_dices = dice_all(y, pred_to_class(pred, img_dims=3,
@@ -342,13 +359,11 @@ def entry_func(args=None):
                                                              predict_mode))
 
         if not analytical and not majority:
-            # Combine predictions across views using Fusion model
             print("\nFusing views...")
-            combined = np.moveaxis(combined, 0, -2).reshape((-1, len(views), n_classes))
-            combined = fm.predict(combined, batch_size=10**4, verbose=1).reshape((d[0], d[1], d[2], n_classes))
         elif analytical:
             print("\nFusing views (analytical)...")
-            combined = np.sum(combined, axis=0)
+        combined = fusion.result()
+        del fusion
 
         if not no_argmax:
             print("\nComputing majority vote...")
@@ -6,7 +6,6 @@ from MultiPlanarUNet.utils import await_and_set_free_gpu, get_best_model, \
                                   create_folders, highlighted, set_gpu, \
                                   random_split
 from MultiPlanarUNet.utils.fusion import predict_and_map, stack_collections
-from MultiPlanarUNet.interpolation.sample_grid import get_voxel_grid_real_space
 from MultiPlanarUNet.logging import Logger
 from MultiPlanarUNet.callbacks import ValDiceScores, PrintLayerWeights
 from MultiPlanarUNet.evaluate.metrics import sparse_fg_precision, \
@@ -45,6 +44,12 @@ def get_argparser():
                         help="Waiting for PID to terminate before starting "
                              "training process.")
     parser.add_argument("--dice_weight", type=str, default="uniform")
+    parser.add_argument("--voxel_fraction", type=float, default=1.0,
+                        help="Fraction of the voxels of each image (randomly "
+                             "sampled) to train on. The fusion training "
+                             "data stores n_views * n_classes values per "
+                             "voxel, lower values reduce memory use. "
+                             "Defaults to 1.0.")
     return parser
 
 
@@ -73,7 +78,8 @@ def make_sets(images, sub_size, N):
 
 def _run_fusion_training(sets, logger, hparams, min_val_images, is_validation,
                          views, n_classes, unet, fusion_model_org, fusion_model,
-                         early_stopping, fm_batch_size, epochs, eval_prob):
+                         early_stopping, fm_batch_size, epochs, eval_prob,
+                         voxel_fraction=1.0):
 
     for _round, _set in enumerate(sets):
         s = "Set %i/%i:\n%s" % (_round + 1, len(sets), _set)
@@ -108,12 +114,17 @@ def _run_fusion_training(sets, logger, hparams, min_val_images, is_validation,
             kwargs.update(hparams["build"])
             seq = images.get_sequencer(views=views, **kwargs)
 
-            # Get voxel grid in real space
-            voxel_grid_real_space = get_voxel_grid_real_space(image)
-
-            # Get array to store predictions across all views
+            # Get array to store predictions across all views, only the
+            # voxels in 'inds' are stored
             targets = image.labels.reshape(-1, 1)
-            points = np.empty(shape=(len(targets), len(views), n_classes),
+            if voxel_fraction < 1:
+                n_voxels = max(int(round(len(targets) * voxel_fraction)), 1)
+                inds = np.sort(np.random.choice(len(targets), n_voxels,
+                                                replace=False))
+            else:
+                # All voxels, a slice selects them without copying
+                n_voxels, inds = len(targets), slice(None)
+            points = np.empty(shape=(n_voxels, len(views), n_classes),
                               dtype=np.float32)
             points.fill(np.nan)
 
@@ -124,10 +135,9 @@ def _run_fusion_training(sets, logger, hparams, min_val_images, is_validation,
                                                   seq=seq,
                                                   image=image,
                                                   view=v,
-                                                  voxel_grid_real_space=voxel_grid_real_space,
                                                   n_planes='same+20',
                                                   targets=targets,
-                                                  eval_prob=eval_prob).reshape(-1, n_classes)
+                                                  eval_prob=eval_prob).reshape(-1, n_classes)[inds]
 
             # Clean up a bit
             del image_set_dict[image_id]
@@ -135,7 +145,7 @@ def _run_fusion_training(sets, logger, hparams, min_val_images, is_validation,
 
             # add to collections
             points_collection.append(points)
-            targets_collection.append(targets)
+            targets_collection.append(targets[inds])
 
         # Stack points into one matrix
         logger("Stacking points...")
@@ -190,6 +200,10 @@ def entry_func(args=None):
     eval_prob = args["eval_prob"]
     await_PID = args["wait_for"]
     dice_weight = args["dice_weight"]
+    voxel_fraction = args["voxel_fraction"]
+    if not 0 < voxel_fraction <= 1:
+        raise ValueError("--voxel_fraction must be in (0, 1], got %s"
+                         % voxel_fraction)
     print("Fitting fusion model for project-folder: %s" % basedir)
 
     # Wait for PID?
@@ -316,7 +330,8 @@ def entry_func(args=None):
         _run_fusion_training(sets, logger, hparams, min_val_images,
                              is_validation, views, n_classes, unet,
                              fusion_model_org, fusion_model,
-                             early_stopping, fm_batch_size, epochs, eval_prob)
+                             early_stopping, fm_batch_size, epochs, eval_prob,
+                             voxel_fraction)
     except KeyboardInterrupt:
         pass
     finally:
@@ -1,3 +1,3 @@
 from .funcs import init_callback_objects
 from .mcp_clean import ModelCheckPointClean
-from .callbacks import ValDiceScores, SavePredictionImages, PrintLayerWeights, Validation, FGBatchBalancer, DividerLine, SaveOutputAs2DImage, TrainTimer
+from .callbacks import ValDiceScores, SavePredictionImages, PrintLayerWeights, Validation, FGBatchBalancer, BatchProducerRefresh, PlaneBankRefresh, DividerLine, SaveOutputAs2DImage, TrainTimer, SamplingStatsLogger
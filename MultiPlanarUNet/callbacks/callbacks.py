@@ -4,6 +4,8 @@ from tensorflow.keras.callbacks import Callback
 from MultiPlanarUNet.evaluate.metrics import dice_all
 from MultiPlanarUNet.utils import highlighted
 from MultiPlanarUNet.logging import ScreenLogger
+from MultiPlanarUNet.sequences.validation_cache import ValidationCache
+from MultiPlanarUNet.sequences.sampling_stats import get_sampling_stats
 from MultiPlanarUNet.utils.plotting import imshow_with_label_overlay, imshow
 
 import numpy as np
@@ -115,6 +117,50 @@ class TrainTimer(Callback):
                            logs["train_time_total"]))
 
 
+class SamplingStatsLogger(Callback):
+    """
+    Appends the sampling stats of the training sequence (see
+    MultiPlanarUNet.sequences.sampling_stats) aggregated over the epoch to
+    the log: the mean number of sampling tries per batch, the fraction of
+    tries rejected by each test and the mean time per batch spent in each
+    stage of the batch creation (incl. ImageQueue waits).
+    If called prior to tf.keras.callbacks.CSVLogger this information will
+    be written to disk.
+
+    Entries are named 'sampler_<stat>', or 'sampler_<task>_<stat>' for
+    MultiTaskSequences.
+    """
+    def __init__(self, sequence, logger=None, verbose=1):
+        """
+        Args:
+            sequence: A MultiPlanarUNet.sequence object
+            logger:   An instance of a MultiPlanar Logger that prints to screen
+                      and/or file
+            verbose:  Print the stats to screen at the end of each epoch
+        """
+        super().__init__()
+        self.logger = logger or ScreenLogger()
+        self.verbose = bool(verbose)
+        self.stats = get_sampling_stats(sequence)
+        if len(self.stats) > 1:
+            self.prefixes = ["sampler_%s_" % t for t in sequence.task_names]
+        else:
+            self.prefixes = ["sampler_"]
+
+    def on_train_begin(self, logs=None):
+        # Drop batches sampled before training (probe batches, images etc.)
+        for stats in self.stats:
+            stats.reset()
+
+    def on_epoch_end(self, epoch, logs=None):
+        for prefix, stats in zip(self.prefixes, self.stats):
+            for key, value in stats.summary().items():
+                logs[prefix + key] = value
+            if self.verbose:
+                self.logger("[%s] %s" % (prefix.rstrip("_"), stats))
+            stats.reset()
+
+
 class FGBatchBalancer(Callback):
     """
     MultiPlanarUNet callback.
@@ -161,6 +207,60 @@ class FGBatchBalancer(Callback):
                                                           data.batch_size))
 
 
+class BatchProducerRefresh(Callback):
+    """
+    MultiPlanarUNet callback.
+
+    Restarts the worker processes of a SharedBatchProducer at the end of each
+    epoch, so that changes to the training sequence made by other callbacks
+    (e.g. FGBatchBalancer) reach the workers. Should be placed after such
+    callbacks.
+
+    The epoch of the sequence is set to the next epoch before the restart, so
+    that the restarted workers draw batches with new keys (see
+    BaseSequence.get_rng).
+    """
+    def __init__(self, producer, logger=None):
+        """
+        Args:
+            producer: A MultiPlanarUNet.sequences.SharedBatchProducer object
+            logger:   An instance of a MultiPlanar Logger that prints to screen
+                      and/or file
+        """
+        super().__init__()
+        self.producer = producer
+        self.logger = logger or ScreenLogger()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if hasattr(self.producer.sequence, "epoch"):
+            self.producer.sequence.epoch = epoch + 1
+        if self.producer.is_running:
+            self.producer.restart()
+
+
+class PlaneBankRefresh(Callback):
+    """
+    MultiPlanarUNet callback.
+
+    Starts the background re-sampling of a fraction of the plane bank of a
+    PlaneBankSequence2D at the end of each epoch. Should be placed before
+    BatchProducerRefresh.
+    """
+    def __init__(self, sequence, logger=None):
+        """
+        Args:
+            sequence: A MultiPlanarUNet.sequences.PlaneBankSequence2D object
+            logger:   An instance of a MultiPlanar Logger that prints to screen
+                      and/or file
+        """
+        super().__init__()
+        self.sequence = sequence
+        self.logger = logger or ScreenLogger()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.sequence.refresh()
+
+
 class PrintLayerWeights(Callback):
     """
     Print the weights of a specified layer every some epoch or batch.
@@ -229,10 +329,17 @@ class Validation(Callback):
     Note: this callback should be called prior to other callbacks evaluating
           those values in a given epoch
 
+    The validation batches of epoch 'epoch' are sampled with the epoch of
+    the validation sequence set to 'epoch', so new batches are drawn each
+    epoch. If 'cache_folder' is set, the batches of epoch 0 are sampled once
+    and stored in a ValidationCache in that folder. Later epochs predict on
+    the cached batches only.
+
     TODO: Currently hard-coded to compute non-BG mean dice coefficients. Change
           to accept arbitrary evaluation functions
     """
-    def __init__(self, val_sequence, steps, logger=None, verbose=True):
+    def __init__(self, val_sequence, steps, logger=None, verbose=True,
+                 cache_folder=None):
         """
         Args:
             val_sequence: A MultiPlanarUNet.sequence object from which validation
@@ -242,12 +349,16 @@ class Validation(Callback):
             logger:       An instance of a MultiPlanar Logger that prints to screen
                           and/or file
             verbose:      Print progress to screen - OBS does not use Logger
+            cache_folder: Optional folder in which to cache the validation
+                          batches, see ValidationCache
         """
         super().__init__()
         self.logger = logger or ScreenLogger()
         self.data = val_sequence
         self.steps = steps
         self.verbose = verbose
+        self.cache_folder = cache_folder
+        self.cache = None
 
         self.n_classes = self.data.n_classes
         if isinstance(self.n_classes, int):
@@ -286,9 +397,16 @@ class Validation(Callback):
                     selected[i] += sel.astype(np.uint64)
                     lock.release()
 
-        # Fetch some validation images from the generator
+        # Fetch some validation images from the generator or the cache
         pool = ThreadPoolExecutor(max_workers=7)
-        result = pool.map(self.data.__getitem__, np.arange(self.steps))
+        if self.cache_folder:
+            if self.cache is None:
+                self.cache = ValidationCache(self.data, self.steps,
+                                             self.cache_folder,
+                                             logger=self.logger)
+            result = (self.cache[i] for i in range(self.steps))
+        else:
+            result = pool.map(self.data.__getitem__, np.arange(self.steps))
 
         # Prepare arrays for CM summary stats
         TPs, relevant, selected = [], [], []
@@ -309,7 +427,7 @@ class Validation(Callback):
 
         # Predict on all
         self.logger("")
-        for i, (X, y, w) in enumerate(result):
+        for i, (X, y) in enumerate(batch[:2] for batch in result):
             if self.verbose:
                 print("   Validation: %i/%i" % (i+1, self.steps), end="\r", flush=True)
 
@@ -327,6 +445,9 @@ class Validation(Callback):
         return TPs, relevant, selected
 
     def on_epoch_end(self, epoch, logs={}):
+        # Sample new validation batches each epoch (see BaseSequence.get_rng),
+        # the cached batches are those of epoch 0
+        self.data.epoch = 0 if self.cache_folder else epoch
 
         # Predict and get CM
         for name, tp, rel, sel in zip(self.task_names, *self.predict()):
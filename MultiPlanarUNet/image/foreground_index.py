@@ -0,0 +1,121 @@
+import numpy as np
+from MultiPlanarUNet.utils.rng import get_rng
+
+
+class ForegroundIndex(object):
+    """
+    Compact index of the foreground voxels of a label map
+
+    For each foreground class a random subset of at most 'max_per_class'
+    voxels is stored, both as voxel indices and as coordinates in the real
+    space frame in which planes and boxes are sampled (scanner space axes,
+    centered on the image center, see ViewInterpolator).
+
+    Used by the sequence objects to place sample planes/boxes directly on
+    foreground regions instead of rejection sampling.
+    """
+    def __init__(self, labels, affine, bg_class=0, max_per_class=5000,
+                 slab_size=16, seed=0):
+        """
+        Args:
+            labels:        ndarray of shape [X, Y, Z] or [X, Y, Z, 1] of
+                           integer class labels
+            affine:        The 4x4 voxel to scanner space affine of the labels
+            bg_class:      The background class, not indexed
+            max_per_class: Maximum (expected) number of voxels stored for
+                           each foreground class
+            slab_size:     Number of slices along the first axis processed at
+                           a time when scanning the label map
+            seed:          Seed of the voxel subsampling, so that the index
+                           of a label map is the same each time it is built
+        """
+        labels = np.asarray(labels)
+        if labels.ndim == 4:
+            labels = labels[..., 0]
+        self.bg_class = bg_class
+        self.max_per_class = max_per_class
+
+        # Count voxels per class
+        if np.issubdtype(labels.dtype, np.unsignedinteger):
+            counts = np.bincount(labels.ravel())
+            classes = np.nonzero(counts)[0]
+            counts = counts[classes]
+        else:
+            classes, counts = np.unique(labels, return_counts=True)
+        fg = classes != bg_class
+        classes, counts = classes[fg], counts[fg]
+
+        # Keep each voxel of class c with probability max_per_class/count_c
+        keep_prob = np.minimum(1.0, max_per_class / np.maximum(counts, 1))
+
+        # Scan the label map in slabs to bound the size of the temporaries
+        rng = np.random.default_rng(seed)
+        voxels, voxel_classes = [], []
+        for start in range(0, labels.shape[0], slab_size):
+            slab = labels[start:start + slab_size]
+            inds = np.nonzero(slab != bg_class)
+            if len(inds[0]) == 0:
+                continue
+            slab_classes = slab[inds]
+            probs = keep_prob[np.searchsorted(classes, slab_classes)]
+            keep = rng.random(len(slab_classes)) < probs
+            inds = np.stack([i[keep] for i in inds], axis=1)
+            inds[:, 0] += start
+            voxels.append(inds.astype(np.int32))
+            voxel_classes.append(slab_classes[keep])
+
+        if voxels:
+            voxels = np.concatenate(voxels)
+            voxel_classes = np.concatenate(voxel_classes)
+        else:
+            voxels = np.empty((0, 3), dtype=np.int32)
+            voxel_classes = np.empty(0, dtype=labels.dtype)
+
+        # Group by class
+        order = np.argsort(voxel_classes, kind="stable")
+        self.voxels = voxels[order]
+        voxel_classes = voxel_classes[order]
+        self.classes, self.class_starts, self.class_counts = np.unique(
+            voxel_classes, return_index=True, return_counts=True
+        )
+
+        # Real space coordinates, centered on the image center
+        center = (np.asarray(labels.shape) - 1) / 2
+        self.points = ((self.voxels - center).dot(affine[:3, :3].T)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.voxels)
+
+    def __str__(self):
+        return "ForegroundIndex(n_voxels=%i, classes=%s)" % (len(self),
+                                                             list(self.classes))
+
+    def __repr__(self):
+        return str(self)
+
+    def sample(self, classes=None, rng=None):
+        """
+        Sample a random indexed foreground voxel. The class is drawn uniformly
+        from 'classes' (or all indexed classes if None or if none of 'classes'
+        are indexed), then a voxel uniformly from those of the class.
+
+        Args:
+            classes: Optional list of preferred classes
+            rng:     Optional np.random.Generator, see utils.rng.get_rng
+
+        Returns:
+            None if no voxels are indexed, otherwise a tuple of the voxel index
+            (ndarray of shape [3]), real space point (ndarray of shape [3])
+            and class of the sampled voxel
+        """
+        if len(self) == 0:
+            return None
+        candidates = np.arange(len(self.classes))
+        if classes is not None:
+            preferred = np.nonzero(np.isin(self.classes, classes))[0]
+            if len(preferred):
+                candidates = preferred
+        rng = get_rng(rng)
+        c = candidates[rng.integers(len(candidates))]
+        i = self.class_starts[c] + rng.integers(self.class_counts[c])
+        return self.voxels[i], self.points[i], self.classes[c]
@@ -0,0 +1,66 @@
+import numpy as np
+from MultiPlanarUNet.interpolation.sample_grid import get_real_space_corners
+
+
+class ImageGeometry(object):
+    """
+    Compact, immutable record of the voxel and real space geometry of an
+    image, computed once from its shape, voxel dimensions and affine.
+
+    Used by the ImagePair objects so that the sequences and samplers may read
+    e.g. the real shape or bounding radius of an image without going through
+    the nibabel header on each sample.
+    """
+    __slots__ = ("shape", "pix_dim", "affine", "inv_affine", "real_shape",
+                 "center", "real_center", "bounding_radius", "corners")
+
+    def __init__(self, shape, pix_dim, affine):
+        """
+        Args:
+            shape:   The voxel shape of the image, rank 4 with channels axis
+            pix_dim: The voxel dimensions of the image, ndarray of shape [3]
+            affine:  The 4x4 voxel to scanner space affine of the image
+        """
+        shape = np.array(shape, dtype=np.int64)
+        pix_dim = np.array(pix_dim, dtype=np.float64)
+        affine = np.array(affine, dtype=np.float64)
+
+        # Voxel-space center and its scanner-space position
+        center = (shape[:3] - 1) / 2
+        real_center = affine[:3, :3].dot(center) + affine[:3, -1]
+
+        # Real (physical) span and radius of the bounding sphere
+        real_shape = shape[:3] * pix_dim
+        bounding_radius = float(np.linalg.norm(real_shape / 2))
+
+        # The 8 corner voxel positions in the centered real space frame in
+        # which planes and boxes are sampled (see ViewInterpolator)
+        corners = get_real_space_corners(shape, affine)
+
+        values = {"shape": shape, "pix_dim": pix_dim, "affine": affine,
+                  "inv_affine": np.linalg.inv(affine),
+                  "real_shape": real_shape, "center": center,
+                  "real_center": real_center,
+                  "bounding_radius": bounding_radius, "corners": corners}
+        for name, value in values.items():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ImageGeometry objects are immutable")
+
+    def __reduce__(self):
+        return self.__class__, (self.shape, self.pix_dim, self.affine)
+
+    def __str__(self):
+        return "ImageGeometry(shape=%s, pix_dim=%s)" % (
+            tuple(self.shape), tuple(np.round(self.pix_dim, 3))
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def max_real_dim(self):
+        return np.max(self.real_shape)
@@ -12,8 +12,10 @@ import nibabel as nib
 
 from MultiPlanarUNet.preprocessing import get_scaler
 from MultiPlanarUNet.logging import ScreenLogger
-from MultiPlanarUNet.interpolation.sample_grid import get_real_image_size, get_pix_dim
+from MultiPlanarUNet.interpolation.sample_grid import get_pix_dim
 from MultiPlanarUNet.interpolation.view_interpolator import ViewInterpolator
+from MultiPlanarUNet.image.foreground_index import ForegroundIndex
+from MultiPlanarUNet.image.image_geometry import ImageGeometry
 
 # w2 negative threshold is too strict for this data set
 nib.Nifti1Header.quaternion_threshold = -1e-6
@@ -36,6 +38,8 @@ class ImagePair(object):
               Loading of data happens automatically at the first reference to
               the image or label attributes
             - In ID name is established (filename minus extension)
+            - The image geometry (shape, affine etc.) is computed from the
+              image header, see self.geometry
             - Placeholder attributes are created that may be used in methods
 
         Args:
@@ -88,6 +92,17 @@ class ImagePair(object):
         # ViewInterpolator object initialized with set_interpolator_object
         self.interpolator = None
 
+        # ForegroundIndex object, built at first reference to fg_index
+        self._fg_index = None
+
+        # Voxel bounding box (ndarray [[start, stop] x 3]) of the image content
+        # the image and labels are cropped to, set by crop_to_content
+        self.crop_box = None
+
+        # ImageGeometry object, recomputed when cropping
+        self.geometry = None
+        self._set_geometry()
+
         # May be set by various functions to keep track of state of this image
         self.load_state = None
 
@@ -110,13 +125,16 @@ class ImagePair(object):
                     "--- real shape: %s\n"
                     "--- pixdim:     %s" % (
                         self.id, self.shape,
-                        np.round(get_real_image_size(self), 3),
-                        np.round(get_pix_dim(self), 3)
+                        np.round(self.real_shape, 3),
+                        np.round(self.pix_dim, 3)
                     ), print_calling_method=print_calling_method)
 
     def __getattr__(self, item):
         if item in self.__dict__:
             return self.__dict__[item]
+        elif "image_obj" not in self.__dict__:
+            # Not yet initialized (e.g. while unpickling)
+            raise AttributeError(item)
         else:
             try:
                 return getattr(self.image_obj, item)
@@ -135,8 +153,13 @@ class ImagePair(object):
         internal copy of the image. Un-assigning self._image will GC the array.
         """
         if self._image is None:
-            self._image = self.image_obj.get_fdata(caching='unchanged',
-                                                   dtype=self.im_dtype)
+            if self.crop_box is not None:
+                # Only read the cropped region from disk
+                self._image = np.asarray(self.image_obj.dataobj[self.crop_slices],
+                                         dtype=self.im_dtype)
+            else:
+                self._image = self.image_obj.get_fdata(caching='unchanged',
+                                                       dtype=self.im_dtype)
         if self._image.ndim == 3:
             self._image = np.expand_dims(self._image, -1)
         return self._image
@@ -151,12 +174,36 @@ class ImagePair(object):
         """ Like self.image """
         if self._labels is None:
             try:
-                self._labels = self.labels_obj.get_fdata(caching="unchanged").astype(self.lab_dtype)
+                if self.crop_box is not None:
+                    labels = np.asarray(self.labels_obj.dataobj[self.crop_slices],
+                                        dtype=np.float32)
+                else:
+                    labels = self.labels_obj.get_fdata(caching="unchanged",
+                                                       dtype=np.float32)
             except AttributeError as e:
                 raise AttributeError("No label file attached to "
                                      "this ImagePair object.") from e
+            self.lab_dtype = self._get_label_dtype(labels)
+            self._labels = labels.astype(self.lab_dtype)
         return self._labels
 
+    def _get_label_dtype(self, labels):
+        """
+        Returns the label dtype used for this ImagePair, self.lab_dtype if all
+        labels fit in its range, otherwise the smallest of uint16 and int32
+        that does. Labels keep this dtype through interpolation.
+        """
+        for dtype in (self.lab_dtype, np.uint16, np.int32):
+            info = np.iinfo(dtype)
+            if labels.min() >= info.min and labels.max() <= info.max:
+                if np.dtype(dtype) != np.dtype(self.lab_dtype):
+                    self.logger("OBS: Labels of %s exceed the range of %s, "
+                                "using %s" % (self.id,
+                                              np.dtype(self.lab_dtype).name,
+                                              np.dtype(dtype).name))
+                return dtype
+        raise ValueError("Labels of %s exceed the range of int32" % self.id)
+
     @labels.setter
     def labels(self, labels):
         raise AttributeError("Manually setting the labels attribute is not "
@@ -170,6 +217,23 @@ class ImagePair(object):
             raise FileNotFoundError("File '%s' not found or not a "
                                     ".nii or .mat file." % path)
 
+    @property
+    def fg_index(self):
+        """
+        Returns a ForegroundIndex of the labels (built at first reference)
+        storing a random, class-stratified subset of the foreground voxel
+        positions of this ImagePair
+        See MultiPlanarUNet.image.foreground_index
+        """
+        if self._fg_index is None:
+            if self.predict_mode:
+                raise AttributeError("No label file attached to "
+                                     "this ImagePair object.")
+            bg_class = self.bg_class if self.bg_class is not None else 0
+            self._fg_index = ForegroundIndex(self.labels, self.affine,
+                                             bg_class=bg_class)
+        return self._fg_index
+
     @property
     def estimated_memory(self):
         """
@@ -195,13 +259,30 @@ class ImagePair(object):
                              "0 and less than or equal to 1")
         self._sample_weight = weight
 
+    def _set_geometry(self):
+        """
+        Compute the ImageGeometry of the (possibly cropped) image from the
+        image header. Voxel [0, 0, 0] of a cropped image maps to the same
+        scanner space position as the first voxel of the crop box in the full
+        image.
+        """
+        shape = np.asarray(self.image_obj.shape)
+        if len(shape) == 3:
+            shape = np.append(shape, 1)
+        affine = np.array(self.image_obj.affine)
+        if self.crop_box is not None:
+            shape[:3] = self.crop_box[:, 1] - self.crop_box[:, 0]
+            affine[:3, -1] += affine[:3, :3].dot(self.crop_box[:, 0])
+        self.geometry = ImageGeometry(shape, get_pix_dim(self.image_obj),
+                                      affine)
+
     @property
     def center(self):
         """
         Returns:
             The voxel-space center of the image
         """
-        return (self.shape[:-1]-1)/2
+        return self.geometry.center
 
     @property
     def real_center(self):
@@ -209,18 +290,16 @@ class ImagePair(object):
         Returns:
             The scanner-space center of the image
         """
-        return self.affine[:3, :3].dot(self.center) + self.affine[:3, -1]
+        return self.geometry.real_center
 
     @property
     def shape(self):
         """
         Returns:
             The voxel shape of the image (always rank 4 with channels axis)
+            Reflects the crop box if set.
         """
-        s = np.asarray(self.image_obj.shape)
-        if len(s) == 3:
-            s = np.append(s, 1)
-        return s
+        return self.geometry.shape
 
     @property
     def real_shape(self):
@@ -228,13 +307,134 @@ class ImagePair(object):
         Returns:
             The real (physical, scanner-space span) shape of the image
         """
-        return get_real_image_size(self.image_obj)
+        return self.geometry.real_shape
+
+    @property
+    def pix_dim(self):
+        """
+        Returns:
+            The voxel dimensions of the image
+        """
+        return self.geometry.pix_dim
+
+    @property
+    def affine(self):
+        """
+        Returns:
+            The voxel to scanner space affine of the (possibly cropped) image
+        """
+        return self.geometry.affine
+
+    @property
+    def full_shape(self):
+        """
+        Returns:
+            The voxel shape of the image on disk, ignoring the crop box
+        """
+        return np.asarray(self.image_obj.shape)[:3]
+
+    @property
+    def crop_slices(self):
+        """
+        Returns:
+            A tuple of 3 slices selecting the crop box in the full image
+        """
+        return tuple(slice(int(a), int(b)) for a, b in self.crop_box)
+
+    def get_content_box(self, bg_value, bg_class=0, margin=0):
+        """
+        Compute the voxel bounding box of the image content, i.e. voxels for
+        which any channel differs from bg_value or the label (if any) differs
+        from bg_class, expanded by 'margin' voxels and clipped to the image.
+
+        Args:
+            bg_value: A number, the value of the constant background
+            bg_class: An integer, the background class
+            margin:   Integer number of voxels to keep around the content
+
+        Returns:
+            An ndarray of shape [3, 2] of [start, stop] voxel indices, or None
+            if the image holds no content
+        """
+        content = np.any(~np.isclose(self.image, bg_value), axis=-1)
+        if not self.predict_mode:
+            content |= self.labels.reshape(content.shape) != bg_class
+        box = []
+        for axis in range(3):
+            other = tuple(a for a in range(3) if a != axis)
+            inds = np.nonzero(np.any(content, axis=other))[0]
+            if len(inds) == 0:
+                return None
+            box.append([inds[0], inds[-1] + 1])
+        box = np.asarray(box) + [-int(margin), int(margin)]
+        return np.clip(box, 0, self.shape[:3, None])
+
+    def crop_to_content(self, bg_value, bg_class=0, margin=5):
+        """
+        Crop the image and labels to the bounding box of their content (see
+        get_content_box). The affine is adjusted accordingly so that the
+        cropped voxels keep their scanner space positions.
+
+        The crop box is stored in self.crop_box and persists across
+        unload/load cycles, in which only the cropped region is read from
+        disk. Predictions may be pasted back into the full grid with
+        paste_to_full.
+
+        Note: The sampling grids of the iso_live sequences are centered on the
+        image center, which moves with the crop to the center of the content.
+
+        Args:
+            bg_value: A number, the value of the constant background
+            bg_class: An integer, the background class
+            margin:   Integer number of voxels to keep around the content
+        """
+        if self.crop_box is not None:
+            # Already cropped
+            return
+        box = self.get_content_box(bg_value, bg_class, margin)
+        if box is None or (np.all(box[:, 0] == 0) and
+                           np.all(box[:, 1] == self.shape[:3])):
+            # No content or nothing to crop
+            return
+        old_shape = self.shape[:3]
+        self.crop_box = box
+        self._set_geometry()
+        slices = self.crop_slices
+        self._image = self._image[slices].copy()
+        if self._labels is not None:
+            self._labels = self._labels[slices].copy()
+        self._fg_index = None
+        self.interpolator = None
+        self.logger("OBS: Cropped %s from %s to %s voxels "
+                    "(crop box %s)" % (self.id, tuple(old_shape),
+                                       tuple(self.shape[:3]), box.tolist()))
+
+    def paste_to_full(self, array, fill_value=0):
+        """
+        Paste an array of the (cropped) image shape into an array of the full
+        image shape. Voxels outside the crop box are set to 'fill_value'.
+
+        Args:
+            array:      ndarray of shape [X, Y, Z, ...] matching self.shape
+            fill_value: Value or ndarray broadcastable to array.shape[3:]
+
+        Returns:
+            The full ndarray of shape [X_full, Y_full, Z_full, ...]
+        """
+        if self.crop_box is None:
+            return array
+        full = np.empty(tuple(self.full_shape) + array.shape[3:],
+                        dtype=array.dtype)
+        full[...] = fill_value
+        full[self.crop_slices] = array
+        return full
 
     @property
     def n_channels(self):
         return self.shape[-1]
 
-    def prepare_for_iso_live(self, bg_value, bg_class, scaler):
+    def prepare_for_iso_live(self, bg_value, bg_class, scaler,
+                             label_preview_factor=None, crop_margin=None):
         """
         Utility method preparing the ImagePair for usage in the iso_live
         interpolation mode (see MultiPlanarUNet.image.ImagePairLoader class).
@@ -242,8 +442,10 @@ class ImagePair(object):
         Performs the following operations:
             1) Loads the image and labels if not already loaded (transparent)
             2) Define proper background value
-            3) Setting multi-channel scaler
-            4) Setting interpolator object
+            3) Cropping to the image content (optional)
+            4) Setting multi-channel scaler
+            5) Setting interpolator object
+            6) Building a coarse label preview (optional)
 
         Args:
             bg_value: A value defining the space outside of the image region.
@@ -254,18 +456,22 @@ class ImagePair(object):
                       pixels getting the 'bg_value' value.
             scaler:   String indicating which sklearn scaler class to use for
                       preprocessing of the image.
-        """
-        if isinstance(bg_value, str):
-            # assuming '<number>pct' format
-            bg_pct = int(bg_value.lower().replace(" ", "").split("pct")[0])
-            bg_value = np.percentile(self.image, bg_pct)
-
-            self.logger("OBS: Using %i percentile BG value of %.3f" % (
-                bg_pct, bg_value
-            ))
-        self.bg_value = bg_value
+            label_preview_factor: Integer block size (in voxels) of a coarse
+                      label preview set on the interpolator, used by the
+                      sequences to reject candidate planes/boxes without
+                      full resolution label interpolation. None to disable.
+            crop_margin: Integer number of voxels of background to keep
+                      around the image content when cropping the image and
+                      labels (see crop_to_content). None to disable.
+        """
+        self.bg_value = self.parse_bg_value(bg_value)
         self.bg_class = bg_class
 
+        # Crop constant background margins
+        if crop_margin is not None:
+            self.crop_to_content(self.standardize_bg_val(self.bg_value),
+                                 bg_class, crop_margin)
+
         # Apply scaling
         if self.scaler is None:
             self.set_scaler(scaler)
@@ -274,11 +480,17 @@ class ImagePair(object):
         self.set_interpolator_with_current(bg_value=self.bg_value,
                                            bg_class=self.bg_class)
 
+        # Set coarse label preview
+        if label_preview_factor and not self.predict_mode:
+            self.interpolator.set_label_preview(label_preview_factor)
+
     def unload(self, unload_scaler=False):
         """
         Unloads the ImagePair by un-assigning the image and labels attributes
         Also clears the currently set interpolator object, as this references
-        the image and label arrays and thus might prevent GC.
+        the image and label arrays and thus might prevent GC. The (compact)
+        foreground index and the crop box are kept, as they are the same
+        across loads.
 
         Args:
             unload_scaler: boolean indicating whether or not to also clear the
@@ -348,11 +560,19 @@ class ImagePair(object):
         """
         self.interpolator = self.get_interpolator_with_current(*args, **kwargs)
 
-    def set_scaler(self, scaler):
+    def set_scaler(self, scaler, bg_value=None, crop_margin=None):
         """
         Sets a scaler on the ImagePair fit to the stored image
         See MultiPlanarUNet.preprocessing.scaling
+
+        If crop_margin is not None, the image and labels are first cropped to
+        the image content (see crop_to_content) using background value
+        'bg_value' (see parse_bg_value).
         """
+        if crop_margin is not None:
+            bg_value = self.standardize_bg_val(self.parse_bg_value(bg_value))
+            bg_class = self.bg_class if self.bg_class is not None else 0
+            self.crop_to_content(bg_value, bg_class, crop_margin)
         self.scaler = get_scaler(scaler=scaler).fit(self.image)
 
     def apply_scaler(self):
@@ -362,6 +582,21 @@ class ImagePair(object):
         """
         self.image = self.scaler.transform(self.image)
 
+    def parse_bg_value(self, bg_value):
+        """
+        Parse a bg_value of the string format '[0-100]pct' to the percentile
+        value computed across the image. Other values are returned unchanged.
+        """
+        if isinstance(bg_value, str):
+            # assuming '<number>pct' format
+            bg_pct = int(bg_value.lower().replace(" ", "").split("pct")[0])
+            bg_value = np.percentile(self.image, bg_pct)
+
+            self.logger("OBS: Using %i percentile BG value of %.3f" % (
+                bg_pct, bg_value
+            ))
+        return bg_value
+
     def standardize_bg_val(self, bg_value):
         """
         Standardize the bg_value, handles None and False differently from 0
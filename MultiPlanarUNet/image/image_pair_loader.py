@@ -12,6 +12,7 @@ import numpy as np
 
 from .image_pair import ImagePair
 from MultiPlanarUNet.logging import ScreenLogger
+from MultiPlanarUNet.utils.rng import get_rng
 
 
 class ImagePairLoader(object):
@@ -155,17 +156,21 @@ class ImagePairLoader(object):
         """
         return self.id_to_image[image_id]
 
-    def get_random(self, N=1, unique=False):
+    def get_random(self, N=1, unique=False, rng=None):
         """
         Return N random images, with or without re-sampling
 
         Args:
             N:      Int, number of randomly sampled images to return
             unique: Bool, whether the sampled images should be all unique
+            rng:    Optional np.random.Generator used to select the images.
+                    Images taken from an ImageQueue depend on its (threaded)
+                    loading and are not reproducible.
 
         Returns:
             A list of ImagePair objects
         """
+        rng = get_rng(rng)
         returned = []
         while len(returned) < N:
             if self.queue:
@@ -176,7 +181,7 @@ class ImagePairLoader(object):
                         returned.append(image)
                         yield image
             else:
-                image = self.images[np.random.randint(len(self))]
+                image = self.images[rng.integers(len(self))]
                 if unique and image in returned:
                     continue
                 else:
@@ -347,7 +352,8 @@ class ImagePairLoader(object):
         from MultiPlanarUNet.interpolation.sample_grid import get_maximum_real_dim
         return np.max([get_maximum_real_dim(f.image_obj) for f in self])
 
-    def set_normalizer(self, scaler, **kwargs):
+    def set_normalizer(self, scaler, bg_value=None, crop_margin=None,
+                       **kwargs):
         """
         Set and fit a scaler on all stored ImagePair objects.
         The scaler should be a sklearn preprocessing scaler, which will be
@@ -355,26 +361,33 @@ class ImagePairLoader(object):
         (and apply when called) the scaler to each channel separately.
 
         Args:
-            scaler:   String name of sklearn scaler class
-            **kwargs: Other arguments, not used
+            scaler:      String name of sklearn scaler class
+            bg_value:    See ImagePair.set_scaler
+            crop_margin: See ImagePair.set_scaler
+            **kwargs:    Other arguments, not used
         """
         for image in self:
-            image.set_scaler(scaler)
+            image.set_scaler(scaler, bg_value, crop_margin)
             image.log_image()
 
-    def prepare_for_iso_live_views(self, bg_class, bg_value, scaler, **kwargs):
+    def prepare_for_iso_live_views(self, bg_class, bg_value, scaler,
+                                   label_preview_factor=None, crop_margin=None,
+                                   **kwargs):
         """
         Loads all images and prepares them for iso-live view interpolation
         training by performing the following operations on each:
             1) Loads the image and labels if not already loaded (transparent)
             2) Define proper background value
-            3) Setting multi-channel scaler
-            4) Setting interpolator object
+            3) Cropping to the image content (optional)
+            4) Setting multi-channel scaler
+            5) Setting interpolator object
 
         Args:
             bg_class: See ImagePair.prepare_for_iso_live_views
             bg_value: See ImagePair.prepare_for_iso_live_views
             scaler:   See ImagePair.prepare_for_iso_live_views
+            label_preview_factor: See ImagePair.prepare_for_iso_live_views
+            crop_margin: See ImagePair.prepare_for_iso_live_views
             **kwargs: Additional keyword arguments
         """
         # Log some things...
@@ -383,7 +396,8 @@ class ImagePairLoader(object):
 
         # Run over volumes: scale, set interpolator, check for affine
         for image in self.id_to_image.values():
-            image.prepare_for_iso_live(bg_value, bg_class, scaler)
+            image.prepare_for_iso_live(bg_value, bg_class, scaler,
+                                       label_preview_factor, crop_margin)
 
             # Log basic stats for the image
             image.log_image()
@@ -437,6 +451,8 @@ class ImagePairLoader(object):
                 self.prepare_for_iso_live_views(**kwargs)
             else:
                 in_kw = {key: kwargs[key] for key in ("bg_value", "bg_class", "scaler")}
+                in_kw["label_preview_factor"] = kwargs.get("label_preview_factor")
+                in_kw["crop_margin"] = kwargs.get("crop_margin")
                 self.queue.set_entry_func("prepare_for_iso_live", in_kw)
                 self.queue.set_exit_func("unload")
 
@@ -444,6 +460,15 @@ class ImagePairLoader(object):
                 self.queue.start(n_threads=3)
                 self.queue.await_full()
 
+            if kwargs.get("plane_bank") and not is_validation:
+                # Draw training batches from a bank of pre-sampled planes
+                from MultiPlanarUNet.sequences import PlaneBankSequence2D
+                return PlaneBankSequence2D(self,
+                                           use_queue=bool(self.queue),
+                                           list_of_augmenters=aug_list,
+                                           logger=self.logger,
+                                           **kwargs)
+
             return IsotrophicLiveViewSequence2D(self,
                                                 is_validation=is_validation,
                                                 use_queue=bool(self.queue),
@@ -460,6 +485,8 @@ class ImagePairLoader(object):
                 self.prepare_for_iso_live_views(**kwargs)
             else:
                 in_kw = {key: kwargs[key] for key in ("bg_value", "bg_class", "scaler")}
+                in_kw["label_preview_factor"] = kwargs.get("label_preview_factor")
+                in_kw["crop_margin"] = kwargs.get("crop_margin")
                 self.queue.set_entry_func("prepare_for_iso_live", in_kw)
                 self.queue.set_exit_func("unload")
 
@@ -482,6 +509,7 @@ class ImagePairLoader(object):
                 self.set_normalizer(**kwargs)
             else:
                 in_kw = {key: kwargs[key] for key in ("bg_value", "scaler")}
+                in_kw["crop_margin"] = kwargs.get("crop_margin")
                 self.queue.set_entry_func("set_scaler", in_kw)
                 self.queue.set_exit_func("unload")
 
@@ -501,6 +529,7 @@ class ImagePairLoader(object):
                 self.set_normalizer(**kwargs)
             else:
                 in_kw = {key: kwargs[key] for key in ("bg_value", "scaler")}
+                in_kw["crop_margin"] = kwargs.get("crop_margin")
                 self.queue.set_entry_func("set_scaler", in_kw)
                 self.queue.set_exit_func("unload")
 
@@ -181,6 +181,25 @@ class ImageQueue(object):
             thread.start()
             self.threads.append((thread, stop_event))
 
+    def restart_after_fork(self, n_threads=None):
+        """
+        Threads (and possibly held locks) are not properly inherited by a
+        forked child process. Re-initialize the queue in the child with the
+        images currently in the (inherited) queue and start n_threads
+        populating threads.
+
+        Args:
+            n_threads: Number of threads to spin up in the child process,
+                       defaults to the number of threads of the parent
+        """
+        n_threads = n_threads or max(len(self.threads), 1)
+        images = list(self.queue.queue)
+        self.queue = Queue(maxsize=self.queue.maxsize)
+        for image in images:
+            self.queue.put_nowait(image)
+        self.threads = []
+        self.start(n_threads=n_threads)
+
     def stop(self):
         """
         Stop populating the queue by invoking the stop event on all threads and
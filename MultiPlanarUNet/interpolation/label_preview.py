@@ -0,0 +1,89 @@
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+
+class LabelPreview(object):
+    """
+    Coarse representation of a label map storing which classes are present
+    in each block of factor x factor x factor voxels. Each block is dilated by
+    one block in all directions, so that a look-up at any position returns
+    all classes present within 'factor' voxels (along each axis) of it.
+
+    Used to cheaply determine a superset of the classes hit by a sampling grid
+    before interpolating the labels at full resolution.
+    """
+    def __init__(self, labels, factor=4):
+        """
+        Args:
+            labels: A ndarray of shape [X, Y, Z] or [X, Y, Z, 1] of integer
+                    class labels
+            factor: Integer >= 2, the block size in voxels
+        """
+        labels = np.asarray(labels)
+        if labels.ndim == 4:
+            labels = labels[..., 0]
+        self.factor = int(factor)
+        if self.factor < 2:
+            raise ValueError("Label preview factor must be >= 2, "
+                             "got %s" % factor)
+
+        # Classes present in the label map
+        if np.issubdtype(labels.dtype, np.unsignedinteger):
+            self.classes = np.nonzero(np.bincount(labels.ravel()))[0]
+        else:
+            self.classes = np.unique(labels)
+
+        # Pad to a multiple of the block size, repeated edge values do not
+        # add classes to a block
+        f = self.factor
+        self.n_blocks = -(-np.asarray(labels.shape) // f)
+        pad = self.n_blocks * f - np.asarray(labels.shape)
+        labels = np.pad(labels, [(0, p) for p in pad], mode="edge")
+
+        # Class presence per block
+        blocked_shape = (self.n_blocks[0], f, self.n_blocks[1], f,
+                         self.n_blocks[2], f)
+        presence = np.empty(tuple(self.n_blocks) + (len(self.classes),),
+                            dtype=np.bool_)
+        for i, c in enumerate(self.classes):
+            presence[..., i] = (labels == c).reshape(blocked_shape).any(axis=(1, 3, 5))
+
+        # Dilate by one block
+        self.presence = maximum_filter(presence, size=(3, 3, 3, 1),
+                                       mode="nearest")
+
+    def __str__(self):
+        return "LabelPreview(factor=%i, n_blocks=%s, n_classes=%i)" % (
+            self.factor, tuple(self.n_blocks), len(self.classes)
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def max_distance(self):
+        """
+        The maximum distance (in voxels, along each voxel axis) between a
+        queried position and a position whose classes are guaranteed to be
+        included in the look-up.
+        """
+        return self.factor - 1
+
+    def classes_at(self, voxel_points):
+        """
+        Look up the classes that may be present at and around positions given
+        in continuous voxel index coordinates.
+
+        Args:
+            voxel_points: A list of 3 ndarrays of voxel index coordinates
+
+        Returns:
+            An ndarray of classes, a superset of the classes found at the
+            nearest voxel of all points within self.max_distance of the points
+        """
+        blocks = []
+        for p, n in zip(voxel_points, self.n_blocks):
+            b = np.floor(np.round(np.ravel(p)) / self.factor).astype(np.int64)
+            blocks.append(np.clip(b, 0, n - 1))
+        present = self.presence[tuple(blocks)].any(axis=0)
+        return self.classes[present]
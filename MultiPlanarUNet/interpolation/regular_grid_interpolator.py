@@ -6,6 +6,11 @@ from scipy.interpolate.interpnd import _ndim_coords_from_arrays
 NOTE: This code is a slightly modified version of scipy.interpolate.RegularGridInterpolator
 
 It does not enforce a cast of the value grid to floats32
+Coordinates, distances and weights are computed in 'coord_dtype' (float32
+by default) and linear interpolation accumulates in the value dtype (or
+'coord_dtype' for integer values), so a float32 volume is interpolated
+without float64 temporaries. Nearest interpolation returns values of the
+native value dtype.
 """
 
 
@@ -41,6 +46,13 @@ class RegularGridInterpolator(object):
         interpolation domain. If None, values outside
         the domain are extrapolated.
 
+    dtype : numpy dtype, optional
+        The data type that fill_value is cast to.
+
+    coord_dtype : numpy floating dtype, optional
+        The data type used for the grid, the sample coordinates and the
+        interpolation weights. Default is np.float32.
+
     Methods
     -------
     __call__
@@ -109,7 +121,7 @@ class RegularGridInterpolator(object):
     # see https://github.com/JohannesBuchner/regulargrid
 
     def __init__(self, points, values, method="linear", bounds_error=True,
-                 fill_value=np.nan, dtype=np.float32):
+                 fill_value=np.nan, dtype=np.float32, coord_dtype=np.float32):
         if method not in ["linear", "nearest", "kNN"]:
             raise ValueError("Method '%s' is not defined" % method)
         self.method = method
@@ -146,45 +158,82 @@ class RegularGridInterpolator(object):
             if not values.shape[i] == len(p):
                 raise ValueError("There are %d points and %d values in "
                                  "dimension %d" % (len(p), values.shape[i], i))
-        self.grid = tuple([np.asarray(p) for p in points])
+        self.coord_dtype = np.dtype(coord_dtype)
+        self.grid = tuple([np.asarray(p, dtype=self.coord_dtype)
+                           for p in points])
         self.values = values
 
-    def __call__(self, xi, method=None):
+        # Linear interpolation accumulates in the value dtype if floating
+        if np.issubdtype(values.dtype, np.floating):
+            self.out_dtype = values.dtype
+        else:
+            self.out_dtype = self.coord_dtype
+
+    def __call__(self, xi, method=None, check_bounds=True):
         """
         Interpolation at coordinates
 
         Parameters
         ----------
-        xi : ndarray of shape (..., ndim)
-            The coordinates to sample the gridded data at
+        xi : ndarray of shape (..., ndim) or tuple of ndim ndarrays
+            The coordinates to sample the gridded data at. A tuple of
+            equally shaped coordinate arrays (mgrid format) is used as-is
+            without stacking the coordinates into an array of points.
 
         method : str
             The method of interpolation to perform. Supported are "linear" and
             "nearest".
 
+        check_bounds : bool
+            If False, all points of xi are assumed to be inside the grid (as
+            determined by the caller) and no out of bounds test is performed.
+
         """
         method = self.method if method is None else method
         if method not in ["linear", "nearest", "kNN"]:
             raise ValueError("Method '%s' is not defined" % method)
 
         ndim = len(self.grid)
-        xi = _ndim_coords_from_arrays(xi, ndim=ndim)
-        if xi.shape[-1] != len(self.grid):
-            raise ValueError("The requested sample points xi have dimension "
-                             "%d, but this RegularGridInterpolator has "
-                             "dimension %d" % (xi.shape[1], ndim))
-
-        xi_shape = xi.shape
-        xi = xi.reshape(-1, xi_shape[-1])
+        if isinstance(xi, (tuple, list)) and len(xi) == ndim and \
+                all(np.shape(x) == np.shape(xi[0]) for x in xi):
+            # Coordinate arrays, keep them separate and in coord_dtype
+            xi_shape = np.shape(xi[0]) + (ndim,)
+            xi = [np.asarray(x, dtype=self.coord_dtype).ravel() for x in xi]
+        else:
+            xi = _ndim_coords_from_arrays(xi, ndim=ndim)
+            if xi.shape[-1] != len(self.grid):
+                raise ValueError("The requested sample points xi have "
+                                 "dimension %d, but this "
+                                 "RegularGridInterpolator has dimension %d"
+                                 % (xi.shape[1], ndim))
+            xi_shape = xi.shape
+            xi = xi.reshape(-1, xi_shape[-1]).T.astype(self.coord_dtype)
 
         if self.bounds_error:
-            for i, p in enumerate(xi.T):
+            for i, p in enumerate(xi):
                 if not np.logical_and(np.all(self.grid[i][0] <= p),
                                       np.all(p <= self.grid[i][-1])):
                     raise ValueError("One of the requested xi is out of bounds "
                                      "in dimension %d" % i)
 
-        indices, norm_distances, out_of_bounds = self._find_indices(xi.T)
+        # Points outside the grid are set to fill_value directly, only points
+        # inside the grid are interpolated
+        out_shape = xi_shape[:-1] + self.values.shape[ndim:]
+        out_of_bounds = None
+        if check_bounds and not self.bounds_error and \
+                self.fill_value is not None:
+            out_of_bounds = self._find_out_of_bounds(xi)
+            n_out = np.count_nonzero(out_of_bounds)
+            if n_out == 0:
+                out_of_bounds = None
+            elif n_out == len(out_of_bounds) and method != "kNN":
+                dtype = self.out_dtype if method == "linear" \
+                    else self.values.dtype
+                return np.full(out_shape, self.fill_value, dtype=dtype)
+            elif method != "kNN":
+                xi = [x[~out_of_bounds] for x in xi]
+
+        indices, norm_distances = self._find_indices(xi)
         if method == "linear":
             result = self._evaluate_linear(indices,
                                            norm_distances,
@@ -195,25 +244,36 @@ class RegularGridInterpolator(object):
                                             out_of_bounds)
         elif method == "kNN":
             result = self._evaluate_NN(indices, norm_distances)
-
-        if not self.bounds_error and self.fill_value is not None:
+            if out_of_bounds is not None:
+                result[out_of_bounds] = self.fill_value
+            out_of_bounds = None
+
+        if out_of_bounds is not None:
+            # Scatter the interpolated points between the fill values
+            inside = result
+            result = np.empty((len(out_of_bounds),) + inside.shape[1:],
+                              dtype=inside.dtype)
             result[out_of_bounds] = self.fill_value
+            result[~out_of_bounds] = inside
 
-        return result.reshape(xi_shape[:-1] + self.values.shape[ndim:])
+        return result.reshape(out_shape)
 
     def _evaluate_linear(self, indices, norm_distances, out_of_bounds):
         # slice for broadcasting over trailing dimensions in self.values
         vslice = (slice(None),) + (None,)*(self.values.ndim - len(indices))
 
         # find relevant values
-        # each i and i+1 represents a edge
-        edges = itertools.product(*[[i, i + 1] for i in indices])
-        values = 0.
-        for edge_indices in edges:
-            weight = 1.
-            for ei, i, yi in zip(edge_indices, indices, norm_distances):
-                weight *= np.where(ei == i, 1 - yi, yi)
-            values += np.asarray(self.values[edge_indices]) * weight[vslice]
+        # each i and i+1 represents a edge, weighted by 1-yi and yi resp.
+        edges = itertools.product(*[[(i, 1 - yi), (i + 1, yi)]
+                                    for i, yi in zip(indices, norm_distances)])
+        values = np.zeros(indices[0].shape + self.values.shape[len(indices):],
+                          dtype=self.out_dtype)
+        for edge in edges:
+            edge_indices, weights = zip(*edge)
+            weight = weights[0]
+            for w in weights[1:]:
+                weight = weight * w
+            values += self.values[edge_indices] * weight[vslice]
         return values
 
     def _evaluate_nearest(self, indices, norm_distances, out_of_bounds):
@@ -249,22 +309,24 @@ class RegularGridInterpolator(object):
         votes /= np.sum(votes, axis=-1)[:, np.newaxis]
         return votes
 
+    def _find_out_of_bounds(self, xi):
+        # check for out of bounds xi
+        out_of_bounds = np.zeros((len(xi[0])), dtype=bool)
+        for x, grid in zip(xi, self.grid):
+            out_of_bounds |= x < grid[0]
+            out_of_bounds |= x > grid[-1]
+        return out_of_bounds
+
     def _find_indices(self, xi):
         # find relevant edges between which xi are situated
         indices = []
         # compute distance to lower edge in unity units
         norm_distances = []
-        # check for out of bounds xi
-        out_of_bounds = np.zeros((xi.shape[1]), dtype=bool)
         # iterate through dimensions
         for x, grid in zip(xi, self.grid):
             i = np.searchsorted(grid, x) - 1
-            i[i < 0] = 0
-            i[i > grid.size - 2] = grid.size - 2
+            np.clip(i, 0, grid.size - 2, out=i)
             indices.append(i)
             norm_distances.append((x - grid[i]) /
                                   (grid[i + 1] - grid[i]))
-            if not self.bounds_error:
-                out_of_bounds += x < grid[0]
-                out_of_bounds += x > grid[-1]
-        return indices, norm_distances, out_of_bounds
+        return indices, norm_distances
@@ -1,9 +1,9 @@
 import nibabel as nib
 import numpy as np
 import numpy.linalg as npl
-import random
 from MultiPlanarUNet.interpolation.linalg import mgrid_to_points, points_to_mgrid
 from MultiPlanarUNet.interpolation.linalg import get_rotation_matrix
+from MultiPlanarUNet.utils.rng import get_rng
 
 
 def get_pix_dim(nii_image):
@@ -42,6 +42,19 @@ def get_maximum_real_dim_in_folder(folder):
     return np.max(sizes)
 
 
+def get_real_space_corners(shape, affine):
+    """
+    Returns the 8 corner voxel positions of a volume of voxel shape 'shape' in
+    the real space frame of 'affine', centered on the volume center (the
+    frame in which planes and boxes are sampled)
+    """
+    from itertools import product
+    shape = np.asarray(shape[:3])
+    corners = np.array(list(product(*[(0, n - 1) for n in shape])),
+                       dtype=np.float64)
+    return (corners - (shape - 1) / 2).dot(affine[:3, :3].T)
+
+
 def get_voxel_grid(images, as_points=False):
     shape = images.shape[:3]
     grid = np.mgrid[0:shape[0]:1,
@@ -79,9 +92,9 @@ def get_voxel_axes_real_space(image, affine, return_basis=False):
         rot_mat = None
 
     # Get grid in real space
-    g_xx = g_xx * transform[0, 0]
-    g_yy = g_yy * transform[1, 1]
-    g_zz = g_zz * transform[2, 2]
+    g_xx = (g_xx * transform[0, 0]).astype(np.float32)
+    g_yy = (g_yy * transform[1, 1]).astype(np.float32)
+    g_zz = (g_zz * transform[2, 2]).astype(np.float32)
 
     if return_basis:
         return (g_xx, g_yy, g_zz), transform, rot_mat
@@ -97,6 +110,19 @@ def get_voxel_axes(image):
     return g_xx, g_yy, g_zz
 
 
+def get_voxel_real_space_affine(images):
+    """
+    Returns the 4x4 affine mapping the voxel indices of 'images' to the
+    centered real space coordinates of get_voxel_grid_real_space, without
+    computing the grid
+    """
+    shape = np.asarray(images.shape[:3])
+    vox_to_real_affine = np.eye(4)
+    vox_to_real_affine[:3, :3] = images.affine[:3, :3]
+    vox_to_real_affine[:3, 3] = -images.affine[:3, :3].dot((shape - 1) / 2)
+    return vox_to_real_affine
+
+
 def get_voxel_grid_real_space(images, append_ones=False):
     # Get shape excluding channels
     shape = images.shape[:-1]
@@ -129,10 +155,13 @@ def get_voxel_grid_real_space(images, append_ones=False):
     return points
 
 
-def get_random_views(N, dim=3, norm=np.random.normal, pos_z=True, weights=None):
+def get_random_views(N, dim=3, norm=None, pos_z=True, weights=None, rng=None):
     """
     http://en.wikipedia.org/wiki/N-sphere#Generating_random_points
+
+    'norm' defaults to the normal distribution of 'rng' (see utils.rng.get_rng)
     """
+    norm = norm or get_rng(rng).normal
     normal_deviates = norm(size=(N, dim))
     radius = np.linalg.norm(normal_deviates, axis=1)[:, np.newaxis]
     views = normal_deviates / radius
@@ -174,31 +203,33 @@ def sample_random_views_with_angle_restriction(views, min_angle_deg,
 
 def sample_plane(norm_vector, sample_dim, real_space_span,
                  real_space_sample_sphere_radius, noise_sd=0.,
-                 return_real_space_grid=False):
+                 return_real_space_grid=False, rng=None):
     # Sample a random displacement
     # Get random displacement within sample sphere
-    rd = np.random.randint(-real_space_sample_sphere_radius,
-                           real_space_sample_sphere_radius, 1)[0]
+    rng = get_rng(rng)
+    rd = rng.integers(-real_space_sample_sphere_radius,
+                      real_space_sample_sphere_radius)
 
     return sample_plane_at(norm_vector=norm_vector,
                            sample_dim=sample_dim,
                            real_space_span=real_space_span,
                            offset_from_center=rd,
                            noise_sd=noise_sd,
-                           test_mode=return_real_space_grid)
+                           test_mode=return_real_space_grid,
+                           rng=rng)
 
 
-def sample_plane_at(norm_vector, sample_dim, real_space_span,
-                    offset_from_center, noise_sd, test_mode=False):
+def get_plane_normal(norm_vector, noise):
+    """
+    Returns the unit normal of a plane sampled with sample_plane_at along view
+    'norm_vector' with noise vector 'noise' added
+    """
     # Prepare normal vector to the plane
     n_hat = np.array(norm_vector, np.float32)
     n_hat /= np.linalg.norm(n_hat)
 
-    # Add noise?
-    if type(noise_sd) is not np.ndarray:
-        noise_sd = np.random.normal(scale=noise_sd, size=3)
-
-    n_hat += noise_sd
+    # Add noise
+    n_hat += noise
     n_hat /= np.linalg.norm(n_hat)
 
     if np.all(n_hat[:-1] < 0.2):
@@ -206,6 +237,18 @@ def sample_plane_at(norm_vector, sample_dim, real_space_span,
         # orientation. We force the first two components to go into the
         # positive direction to control variability of sampling
         n_hat[:-1] = np.abs(n_hat[:-1])
+    return n_hat
+
+
+def sample_plane_at(norm_vector, sample_dim, real_space_span,
+                    offset_from_center, noise_sd, test_mode=False, rng=None):
+    # Add noise?
+    if type(noise_sd) is not np.ndarray:
+        noise_sd = get_rng(rng).normal(scale=noise_sd, size=3)
+
+    # Prepare normal vector to the plane
+    n_hat = get_plane_normal(norm_vector, noise_sd)
+
     if np.all(np.isclose(n_hat[:-1], 0)):
         u = np.array([1, 0, 0])
         v = np.array([0, 1, 0])
@@ -229,12 +272,12 @@ def sample_plane_at(norm_vector, sample_dim, real_space_span,
     j = complex(sample_dim)
     grid = np.mgrid[-hd:hd:j,
                     -hd:hd:j,
-                    offset_from_center:offset_from_center:1j]
+                    offset_from_center:offset_from_center:1j].astype(np.float32)
 
     # Calculate voxel coordinates on the real space grid
     points = mgrid_to_points(grid)
 
-    real_points = basis.dot(points.T).T
+    real_points = basis.astype(np.float32).dot(points.T).T
     real_grid = points_to_mgrid(real_points, grid.shape[1:])
 
     if test_mode:
@@ -243,7 +286,46 @@ def sample_plane_at(norm_vector, sample_dim, real_space_span,
         return real_grid
 
 
-def sample_box(sample_dim, real_box_dim, real_dims, noise_sd=0., test_mode=False):
+def displace_grid(mgrid, fields):
+    """
+    Displace the points of the sampling grid 'mgrid' (of shape [3, *shape],
+    as returned by sample_plane_at or sample_box_at) by 'fields' given in
+    units of the grid steps. Sampling the image at the displaced grid equals
+    resampling the sample at grid indices i + fields(i), i.e. applying an
+    elastic deformation (see augmentation.elastic_deformation) to the
+    sample, with a single interpolation from the image.
+
+    Args:
+        mgrid:  ndarray of shape [3, *shape], an affine grid of real space
+                points
+        fields: List of displacement fields, one for each grid axis of size
+                > 1, each of shape 'shape' with the size 1 axes removed
+
+    Returns:
+        The displaced grid, ndarray of shape [3, *shape]
+    """
+    shape = mgrid[0].shape
+    moving = [i for i, n in enumerate(shape) if n > 1]
+    if len(fields) != len(moving):
+        raise ValueError("Got %i displacement fields for a grid with %i "
+                         "non-singleton axes" % (len(fields), len(moving)))
+    origin = np.array([m[(0,) * len(shape)] for m in mgrid])
+    displaced = np.array(mgrid, dtype=np.float32, copy=True)
+    for axis, field in zip(moving, fields):
+        # Real space step vector along the grid axis
+        end = [0] * len(shape)
+        end[axis] = shape[axis] - 1
+        step = (np.array([m[tuple(end)] for m in mgrid]) - origin) / end[axis]
+        field = np.reshape(field, shape)
+        for d in range(3):
+            if step[d]:
+                displaced[d] += field * np.float32(step[d])
+    return displaced
+
+
+def sample_box(sample_dim, real_box_dim, real_dims, noise_sd=0.,
+               test_mode=False, rng=None):
+    rng = get_rng(rng)
 
     # Set sample space equal to real_dims or expanded to 1.1x sample box dim
     # 1.1x to give a little room around the image for sampling
@@ -252,33 +334,35 @@ def sample_box(sample_dim, real_box_dim, real_dims, noise_sd=0., test_mode=False
     # Sample a random displacement
     # Get random displacement within sample space, center on origin
     d = (sample_space - real_box_dim)
-    placement = np.array([random.uniform(0, d[i]) for i in range(3)]) - sample_space/2
+    placement = rng.uniform(0, d) - sample_space/2
 
     return sample_box_at(real_placement=placement,
                          sample_dim=sample_dim,
                          real_box_dim=real_box_dim,
                          noise_sd=noise_sd,
-                         test_mode=test_mode)
+                         test_mode=test_mode,
+                         rng=rng)
 
 
 def sample_box_at(real_placement, sample_dim, real_box_dim,
-                  noise_sd, test_mode):
+                  noise_sd, test_mode, rng=None):
 
     j = complex(sample_dim)
     a, b, c = real_placement
     grid = np.mgrid[a:a + real_box_dim:j,
                     b:b + real_box_dim:j,
-                    c:c + real_box_dim:j]
+                    c:c + real_box_dim:j].astype(np.float32)
 
     rot_mat = np.eye(3)
     rot_grid = grid
     if noise_sd:
         # Get random rotation vector
-        rot_axis = get_random_views(N=1, dim=3, pos_z=True)
+        rng = get_rng(rng)
+        rot_axis = get_random_views(N=1, dim=3, pos_z=True, rng=rng)
 
         rot_angle = False
         while not rot_angle:
-            angle = np.abs(np.random.normal(scale=noise_sd, size=1)[0])
+            angle = np.abs(rng.normal(scale=noise_sd))
             if angle < 2*np.pi:
                 rot_angle = angle
 
@@ -288,7 +372,7 @@ def sample_box_at(real_placement, sample_dim, real_box_dim,
         points = mgrid_to_points(grid)
         center = np.mean(points, axis=0)
         points -= center
-        points = rot_mat.dot(points.T).T + center
+        points = rot_mat.astype(np.float32).dot(points.T).T + center
         rot_grid = points_to_mgrid(points, grid.shape[1:])
 
     if test_mode:
@@ -1,8 +1,10 @@
+import itertools
 import numpy as np
 from MultiPlanarUNet.interpolation.regular_grid_interpolator import RegularGridInterpolator
 from MultiPlanarUNet.logging import ScreenLogger
 from MultiPlanarUNet.interpolation.linalg import points_to_mgrid, mgrid_to_points
 from MultiPlanarUNet.interpolation.sample_grid import get_voxel_axes_real_space
+from MultiPlanarUNet.interpolation.label_preview import LabelPreview
 
 
 def is_rot_mat(mat):
@@ -14,9 +16,60 @@ def is_rot_mat(mat):
     return is_ortho and is_unimodular
 
 
+def _take(values, inds, axis):
+    """
+    Take 'inds' along 'axis' of 'values'. Arithmetic progressions of indices
+    are served as (strided) views, other index arrays through np.take.
+    """
+    if len(inds) > 1:
+        step = inds[1] - inds[0]
+        if step != 0 and np.all(np.diff(inds) == step):
+            stop = inds[-1] + (1 if step > 0 else -1)
+            sl = [slice(None)] * values.ndim
+            sl[axis] = slice(inds[0], stop if stop >= 0 else None, step)
+            return values[tuple(sl)]
+    return np.take(values, inds, axis=axis)
+
+
+def _resample_axis(values, positions, axis, method, tol):
+    """
+    Resample 'values' along 'axis' at the continuous voxel index 'positions'
+    using linear or nearest interpolation. Reproduces the indexing rules of
+    RegularGridInterpolator (positions are clipped into the volume, out of
+    bounds positions are handled by the caller).
+    """
+    n = values.shape[axis]
+    inds = np.clip(np.floor(positions).astype(np.int64), 0, n - 2)
+    dists = np.clip(positions - inds, 0., 1.)
+    if method == "nearest" or np.all(np.abs(dists - np.round(dists)) < tol):
+        # Positions (nearly) on voxel centers, no weighting needed
+        if method == "nearest":
+            inds = np.where(dists <= .5, inds, inds + 1)
+        else:
+            inds = inds + np.round(dists).astype(np.int64)
+        return _take(values, inds, axis)
+    low = _take(values, inds, axis)
+    high = _take(values, inds + 1, axis)
+    shape = [1] * values.ndim
+    shape[axis] = len(positions)
+    dists = dists.reshape(shape).astype(np.float32)
+    return low + (high - low) * dists
+
+
+def _to_out(values, out):
+    """
+    Write 'values' into the preallocated array 'out' (if not None) and return
+    it, otherwise return 'values'
+    """
+    if out is None:
+        return values
+    np.copyto(out, values.reshape(out.shape), casting="unsafe")
+    return out
+
+
 class ViewInterpolator(object):
     def __init__(self, image, labels, affine,
-                 bg_value=0, bg_class=0, logger=None):
+                 bg_value=0, bg_class=0, logger=None, axis_aligned_tol=1e-3):
 
         # Ensure 4D
         if not image.ndim == 4:
@@ -35,12 +88,22 @@ class ViewInterpolator(object):
         # Store potential transformation to regular grid
         self.rot_mat = None
 
+        # Maximum deviation (in voxels) from an axis-aligned, voxel-spaced
+        # sampling for which interpolation is replaced by array slicing
+        # Set to None to disable the axis-aligned fast path
+        self.axis_aligned_tol = axis_aligned_tol
+        self.bg_value = bg_value
+        self.bg_class = bg_class
+
+        # Coarse label map used by preview_labels, see set_label_preview
+        self.label_preview = None
+
         # Define interpolators
-        self.im_intrps, self.lab_intrp = self._init_interpolators(image,
-                                                                  labels,
-                                                                  bg_value,
-                                                                  bg_class,
-                                                                  affine)
+        self.im_intrp, self.lab_intrp = self._init_interpolators(image,
+                                                                 labels,
+                                                                 bg_value,
+                                                                 bg_class,
+                                                                 affine)
 
     def apply_rotation(self, mgrid):
         if self.rot_mat is not None:
@@ -50,44 +113,296 @@ class ViewInterpolator(object):
         else:
             return mgrid
 
+    def get_axis_aligned_plan(self, mgrid, apply_rot=True):
+        """
+        Check if the sampling grid 'mgrid' runs along the voxel axes of the
+        image, i.e. if each grid axis is parallel to one voxel axis (within
+        self.axis_aligned_tol voxels over the extent of the grid). This is the
+        case for e.g. views parallel to an image axis.
+
+        Returns:
+            None if the grid is not axis-aligned, otherwise a list of
+            (voxel axis, continuous voxel index positions) tuples, one for
+            each grid axis in order.
+        """
+        if self.axis_aligned_tol is None or \
+                np.any(np.asarray(self.im_shape[:3]) < 2):
+            return None
+        if apply_rot:
+            mgrid = self.apply_rotation(mgrid)
+        shape = mgrid[0].shape
+        if len(shape) != 3:
+            return None
+
+        def corner(inds):
+            return np.array([m[inds] for m in mgrid], dtype=np.float64)
+
+        # Continuous voxel index of the grid origin and steps along grid axes
+        origin = (corner((0, 0, 0)) - self.grid_origin) / self.grid_spacing
+        plan, used_axes = [], []
+        for i, n in enumerate(shape):
+            inds = [0, 0, 0]
+            inds[i] = n - 1
+            end = (corner(tuple(inds)) - self.grid_origin) / self.grid_spacing
+            span = end - origin
+            if n > 1:
+                vox_axis = int(np.argmax(np.abs(span)))
+                off_axis = np.delete(np.abs(span), vox_axis)
+                if np.any(off_axis > self.axis_aligned_tol) or \
+                        vox_axis in used_axes:
+                    return None
+                step = span[vox_axis] / (n - 1)
+                positions = origin[vox_axis] + step * np.arange(n)
+            else:
+                vox_axis = None
+                positions = None
+            plan.append([vox_axis, positions])
+            used_axes.append(vox_axis)
+
+        # Assign remaining (constant) voxel axes to grid axes of size 1
+        free_axes = [a for a in range(3) if a not in used_axes]
+        for p in plan:
+            if p[0] is None:
+                p[0] = free_axes.pop(0)
+                p[1] = origin[p[0]:p[0]+1]
+        return [tuple(p) for p in plan]
+
+    def _intrp_axis_aligned(self, values, plan, method, fill_value):
+        """
+        Sample 'values' at the positions described by an axis-aligned plan
+        (see get_axis_aligned_plan) by slicing/resampling along each axis.
+        """
+        tol = self.axis_aligned_tol
+        n_vox = values.shape[:3]
+
+        # Out of bounds positions along each voxel axis
+        out_of_bounds = {}
+        for vox_axis, positions in plan:
+            out_of_bounds[vox_axis] = (positions < -tol) | \
+                                      (positions > n_vox[vox_axis] - 1 + tol)
+
+        # Resample the axes sampled fewest times first
+        order = sorted(plan, key=lambda p: len(p[1]))
+        for vox_axis, positions in order:
+            if np.all(out_of_bounds[vox_axis]):
+                # Plane does not intersect the volume
+                shape = tuple(len(p[1]) for p in plan) + values.shape[3:]
+                return np.full(shape, fill_value, dtype=values.dtype)
+            values = _resample_axis(values, positions, vox_axis, method, tol)
+
+        # Order axes as the grid axes
+        values = np.transpose(values, [p[0] for p in plan] +
+                              list(range(3, values.ndim)))
+        values = np.require(values, requirements=["C", "O", "W"])
+        for i, (vox_axis, _) in enumerate(plan):
+            mask = out_of_bounds[vox_axis]
+            if np.any(mask):
+                sl = [slice(None)] * values.ndim
+                sl[i] = mask
+                values[tuple(sl)] = fill_value
+        return values
+
+    def get_bounds_state(self, mgrid, apply_rot=True):
+        """
+        Determine analytically whether the sampling grid 'mgrid' lies fully
+        inside or fully outside of the image volume. The grid is an affine
+        map of its indices, so the coordinate extremes are found at the grid
+        corners.
+
+        Returns:
+            A tuple of booleans (all_inside, all_outside). Both are False if
+            the grid (possibly) intersects the volume boundary.
+        """
+        if apply_rot:
+            mgrid = self.apply_rotation(mgrid)
+        corners = itertools.product(*[(0, n - 1) for n in mgrid[0].shape])
+        corners = np.array([[m[c] for m in mgrid] for c in corners])
+        low, high = corners.min(axis=0), corners.max(axis=0)
+
+        # Small margin, points exactly on the border are considered inside
+        # by the interpolators
+        margin = 1e-4 * self.grid_spacing
+        all_inside = np.all(low >= self.grid_bounds[0] + margin) and \
+                     np.all(high <= self.grid_bounds[1] - margin)
+        all_outside = np.any(high < self.grid_bounds[0] - margin) or \
+                      np.any(low > self.grid_bounds[1] + margin)
+        return bool(all_inside), bool(all_outside)
+
+    def set_label_preview(self, factor):
+        """
+        Build a coarse class presence map of the labels (see
+        MultiPlanarUNet.interpolation.label_preview) with blocks of 'factor'
+        voxels, enabling preview_labels. Pass factor=None to disable.
+        """
+        if factor and self.labels is not None:
+            self.label_preview = LabelPreview(self.labels, factor)
+        else:
+            self.label_preview = None
+
+    def preview_labels(self, mgrid, apply_rot=True):
+        """
+        Cheaply determine which classes the labels interpolated at 'mgrid' can
+        possibly contain by looking up a sub-sampled grid in the coarse label
+        preview. The grid is sub-sampled such that all points of 'mgrid' are
+        within the look-up distance of the preview.
+
+        Returns:
+            None if no label preview is set, otherwise an ndarray of classes,
+            a superset of the classes returned by intrp_labels(mgrid)
+        """
+        if self.label_preview is None:
+            return None
+        rot_mat = self.rot_mat if apply_rot else None
+
+        # Absolute step vectors along the grid axes in voxel units
+        # Computed from the grid corners, the grid is sub-sampled before
+        # applying any rotation
+        shape = mgrid[0].shape
+
+        def point(inds):
+            p = np.array([m[inds] for m in mgrid], dtype=np.float64)
+            return rot_mat.dot(p) if rot_mat is not None else p
+
+        origin = point((0,) * len(shape))
+        steps = np.zeros((len(shape), 3))
+        for i, n in enumerate(shape):
+            if n > 1:
+                inds = [0] * len(shape)
+                inds[i] = n - 1
+                end = point(tuple(inds))
+                steps[i] = np.abs((end - origin) / (n - 1) / self.grid_spacing)
+
+        # Sub-sample grid axis i with stride c/L_i (L_i the largest step
+        # component), such that every grid point is within the look-up
+        # distance of a sub-sampled point along all voxel axes:
+        # sum_i (stride_i/2) * steps[i, a] <= max_distance for each axis a
+        lengths = steps.max(axis=1)
+        moving = lengths > 0
+        c = 2 * self.label_preview.max_distance / \
+            max(np.max(np.sum(steps[moving] / lengths[moving, None], axis=0)), 1)
+        inds = []
+        for n, length in zip(shape, lengths):
+            stride = max(1, int(c / length)) if length > 0 else n
+            ax_inds = np.arange(0, n, stride)
+            if ax_inds[-1] != n - 1:
+                ax_inds = np.append(ax_inds, n - 1)
+            inds.append(ax_inds)
+        inds = np.ix_(*inds)
+        sub_grid = tuple(m[inds] for m in mgrid)
+        if rot_mat is not None:
+            sub_grid = self.apply_rotation(sub_grid)
+
+        # The sub-grid includes the grid corners and so has the same bounds
+        all_inside, all_outside = self.get_bounds_state(sub_grid,
+                                                        apply_rot=False)
+        if all_outside:
+            return np.array([self.bg_class])
+        points = [(m - o) / s for m, o, s in zip(sub_grid,
+                                                 self.grid_origin,
+                                                 self.grid_spacing)]
+        classes = self.label_preview.classes_at(points)
+        if not all_inside and self.bg_class not in classes:
+            # Points outside the volume are assigned the bg class
+            classes = np.append(classes, self.bg_class)
+        return classes
+
     def __call__(self, rgrid_mgrid):
         # Align grid if necessary
         rgrid_mgrid = self.apply_rotation(rgrid_mgrid)
 
         # Interpolate image and labels
-        image = self.intrp_image(rgrid_mgrid, apply_rot=False)
-        labels = self.intrp_labels(rgrid_mgrid, apply_rot=False)
+        bounds = self.get_bounds_state(rgrid_mgrid, apply_rot=False)
+        plan = self.get_axis_aligned_plan(rgrid_mgrid, apply_rot=False)
+        image = self.intrp_image(rgrid_mgrid, apply_rot=False,
+                                 plan=plan, bounds=bounds)
+        labels = self.intrp_labels(rgrid_mgrid, apply_rot=False,
+                                   plan=plan, bounds=bounds)
 
         return image, labels
 
-    def intrp_image(self, mgrid, apply_rot=True):
+    def intrp_image(self, mgrid, apply_rot=True, plan=False, bounds=None,
+                    out=None):
+        """
+        Interpolate the image at 'mgrid'. If 'out' is passed, the result is
+        written into it (it must hold mgrid[0].squeeze().shape + (n_channels,)
+        elements) and 'out' is returned.
+        """
         if apply_rot:
             mgrid = self.apply_rotation(mgrid)
+        if bounds is None:
+            bounds = self.get_bounds_state(mgrid, apply_rot=False)
+        all_inside, all_outside = bounds
+        if all_outside:
+            # Grid does not intersect the volume
+            if out is not None:
+                out[...] = self.bg_value
+                return out
+            return np.full(mgrid[0].squeeze().shape + (self.n_channels,),
+                           self.bg_value, dtype=self.im_dtype)
+        if plan is False:
+            plan = self.get_axis_aligned_plan(mgrid, apply_rot=False)
+
+        if plan is not None:
+            # Grid is aligned with the voxel axes, slice the image instead
+            image = self._intrp_axis_aligned(self.image, plan,
+                                             method="linear",
+                                             fill_value=self.bg_value)
+            if out is not None:
+                return _to_out(image, out)
+            return image.reshape(mgrid[0].squeeze().shape +
+                                 (self.n_channels,)).astype(self.im_dtype,
+                                                            copy=False)
 
         if not isinstance(mgrid, tuple):
             # RegularGridInterpolator expects this tuple(xx, yy, zz) format
             mgrid = tuple(mgrid)
 
-        # Interpolate image along all channels
-        image = np.zeros(shape=mgrid[0].squeeze().shape + (self.n_channels,),
-                         dtype=self.im_dtype)
+        # Interpolate image along all channels at once, only points inside
+        # the volume are interpolated
+        image = self.im_intrp(mgrid, check_bounds=not all_inside)
+        if out is not None:
+            return _to_out(image, out)
+        return image.reshape(mgrid[0].squeeze().shape +
+                             (self.n_channels,)).astype(self.im_dtype,
+                                                        copy=False)
 
-        for i in range(self.n_channels):
-            image[..., i] = self.im_intrps[i](mgrid).squeeze()
-
-        return image
-
-    def intrp_labels(self, mgrid, apply_rot=True):
+    def intrp_labels(self, mgrid, apply_rot=True, plan=False, bounds=None,
+                     out=None):
+        """
+        Interpolate the labels at 'mgrid' (nearest). If 'out' is passed, the
+        result is written into it and 'out' is returned.
+        """
         if apply_rot:
             mgrid = self.apply_rotation(mgrid)
 
         # Interpolate labels
         if self.lab_intrp:
+            if bounds is None:
+                bounds = self.get_bounds_state(mgrid, apply_rot=False)
+            all_inside, all_outside = bounds
+            if all_outside:
+                # Grid does not intersect the volume
+                if out is not None:
+                    out[...] = self.bg_class
+                    return out
+                return np.full(mgrid[0].squeeze().shape, self.bg_class,
+                               dtype=self.labels.dtype)
+            if plan is False:
+                plan = self.get_axis_aligned_plan(mgrid, apply_rot=False)
+            if plan is not None:
+                # Grid is aligned with the voxel axes, slice the labels instead
+                labels = self._intrp_axis_aligned(self.labels, plan,
+                                                  method="nearest",
+                                                  fill_value=self.bg_class)
+                return _to_out(labels.squeeze(), out)
+
             if not isinstance(mgrid, tuple):
                 # RegularGridInterpolator expects tuple(xx, yy, zz) format
                 mgrid = tuple(mgrid)
 
-            return self._cast_labels(self.lab_intrp(mgrid).squeeze())
+            # Nearest interpolation returns labels of the stored label dtype
+            labels = self.lab_intrp(mgrid, check_bounds=not all_inside)
+            return _to_out(labels.squeeze(), out)
         else:
             return None
 
@@ -98,7 +413,9 @@ class ViewInterpolator(object):
                                                           return_basis=True)
         g_all = list(g_all)
 
-        # Set rotation matrix
+        # Set rotation matrix, float32 to keep rotated grids float32
+        if rot_mat is not None:
+            rot_mat = rot_mat.astype(np.float32)
         self.rot_mat = rot_mat
 
         # Flip axes? Must be strictly increasing
@@ -112,34 +429,31 @@ class ViewInterpolator(object):
                     labels = np.flip(labels, i)
         g_xx, g_yy, g_zz = g_all
 
-        # Set interpolator for image, one for each channel
-        im_intrps = []
-        for i in range(self.n_channels):
-            im_intrps.append(RegularGridInterpolator((g_xx, g_yy, g_zz),
-                                                     image[..., i].squeeze(),
-                                                     bounds_error=False,
-                                                     fill_value=bg_value,
-                                                     method="linear",
-                                                     dtype=np.float32))
+        # Store (flipped) arrays and grid geometry for axis-aligned sampling
+        self.image = image
+        self.labels = labels
+        self.grid_origin = np.array([g[0] for g in g_all], dtype=np.float64)
+        self.grid_spacing = np.array([(g[1] - g[0]) if len(g) > 1 else 1.
+                                      for g in g_all], dtype=np.float64)
+        self.grid_bounds = np.array([[g[0] for g in g_all],
+                                     [g[-1] for g in g_all]], dtype=np.float64)
+
+        # Set interpolator for image, shared across all channels so that
+        # grid indices and weights are computed once per call
+        im_intrp = RegularGridInterpolator((g_xx, g_yy, g_zz), image,
+                                           bounds_error=False,
+                                           fill_value=bg_value,
+                                           method="linear",
+                                           dtype=np.float32)
 
         try:
-            # Set interpolator for labels
+            # Set interpolator for labels, fill value of the label dtype
             lab_intrp = RegularGridInterpolator((g_xx, g_yy, g_zz), labels,
                                                 bounds_error=False,
                                                 fill_value=bg_class,
                                                 method="nearest",
-                                                dtype=np.uint8)
+                                                dtype=labels.dtype)
         except (AttributeError, TypeError, ValueError):
             lab_intrp = None
 
-        return im_intrps, lab_intrp
-
-    def _cast_labels(self, labels):
-        # Cast labels float64 -> uint8/16
-        type_info = np.iinfo(np.uint8)
-        l = type_info.min
-        u = type_info.max
-        if np.all((labels >= l) & (labels <= u)):
-            return labels.astype(np.uint8)
-        else:
-            return labels.astype(np.uint16)
+        return im_intrp, lab_intrp
@@ -71,6 +71,17 @@ class FusionModel(Model):
 
         return [inputs], [fusion]
 
+    def get_fusion_weights(self):
+        """
+        Returns the per-view, per-class weights [n_inputs, n_classes], the
+        per-class biases [n_classes] and the activation ('softmax' or None)
+        of the fusion layer, see utils.fusion.StreamingFusion
+        """
+        layer = self.layers[-1]
+        W, b = layer.get_weights()
+        activation = "softmax" if layer.activation is tf.nn.softmax else None
+        return W, b.reshape(-1), activation
+
     def _log(self):
         self.logger("Optimizer:  %s" % self.optimizer)
         self.logger("Loss:       %s" % self.loss)
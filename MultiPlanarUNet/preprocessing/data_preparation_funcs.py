@@ -267,7 +267,14 @@ def prepare_for_multi_task_2d(hparams, just_one=False, no_val=False, logger=None
     # Create the training and validation sequencers
     # These will produce batches shared across the N tasks
     from MultiPlanarUNet.sequences import MultiTaskSequence
-    train = MultiTaskSequence(train_seqs, hparams["build"]["task_names"])
-    val = MultiTaskSequence(val_seqs, hparams["build"]["task_names"])
+    fit = hparams["fit"]
+    train = MultiTaskSequence(train_seqs, hparams["build"]["task_names"],
+                              logger=logger,
+                              n_threads=fit.get("task_threads"),
+                              prefetch=fit.get("task_prefetch"),
+                              report_every=fit.get("task_report_every"))
+    val = MultiTaskSequence(val_seqs, hparams["build"]["task_names"],
+                            logger=logger,
+                            n_threads=fit.get("task_threads"))
 
     return train, val, hparams
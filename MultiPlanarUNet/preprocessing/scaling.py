@@ -45,14 +45,57 @@ class MultiChannelScaler(object):
         self.scalers = scalers
         return self
 
-    def transform(self, X, *args, **kwargs):
+    @property
+    def is_affine(self):
+        """
+        Returns:
+            True if the channel scalers are affine transformations
+            (x * scale + offset), which may be applied in-place
+        """
+        return issubclass(self.scaler_class, (preprocessing.RobustScaler,
+                                              preprocessing.StandardScaler,
+                                              preprocessing.MinMaxScaler,
+                                              preprocessing.MaxAbsScaler))
+
+    def get_affine_params(self):
+        """
+        Returns:
+            Per channel scale and offset ndarrays of shape [n_channels] of
+            affine channel scalers
+        """
+        points = np.array([[0.], [1.]])
+        offsets = np.array([s.transform(points)[0, 0] for s in self.scalers])
+        scales = np.array([s.transform(points)[1, 0] for s in self.scalers])
+        return scales - offsets, offsets
+
+    def transform(self, X, *args, in_place=False, **kwargs):
+        """
+        Transform each channel of X with its fitted scaler
+
+        Args:
+            X:        ndarray of any shape with n_channels along the last axis
+            in_place: Write the result into X (X must be of a floating dtype).
+                      Affine scalers are then applied without temporary
+                      copies of X.
+
+        Returns:
+            The transformed ndarray (X if in_place=True)
+        """
         if X.shape[-1] != self.n_channels:
             raise ValueError("Invalid input of dimension %i, expected "
                              "last axis with %i channels" % (X.ndim,
                                                              self.n_channels))
 
+        if in_place and self.is_affine and not args and not kwargs:
+            scales, offsets = self.get_affine_params()
+            for i in range(self.n_channels):
+                channel = X[..., i]
+                channel *= scales[i]
+                channel += offsets[i]
+            return X
+
         # Prepare volume like X to store results
-        transformed = np.empty_like(X)
+        transformed = X if in_place else np.empty_like(X)
         for i in range(self.n_channels):
             scl = self.scalers[i]
             s = scl.transform(X[..., i].reshape(-1, 1), *args, **kwargs)
@@ -4,3 +4,6 @@ from .sliding_patch_sequence_3d import SlidingPatchSequence3D
 from .isotrophic_live_view_sequence_2d import IsotrophicLiveViewSequence2D
 from .isotrophic_live_view_sequence_3d import IsotrophicLiveViewSequence3D
 from .multi_class_sequence import MultiTaskSequence
+from .batch_producer import SharedBatchProducer
+from .plane_bank import PlaneBank, PlaneBankSequence2D
+from .validation_cache import ValidationCache
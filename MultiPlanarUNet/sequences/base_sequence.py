@@ -1,16 +1,29 @@
 from tensorflow.keras.utils import Sequence
 from multiprocessing import current_process
+from MultiPlanarUNet.utils.rng import get_batch_rng, new_seed
 import numpy as np
+import random
 
 
 class BaseSequence(Sequence):
-    def __init__(self):
+    def __init__(self, seed=None):
+        """
+        Args:
+            seed: Integer global seed of the random streams of the batches,
+                  see get_rng. A random seed is drawn if None.
+        """
         super().__init__()
 
         # A dictionary mapping process names to whether the process has been
         # seeded
         self.is_seeded = {}
 
+        # Each batch is sampled from its own np.random.Generator derived from
+        # (base_seed, epoch, batch index, worker_id), see get_rng
+        self.base_seed = new_seed() if seed is None else int(seed)
+        self.epoch = 0
+        self.worker_id = 0
+
     def seed(self):
         # If multiprocessing the processes will inherit the RNG state of the
         # main process - here we reseed each process once so that the batches
@@ -20,4 +33,32 @@ class BaseSequence(Sequence):
             # Re-seed this process
             # If threading this will just re-seed MainProcess
             np.random.seed()
+            random.seed()
             self.is_seeded[pname] = True
+
+    def get_rng(self, idx, epoch=None, worker_id=None, stream=0):
+        """
+        Returns the np.random.Generator from which batch 'idx' is sampled.
+
+        The batch is a function of its key (base_seed, epoch, idx, worker_id)
+        only (given the same images, see ImagePairLoader.get_random), so it
+        may be regenerated with:
+            sequence.epoch, sequence.worker_id = epoch, worker_id
+            sequence[idx]
+
+        Args:
+            idx:       The batch index
+            epoch:     The epoch, defaults to self.epoch
+            worker_id: The id of the producing worker, defaults to
+                       self.worker_id
+            stream:    See utils.rng.get_batch_rng
+
+        Returns:
+            A np.random.Generator
+        """
+        epoch = self.epoch if epoch is None else epoch
+        worker_id = self.worker_id if worker_id is None else worker_id
+        return get_batch_rng(self.base_seed, epoch, idx, worker_id, stream)
+
+    def on_epoch_end(self):
+        self.epoch += 1
@@ -0,0 +1,297 @@
+"""
+Production of training batches in worker processes writing into a ring of
+preallocated shared memory buffers.
+
+The workers are forked from the training process and thus share all volumes
+already loaded by the ImagePairLoader (and its ImageQueue) with it
+copy-on-write, without pickling. Finished batches are written into shared
+buffers from which the training loop reads them without un-pickling.
+
+The trainer (see train.Trainer) consumes the batches through fit_generator,
+which prefetches an unbounded number of batches, and thus uses copy=True:
+each batch is copied once out of its buffer. With copy=False the batches are
+yielded without copying, which is only safe for consumers holding at most
+n_held batches at a time, i.e. prefetching fewer than n_held batches (see
+SharedBatchProducer).
+"""
+
+import multiprocessing as mp
+import queue
+import numpy as np
+from MultiPlanarUNet.logging import ScreenLogger
+from MultiPlanarUNet.sequences.sampling_stats import get_sampling_stats
+
+
+def _flatten(batch):
+    """
+    Flatten a (possibly nested) tuple/list structure of ndarrays to a list of
+    ndarrays and a structure description for use with _unflatten
+    """
+    if isinstance(batch, (tuple, list)):
+        arrays, structure = [], []
+        for item in batch:
+            item_arrays, item_structure = _flatten(item)
+            structure.append((len(arrays), item_structure))
+            arrays.extend(item_arrays)
+        return arrays, (type(batch), structure)
+    else:
+        return [np.asarray(batch)], None
+
+
+def _unflatten(arrays, structure):
+    """
+    Inverse of _flatten
+    """
+    if structure is None:
+        return arrays[0]
+    seq_type, items = structure
+    return seq_type(_unflatten(arrays[start:], item_structure)
+                    for start, item_structure in items)
+
+
+def _restart_image_queues(sequence):
+    """
+    Threads are not inherited by forked processes. Restart the populating
+    threads of the ImageQueue(s) (if any) of the ImagePairLoader(s) of
+    'sequence' in the current process.
+    """
+    loaders = getattr(sequence, "image_pair_loader", [])
+    if not isinstance(loaders, (list, tuple)):
+        loaders = [loaders]
+    for loader in loaders:
+        if getattr(loader, "queue", None):
+            loader.queue.restart_after_fork()
+
+
+def _produce(sequence, worker_id, buffers, free, ready, stop_event):
+    """
+    Worker process target function. Repeatedly takes a free buffer slot,
+    produces a batch from 'sequence' and writes it to the slot.
+
+    The batches of worker 'worker_id' are indexed 0, 1, ... from each
+    (re)start and the worker id is set on the sequence, so that each batch
+    has a unique key (see BaseSequence.get_rng) as long as the epoch of the
+    sequence is incremented between restarts (see BatchProducerRefresh).
+
+    The sampling stats of each batch (see sampling_stats.SamplingStats) and
+    its key (epoch, idx, worker_id) are sent along with its slot.
+    """
+    try:
+        _restart_image_queues(sequence)
+        if hasattr(sequence, "worker_id"):
+            sequence.worker_id = worker_id
+        stats = get_sampling_stats(sequence)
+        for s in stats:
+            s.reset()
+        idx = 0
+        while not stop_event.is_set():
+            try:
+                slot = free.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if slot is None:
+                break
+            arrays, _ = _flatten(sequence[idx % len(sequence)])
+            if len(arrays) != len(buffers[slot]):
+                raise ValueError("Sequence returned %i arrays, expected %i"
+                                 % (len(arrays), len(buffers[slot])))
+            for src, dst in zip(arrays, buffers[slot]):
+                if src.shape != dst.shape:
+                    raise ValueError("Sequence returned array of shape %s, "
+                                     "expected %s" % (src.shape, dst.shape))
+                np.copyto(dst, src, casting="same_kind")
+            key = (getattr(sequence, "epoch", None), idx % len(sequence),
+                   worker_id)
+            ready.put((slot, [s.pop_state() for s in stats], key))
+            idx += 1
+    except Exception:
+        import traceback
+        ready.put(traceback.format_exc())
+
+
+class SharedBatchProducer(object):
+    """
+    Iterator over batches of a MultiPlanarUNet.sequence object, produced by
+    a pool of forked worker processes.
+
+    Each batch is written into one of 'n_buffers' preallocated slots of
+    shared memory. The iterator yields the batches as ndarray views of the
+    slots (with the same (possibly nested) structure as returned by the
+    sequence). The slots of the 'n_held' most recently yielded batches are
+    held back from the workers, i.e. a yielded batch stays valid until
+    n_held more batches have been requested. Consumers that keep references
+    to batches for longer (e.g. by prefetching them or by wrapping them in
+    tensors without copying) must pass an n_held of at least their prefetch
+    depth + 1, or copy=True to yield copies of the batches instead.
+
+    The batch shapes and dtypes are determined from a single batch produced
+    in the main process at initialization; integer arrays (e.g. sparse
+    labels, which may have different dtypes across images) are stored as
+    int32.
+
+    Attributes of the sequence changed in the main process (e.g. by the
+    FGBatchBalancer callback) only propagate to the workers on restart, which
+    should be called at the end of each epoch (see BatchProducerRefresh).
+    """
+    def __init__(self, sequence, n_workers, n_buffers=None, n_held=1,
+                 copy=False, logger=None):
+        """
+        Args:
+            sequence:  A MultiPlanarUNet.sequence object
+            n_workers: Number of worker processes
+            n_buffers: Number of shared memory batch slots, defaults to
+                       2 * n_workers + n_held
+            n_held:    Number of most recently yielded batches whose slots
+                       are held back from the workers
+            copy:      Yield copies of the batches, their slots are handed
+                       back to the workers immediately
+            logger:    A MultiPlanarUNet logger object
+        """
+        self.sequence = sequence
+        self.n_workers = max(int(n_workers), 1)
+        self.n_held = 0 if copy else int(n_held)
+        self.copy = bool(copy)
+        self.n_buffers = int(n_buffers or 2 * self.n_workers + self.n_held)
+        self.logger = logger or ScreenLogger()
+        if not self.copy and self.n_held < 1:
+            raise ValueError("n_held must be at least 1, got %i"
+                             % self.n_held)
+        if self.n_buffers < self.n_held + 1:
+            raise ValueError("Need at least n_held + 1 = %i batch buffers, "
+                             "got %i" % (self.n_held + 1, self.n_buffers))
+
+        # Workers are forked so that loaded volumes are shared, not pickled
+        self.ctx = mp.get_context("fork")
+
+        # Allocate the shared buffers from a probe batch
+        arrays, self.structure = _flatten(sequence[0])
+        self.specs = []
+        for a in arrays:
+            dtype = np.int32 if np.issubdtype(a.dtype, np.integer) else a.dtype
+            self.specs.append((a.shape, np.dtype(dtype)))
+        self.buffers = []
+        for _ in range(self.n_buffers):
+            slot = []
+            for shape, dtype in self.specs:
+                n_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+                raw = self.ctx.RawArray("B", n_bytes)
+                slot.append(np.frombuffer(raw, dtype=dtype,
+                                          count=int(np.prod(shape))).reshape(shape))
+            self.buffers.append(slot)
+
+        # Slots currently handed out to the consumer, oldest first, and the
+        # key (epoch, idx, worker_id) of the last batch (see _produce)
+        self._held = []
+        self.last_key = None
+        self.workers = []
+        self.free = None
+        self.ready = None
+        self.stop_event = None
+        self.log()
+
+    def log(self):
+        n_bytes = sum(int(np.prod(s)) * d.itemsize for s, d in self.specs)
+        self.logger("Batch producer: %i workers, %i shared buffers "
+                    "of %.2f MB, %s" % (self.n_workers, self.n_buffers,
+                                        n_bytes / 1024 ** 2,
+                                        "yielding copies" if self.copy else
+                                        "%i held" % self.n_held))
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __iter__(self):
+        """
+        Returns a generator over the batches, Keras (tf 1.x) fit_generator
+        only accepts generator objects and keras.utils.Sequence objects
+        """
+        while True:
+            yield next(self)
+
+    @property
+    def is_running(self):
+        return bool(self.workers)
+
+    def start(self):
+        """
+        Fork the worker processes and hand them all slots not currently held
+        by the consumer
+        """
+        if self.is_running:
+            return
+        self.free = self.ctx.Queue()
+        self.ready = self.ctx.Queue()
+        self.stop_event = self.ctx.Event()
+        for slot in range(self.n_buffers):
+            if slot not in self._held:
+                self.free.put(slot)
+        for i in range(self.n_workers):
+            # Worker ids start at 1, 0 is the main process
+            p = self.ctx.Process(target=_produce,
+                                 name="BatchProducer-%i" % i,
+                                 args=(self.sequence, i + 1, self.buffers,
+                                       self.free, self.ready, self.stop_event),
+                                 daemon=True)
+            p.start()
+            self.workers.append(p)
+
+    def stop(self, timeout=5):
+        """
+        Stop and join the worker processes. Batches produced but not yet
+        consumed are discarded.
+        """
+        if not self.is_running:
+            return
+        self.stop_event.set()
+        for _ in self.workers:
+            self.free.put(None)
+        for p in self.workers:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self.workers = []
+
+    def restart(self):
+        """
+        Restart the workers, propagating the current state of the sequence
+        """
+        self.stop()
+        self.start()
+
+    def __next__(self):
+        if not self.is_running:
+            self.start()
+
+        # Hand back the slots of batches older than the n_held last ones,
+        # making room for the slot of this batch
+        while self._held and len(self._held) >= self.n_held:
+            self.free.put(self._held.pop(0))
+
+        # Wait for a finished batch
+        while True:
+            try:
+                item = self.ready.get(timeout=1)
+                break
+            except queue.Empty:
+                if not any(p.is_alive() for p in self.workers):
+                    raise RuntimeError("All batch producer workers died")
+        if isinstance(item, str):
+            # A worker failed, item is its traceback
+            self.stop()
+            raise RuntimeError("Batch producer worker failed:\n%s" % item)
+        slot, states, self.last_key = item
+        for stats, state in zip(get_sampling_stats(self.sequence), states):
+            stats.merge(state)
+        if self.copy:
+            batch = [a.copy() for a in self.buffers[slot]]
+            self.free.put(slot)
+            return _unflatten(batch, self.structure)
+        self._held.append(slot)
+        return _unflatten(self.buffers[slot], self.structure)
+
+    def __del__(self):
+        try:
+            self.stop(timeout=1)
+        except Exception:
+            pass
@@ -1,8 +1,13 @@
 from MultiPlanarUNet.sequences import BaseSequence
 from MultiPlanarUNet.utils import get_class_weights as gcw
 from MultiPlanarUNet.logging import ScreenLogger
-from MultiPlanarUNet.preprocessing import reshape_add_axis, one_hot_encode_y
+from MultiPlanarUNet.utils.rng import get_rng
+from MultiPlanarUNet.sequences.sampling_stats import SamplingStats
+from MultiPlanarUNet.augmentation.pipeline import AugmentationPipeline
+from multiprocessing import current_process
 import numpy as np
+import threading
+import time
 
 
 class IsotrophicLiveViewSequence(BaseSequence):
@@ -10,8 +15,9 @@ class IsotrophicLiveViewSequence(BaseSequence):
                  real_space_span=None, noise_sd=0., force_all_fg="auto",
                  fg_batch_fraction=0.50, label_crop=None, logger=None,
                  is_validation=False, list_of_augmenters=None, sparse=True,
-                 **kwargs):
-        super().__init__()
+                 use_fg_index=True, buffer_slots=None, seed=None,
+                 elastic_on_grid=True, **kwargs):
+        super().__init__(seed=seed)
 
         # Validation or training batch generator?
         self.is_validation = is_validation
@@ -32,15 +38,41 @@ class IsotrophicLiveViewSequence(BaseSequence):
         # Do not augment validation data
         self.list_of_augmenters = list_of_augmenters if not self.is_validation else None
 
+        # Augmenters deforming the sampling grids (see deform_grid) instead
+        # of the sampled batch, e.g. Elastic2D/Elastic3D if elastic_on_grid
+        self.grid_augmenters = []
+        if elastic_on_grid and self.list_of_augmenters:
+            self.grid_augmenters = [a for a in self.list_of_augmenters
+                                    if hasattr(a, "deform_grid")]
+            self.list_of_augmenters = [a for a in self.list_of_augmenters
+                                       if not hasattr(a, "deform_grid")]
+
+        # The remaining augmenters are applied in order to the batch buffers
+        # in place, see augment
+        self.augmentation = AugmentationPipeline(self.list_of_augmenters)
+
         # Batch creation options
         self.batch_size = batch_size
         self.n_classes = n_classes
         self.sparse = sparse
 
+        # Samples are written directly into batch output buffers. With
+        # buffer_slots set, each worker (process and thread) cycles through
+        # that many preallocated sets of buffers, so a returned batch is only
+        # valid until the worker has produced buffer_slots more batches.
+        # Only set if batches are consumed (copied) before then, otherwise
+        # new buffers are allocated for each batch. See get_batch_buffers.
+        self.buffer_slots = buffer_slots
+        self._buffer_pools = {}
+
         # Minimum fraction of slices in each batch with FG
         self.force_all_fg_switch = force_all_fg
         self.fg_batch_fraction = fg_batch_fraction
 
+        # Place FG samples directly on indexed FG voxels (see
+        # ImagePair.fg_index) instead of relying on rejection sampling
+        self.use_fg_index = use_fg_index
+
         # Store labels?
         self.store_y = False
         self.stored_y = []
@@ -53,6 +85,18 @@ class IsotrophicLiveViewSequence(BaseSequence):
         # Set potential label label_crop
         self.label_crop = np.array([[0, 0], [0, 0]]) if label_crop is None else label_crop
 
+        # Counters for candidates tested on the coarse label preview
+        # See reject_on_preview
+        self.preview_stats = {"tested": 0, "rejected": 0, "preview_time": 0.,
+                              "n_labels": 0, "label_time": 0.}
+        self.preview_log_every = 2500
+
+        # Tries, rejections and stage timings of the sampled batches
+        # See MultiPlanarUNet.sequences.sampling_stats
+        self.sampling_stats = SamplingStats(
+            extra_stages=self.augmentation.stages
+        )
+
     def __len__(self):
         raise NotImplemented
 
@@ -73,6 +117,58 @@ class IsotrophicLiveViewSequence(BaseSequence):
             raise ValueError("Invalid batch size of %i" % value)
         self._batch_size = value
 
+    @property
+    def label_dtype(self):
+        return np.uint8 if self.n_classes <= 256 else np.int32
+
+    @property
+    def sample_shape(self):
+        """ Spatial shape of a single sample (plane or box) """
+        return tuple(self.batch_shape[1:-1])
+
+    @property
+    def n_channels(self):
+        return self.images[0].n_channels
+
+    def _get_buffer_pool(self):
+        key = (current_process().name, threading.get_ident())
+        if key not in self._buffer_pools:
+            self._buffer_pools[key] = {"slots": [{} for _ in
+                                                 range(self.buffer_slots)],
+                                       "current": -1}
+        return self._buffer_pools[key]
+
+    def _get_buffer(self, name, shape, dtype):
+        """
+        Returns the buffer 'name' of the current slot of this worker,
+        allocated on first use or if shape or dtype changed. Returns a new
+        array if buffer_slots is not set.
+        """
+        if not self.buffer_slots:
+            return np.empty(shape, dtype=dtype)
+        pool = self._get_buffer_pool()
+        slot = pool["slots"][pool["current"]]
+        buf = slot.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            slot[name] = buf
+        return buf
+
+    def get_batch_buffers(self):
+        """
+        Returns image, label and weight output arrays of shapes
+        [batch_size, *sample_shape, n_channels], [batch_size, *sample_shape]
+        and [batch_size] for the next batch, taken from the next slot of this
+        worker if buffer_slots is set (see __init__).
+        """
+        if self.buffer_slots:
+            pool = self._get_buffer_pool()
+            pool["current"] = (pool["current"] + 1) % len(pool["slots"])
+        shape = (self.batch_size,) + self.sample_shape
+        return (self._get_buffer("x", shape + (self.n_channels,), np.float32),
+                self._get_buffer("y", shape, self.label_dtype),
+                self._get_buffer("w", (self.batch_size,), np.float32))
+
     @property
     def n_fg_slices(self):
         return int(np.ceil(self.batch_size * self.fg_batch_fraction))
@@ -145,35 +241,192 @@ class IsotrophicLiveViewSequence(BaseSequence):
             # minimum requirement. Discard the slice and sample again.
             return False, 0
 
+    def select_fg_target(self, image, has_fg, has_fg_vec, cur_batch_size,
+                         rng=None):
+        """
+        Decide whether the next sample should be placed on a foreground voxel
+        of 'image' and if so, select the voxel from the image's foreground
+        index. A FG sample is requested with probability (number of FG samples
+        still needed)/(number of samples left in the batch), so the
+        n_fg_slices and force_all_fg requirements are met without relying on
+        rejection sampling. Classes not yet in the batch are preferred if
+        force_all_fg is set.
+
+        Args:
+            image:          The ImagePair to sample from
+            has_fg:         Number of samples with FG in the batch so far
+            has_fg_vec:     Vector of FG classes found in the batch so far
+            cur_batch_size: Number of samples currently in the batch
+            rng:            Optional np.random.Generator, see BaseSequence.get_rng
+
+        Returns:
+            None or a tuple of voxel index, real space point and class, see
+            ForegroundIndex.sample
+        """
+        if not self.use_fg_index or image.predict_mode:
+            return None
+        remaining = self.batch_size - cur_batch_size
+        n_needed = max(self.n_fg_slices - has_fg, 0)
+        missing = None
+        if self.force_all_fg:
+            missing = np.asarray(self.fg_classes)[np.asarray(has_fg_vec) == 0]
+            n_needed = max(n_needed, len(missing))
+        rng = get_rng(rng)
+        if remaining <= 0 or rng.random() >= n_needed / remaining:
+            return None
+        return image.fg_index.sample(missing if missing is not None
+                                     and len(missing) else None, rng=rng)
+
+    def deform_grid(self, mgrid, rng=None):
+        """
+        Apply the grid augmenters (see __init__) to the sampling grid of a
+        single sample
+
+        Returns:
+            The (possibly) deformed grid, the keyword arguments with which to
+            interpolate at the grid (see ViewInterpolator.intrp_image, empty
+            if not deformed) and the sample weight of the deformed sample
+            (None if not deformed or to keep the sample weight of the image)
+        """
+        deformed, weight = False, None
+        for aug in self.grid_augmenters:
+            mgrid, aug_deformed = aug.deform_grid(mgrid, rng=rng)
+            if aug_deformed:
+                deformed = True
+                if aug.weight is not None:
+                    weight = aug.weight
+        if not deformed:
+            return mgrid, {}, None
+
+        # The deformed grid is no longer affine, its bounds can not be
+        # determined from its corners and it is never axis-aligned
+        return mgrid, {"plan": None, "bounds": (False, False)}, weight
+
+    def interpolate_labels(self, image, mgrid, out=None, **kwargs):
+        """
+        Interpolate the labels of 'image' at 'mgrid' (into 'out' if passed),
+        timing the interpolation if the image has a label preview (used to
+        estimate the time saved by the preview, see reject_on_preview)
+        """
+        if image.interpolator.label_preview is None:
+            return image.interpolator.intrp_labels(mgrid, out=out, **kwargs)
+        t0 = time.time()
+        lab = image.interpolator.intrp_labels(mgrid, out=out, **kwargs)
+        self.preview_stats["label_time"] += time.time() - t0
+        self.preview_stats["n_labels"] += 1
+        return lab
+
+    def reject_on_preview(self, image, mgrid, has_fg, has_fg_vec,
+                          cur_batch_size, check_vec, check_fg):
+        """
+        Test a candidate grid on the coarse label preview of 'image' (if set,
+        see ImagePair.prepare_for_iso_live). The preview returns a superset of
+        the classes of the full resolution labels, so a candidate rejected on
+        the preview would also be rejected by validate_lab_vec/validate_lab.
+
+        Args:
+            image:          The ImagePair to sample from
+            mgrid:          The candidate sampling grid, must be affine (i.e.
+                            not deformed by the grid augmenters, see
+                            ViewInterpolator.preview_labels)
+            has_fg:         See validate_lab
+            has_fg_vec:     See validate_lab_vec
+            cur_batch_size: Number of samples currently in the batch
+            check_vec:      Apply the validate_lab_vec test
+            check_fg:       Apply the validate_lab test
+
+        Returns:
+            None if the candidate may be accepted, otherwise "fg_vec" or "fg"
+            naming the test that rejected it
+        """
+        t0 = time.time()
+        classes = image.interpolator.preview_labels(mgrid)
+        if classes is None:
+            return None
+        rejected = None
+        if check_vec and not self.validate_lab_vec(classes, has_fg_vec,
+                                                   cur_batch_size)[0]:
+            rejected = "fg_vec"
+        elif check_fg and not self.validate_lab(classes, has_fg,
+                                                cur_batch_size)[0]:
+            rejected = "fg"
+
+        stats = self.preview_stats
+        stats["preview_time"] += time.time() - t0
+        stats["tested"] += 1
+        stats["rejected"] += int(rejected is not None)
+        if stats["tested"] % self.preview_log_every == 0:
+            self.log_preview_stats()
+        return rejected
+
+    def log_preview_stats(self):
+        """
+        Log the rejection rate of the label preview and an estimate of the
+        time saved (label interpolations avoided minus time spent on the
+        preview) in this process
+        """
+        stats = self.preview_stats
+        if not stats["tested"]:
+            return
+        mean_label_time = stats["label_time"] / max(stats["n_labels"], 1)
+        saved = stats["rejected"] * mean_label_time - stats["preview_time"]
+        self.logger("Label preview: %i/%i candidates rejected (%.1f%%), "
+                    "est. time saved: %.2f sec" % (
+            stats["rejected"], stats["tested"],
+            100 * stats["rejected"] / stats["tested"], saved
+        ))
+
+    def one_hot_encode(self, batch_y):
+        """
+        One-hot encode the sparse labels 'batch_y' into a uint8 buffer of the
+        current slot (see get_batch_buffers)
+        """
+        shape = batch_y.shape + (self.n_classes,)
+        out = self._get_buffer("y_one_hot", shape, np.uint8)
+        np.equal(batch_y[..., None], np.arange(self.n_classes), out=out,
+                 casting="unsafe")
+        return out
+
     def prepare_batches(self, batch_x, batch_y, batch_w):
+        # Batches are normally already arrays (see get_batch_buffers)
+        batch_x = np.asarray(batch_x)
+        batch_y = np.asarray(batch_y)
+
         # Crop labels if necessary
         if self.label_crop.sum() != 0:
             batch_y = self._crop_labels(batch_y)
 
-        # Reshape X (and one-hot encode y)
-        batch_x = np.asarray(batch_x)
-
+        # Add channel axis to sparse labels or one-hot encode if requested
         if self.n_classes > 1 and not self.sparse:
-            batch_y = one_hot_encode_y(batch_y, n_classes=self.n_classes)
+            batch_y = self.one_hot_encode(batch_y)
         else:
-            batch_y = np.asarray(batch_y)
             batch_y = batch_y.reshape(batch_y.shape + (1,))
 
         if self.store_y:
-            self.stored_y.append(batch_y)
+            # Buffers may be reused, store a copy
+            self.stored_y.append(np.array(batch_y) if self.buffer_slots
+                                 else batch_y)
 
         return batch_x, batch_y, np.asarray(batch_w)
 
-    def augment(self, batch_x, batch_y, batch_w, bg_values):
+    def augment(self, batch_x, batch_y, batch_w, bg_values, rng=None,
+                stats=None):
+        """
+        Apply the augmenters to the batch arrays in place, recording the time
+        spent in each augmenter in the BatchStats 'stats' if passed
+        """
         # Apply further augmentation?
-        if self.list_of_augmenters:
-            for aug in self.list_of_augmenters:
-                batch_x, batch_y, batch_w = aug(batch_x=batch_x,
-                                                batch_y=batch_y,
-                                                batch_w=batch_w,
-                                                bg_values=bg_values)
-
+        if self.augmentation:
+            batch_x, batch_y, batch_w = self.augmentation(batch_x, batch_y,
+                                                          batch_w, bg_values,
+                                                          rng=rng,
+                                                          stats=stats)
         return batch_x, batch_y, batch_w
 
     def scale(self, batch_x, scalers):
-        return [scaler.transform(im) for im, scaler in zip(batch_x, scalers)]
+        """
+        Normalize each sample of 'batch_x' in place with its scaler
+        """
+        for im, scaler in zip(batch_x, scalers):
+            scaler.transform(im, in_place=True)
+        return batch_x
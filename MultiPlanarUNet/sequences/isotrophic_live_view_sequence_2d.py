@@ -1,5 +1,6 @@
 from MultiPlanarUNet.sequences.isotrophic_live_view_sequence import IsotrophicLiveViewSequence
-from MultiPlanarUNet.interpolation.sample_grid import sample_plane_at, get_bounding_sphere_real_radius
+from MultiPlanarUNet.interpolation.sample_grid import sample_plane_at, get_plane_normal
+from MultiPlanarUNet.utils.rng import get_rng
 import numpy as np
 
 
@@ -8,6 +9,11 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
 
         super().__init__(image_pair_loader, **kwargs)
         self.views = views
+
+        # Stores per image the volume corners and per view offset intervals
+        # of planes intersecting the volume, see get_view_bounds
+        self._view_bounds = {}
+
         self.batch_shape = (self.batch_size, self.sample_dim, self.sample_dim,
                             self.n_classes)
 
@@ -25,18 +31,41 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
         self.logger("Force all FG:                %s" % self.force_all_fg)
         self.logger("Noise SD:                    %s" % self.noise_sd)
         self.logger("Augmenters:                  %s" % self.list_of_augmenters)
+        self.logger("Grid augmenters:             %s" % self.grid_augmenters)
 
     def __len__(self):
         n_samples = self.sample_dim * len(self.images) * len(self.views)
         return int(np.ceil(n_samples / self.batch_size))
 
+    def get_view_bounds(self, image):
+        """
+        Returns the real space corners of the volume of 'image' (see
+        ImageGeometry), the interval of offsets along each view
+        (without noise) for which a sampled plane intersects the volume and
+        the indices of the views for which this interval is non-empty.
+        Computed once per image.
+        """
+        if image.id not in self._view_bounds:
+            corners = image.geometry.corners
+            hd = self.real_space_span // 2
+            bounds = []
+            for view in self.views:
+                proj = corners.dot(get_plane_normal(view, 0.))
+                bounds.append([max(-hd, proj.min()), min(hd, proj.max())])
+            bounds = np.array(bounds)
+            valid_views = np.nonzero(bounds[:, 0] <= bounds[:, 1])[0]
+            if len(valid_views) == 0:
+                valid_views = np.arange(len(self.views))
+            self._view_bounds[image.id] = (corners, bounds, valid_views)
+        return self._view_bounds[image.id]
+
     def get_view_from(self, image_id, view, n_planes):
         image = [m for m in self.images if m.id == image_id][0]
 
         sample_res = self.real_space_span/(self.sample_dim-1)
         if n_planes == "by_radius":
             # Get sample sphere radius
-            bounds = get_bounding_sphere_real_radius(image)
+            bounds = image.geometry.bounding_radius
             n_planes = int(2 * bounds / sample_res)
         else:
             extra = 0
@@ -63,6 +92,14 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
                     "offset %.3f to %.3f..." % (n_planes, offsets[0],
                                                 offsets[-1]))
 
+        # Planes parallel to an image axis are sliced from the voxel array
+        # instead of interpolated (see ViewInterpolator.get_axis_aligned_plan)
+        grid = sample_plane_at(offset_from_center=offsets[0],
+                               **dict(kwargs, test_mode=False))
+        if image.interpolator.get_axis_aligned_plan(grid) is not None:
+            self.logger("View is aligned with the image axes, "
+                        "slicing planes instead of interpolating")
+
         # Prepare results arrays
         shape = (self.sample_dim, self.sample_dim, n_planes)
         Xs = np.empty(shape + (image.n_channels,), dtype=image.image.dtype)
@@ -112,19 +149,31 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
 
         return im, lab, real_axis, inv_basis
 
-    def __getitem__(self, idx):
+    def sample_planes(self, rng=None, stats=None):
         """
-        Used by keras.fit_generator to fetch mini-batches during training
+        Sample the planes of one (FG balanced) batch from random images,
+        without augmentation and normalization
+
+        Args:
+            rng:   Optional np.random.Generator, see BaseSequence.get_rng
+            stats: Optional BatchStats object recording the tries,
+                   rejections and stage timings of the batch
+
+        Returns:
+            Lists of images, labels, sample weights, scalers and background
+            values of the sampled planes
         """
-        # If multiprocessing, set unique seed for this particular process
-        self.seed()
+        rng = get_rng(rng)
+        stats = stats or self.sampling_stats.new_batch()
 
         # Store how many slices has fg so far
         has_fg = 0
         has_fg_vec = np.zeros_like(self.fg_classes)
 
         # Interpolate on a random index for each sample image to generate batch
-        batch_x, batch_y, batch_w = [], [], []
+        # Samples are written directly into the batch buffers at index n
+        batch_x, batch_y, batch_w = self.get_batch_buffers()
+        n = 0
 
         # Maximum number of sampling trails
         max_tries = self.batch_size * 15
@@ -136,44 +185,90 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
 
         scalers = []
         bg_values = []
-        for i, image in enumerate(self.image_pair_loader.get_random(N=N)):
+        images = self.image_pair_loader.get_random(N=N, rng=rng)
+        for i, image in enumerate(stats.timed_iter(images, "queue_wait")):
             tries = 0
             # Sample a batch from the image
-            while len(batch_x) < cuts[i]:
+            while n < cuts[i]:
                 tries += 1
+                stats.tries += 1
 
                 # Randomly sample a slice from a random image and random view
-                view = self.views[np.random.randint(0, len(self.views), 1)[0]]
+                # Only views along which planes can intersect the image
+                corners, _, valid_views = self.get_view_bounds(image)
+                view = self.views[valid_views[rng.integers(len(valid_views))]]
 
                 # Get sample sphere radius
                 sphere_r_real = self.real_space_span // 2
 
-                # Sample a position on the axis
-                rd = np.random.uniform(-sphere_r_real, sphere_r_real, 1)[0]
+                # Noise is drawn here to get the normal of the plane
+                noise = rng.normal(scale=self.noise_sd, size=3)
+                n_hat = get_plane_normal(view, noise)
+
+                target = self.select_fg_target(image, has_fg, has_fg_vec, n,
+                                               rng=rng)
+                if target is not None:
+                    # Offset the plane to pass through the selected FG voxel
+                    rd = target[1].dot(n_hat)
+                else:
+                    # Sample a position on the axis, within the offsets at
+                    # which the plane intersects the volume
+                    proj = corners.dot(n_hat)
+                    low = max(-sphere_r_real, proj.min())
+                    high = min(sphere_r_real, proj.max())
+                    if low > high:
+                        low, high = -sphere_r_real, sphere_r_real
+                    rd = rng.uniform(low, high)
 
                 # Get grid and interpolate
-                mgrid = sample_plane_at(view,
-                                        sample_dim=self.sample_dim,
-                                        real_space_span=self.real_space_span,
-                                        offset_from_center=rd,
-                                        noise_sd=self.noise_sd,
-                                        test_mode=False)
+                with stats.time("grid"):
+                    mgrid = sample_plane_at(
+                        view, sample_dim=self.sample_dim,
+                        real_space_span=self.real_space_span,
+                        offset_from_center=rd, noise_sd=noise,
+                        test_mode=False
+                    )
+
+                # Deform the grid with the grid augmenters (e.g. elastic
+                # deformations), the sample is then interpolated only once
+                with stats.time("augment"):
+                    mgrid, intrp_kw, aug_weight = self.deform_grid(mgrid, rng)
+
+                # Reject on the coarse label preview before interpolating
+                # the labels at full resolution. The preview is only valid
+                # for undeformed (affine) grids, deformed samples are tested
+                # on the full resolution labels only
+                rejected = not intrp_kw and self.reject_on_preview(
+                    image, mgrid, has_fg, has_fg_vec, n,
+                    check_vec=self.force_all_fg and tries < max_tries,
+                    check_fg=tries <= max_tries
+                )
+                if rejected:
+                    tries += int(rejected == "fg_vec")
+                    stats.reject("validate_lab_vec" if rejected == "fg_vec"
+                                 else "validate_lab")
+                    continue
 
                 # Get interpolated labels
-                lab = image.interpolator.intrp_labels(mgrid)
+                with stats.time("labels"):
+                    lab = self.interpolate_labels(image, mgrid,
+                                                  out=batch_y[n], **intrp_kw)
 
                 if self.force_all_fg and tries < max_tries:
-                    valid, has_fg_vec = self.validate_lab_vec(lab,
-                                                              has_fg_vec,
-                                                              len(batch_y))
+                    valid, has_fg_vec = self.validate_lab_vec(lab, has_fg_vec,
+                                                              n)
                     if not valid:
                         tries += 1
+                        stats.reject("validate_lab_vec")
                         continue
 
-                valid_lab, fg_change = self.validate_lab(lab, has_fg, len(batch_y), debug=False)
+                valid_lab, fg_change = self.validate_lab(lab, has_fg, n, debug=False)
                 if valid_lab or tries > max_tries:
                     # Get interpolated image
-                    im = image.interpolator.intrp_image(mgrid)
+                    with stats.time("image"):
+                        im = image.interpolator.intrp_image(mgrid,
+                                                            out=batch_x[n],
+                                                            **intrp_kw)
 
                     if tries > max_tries or self.is_valid_im(im, image.bg_value):
                         # Update foreground counter
@@ -186,22 +281,48 @@ class IsotrophicLiveViewSequence2D(IsotrophicLiveViewSequence):
                         # Save bg value if needed in potential augmenters
                         bg_values.append(image.bg_value)
 
-                        # Add to batches
-                        batch_x.append(im)
-                        batch_y.append(lab)
-                        batch_w.append(image.sample_weight)
+                        # Keep the sample at index n
+                        batch_w[n] = image.sample_weight if aug_weight is None \
+                            else aug_weight
+                        n += 1
+                    else:
+                        stats.reject("is_valid_im")
+                else:
+                    stats.reject("validate_lab")
+
+        return batch_x, batch_y, batch_w, scalers, bg_values
+
+    def __getitem__(self, idx):
+        """
+        Used by keras.fit_generator to fetch mini-batches during training
+        """
+        # If multiprocessing, set unique seed for this particular process
+        self.seed()
+
+        # All random numbers of the batch are drawn from its own generator
+        rng = self.get_rng(idx)
+        stats = self.sampling_stats.new_batch()
+
+        # Sample planes
+        sampled = self.sample_planes(rng, stats)
+        batch_x, batch_y, batch_w, scalers, bg_values = sampled
 
         # Apply augmentation if specified
-        batch_x, batch_y, batch_w = self.augment(batch_x, batch_y,
-                                                 batch_w, bg_values)
+        with stats.time("augment"):
+            batch_x, batch_y, batch_w = self.augment(batch_x, batch_y,
+                                                     batch_w, bg_values,
+                                                     rng=rng, stats=stats)
 
         # Normalize images
-        batch_x = self.scale(batch_x, scalers)
+        with stats.time("scale"):
+            batch_x = self.scale(batch_x, scalers)
 
         # Reshape, one-hot encode etc.
-        batch_x, batch_y, batch_w = self.prepare_batches(batch_x,
-                                                         batch_y,
-                                                         batch_w)
+        with stats.time("prepare"):
+            batch_x, batch_y, batch_w = self.prepare_batches(batch_x,
+                                                             batch_y,
+                                                             batch_w)
+        self.sampling_stats.add(stats)
 
         assert len(batch_x) == self.batch_size
         return batch_x, batch_y, batch_w
@@ -27,6 +27,7 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
         self.logger("N fg slices:                 %s" % self.n_fg_slices)
         self.logger("Batch size:                  %s" % self.batch_size)
         self.logger("Force all FG:                %s" % self.force_all_fg)
+        self.logger("Grid augmenters:             %s" % self.grid_augmenters)
 
     def __len__(self):
         """ Controlled in train.py """
@@ -47,7 +48,7 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
         return im, lab
 
     def get_base_patches_from(self, image, return_y=False, batch_size=1):
-        real_dims = image.real_shape
+        real_dims = image.geometry.real_shape
 
         # Calculate positions
         sample_space = np.asarray([max(i, self.real_box_dim) for i in real_dims])
@@ -79,7 +80,7 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
                 # Get grid and interpolate
                 grid, axes, inv_mat = sample_box(sample_dim=self.sample_dim,
                                                  real_box_dim=self.real_box_dim,
-                                                 real_dims=image.real_shape,
+                                                 real_dims=image.geometry.real_shape,
                                                  noise_sd=self.noise_sd,
                                                  test_mode=True)
 
@@ -99,12 +100,18 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
         # If multiprocessing, set unique seed for this particular process
         self.seed()
 
+        # All random numbers of the batch are drawn from its own generator
+        rng = self.get_rng(idx)
+        stats = self.sampling_stats.new_batch()
+
         # Store how many slices has fg so far
         has_fg = 0
         has_fg_vec = np.zeros_like(self.fg_classes)
 
         # Interpolate on a random index for each sample image to generate batch
-        batch_x, batch_y, batch_w = [], [], []
+        # Samples are written directly into the batch buffers at index n
+        batch_x, batch_y, batch_w = self.get_batch_buffers()
+        n = 0
 
         # Get a random image
         max_tries = self.batch_size * 15
@@ -116,31 +123,76 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
 
         scalers = []
         bg_values = []
-        for i, image in enumerate(self.image_pair_loader.get_random(N=N)):
+        images = self.image_pair_loader.get_random(N=N, rng=rng)
+        for i, image in enumerate(stats.timed_iter(images, "queue_wait")):
             tries = 0
             # Sample a batch from the image
-            while len(batch_x) < cuts[i]:
-                # Get grid and interpolate
-                mgrid = sample_box(sample_dim=self.sample_dim,
-                                   real_box_dim=self.real_box_dim,
-                                   real_dims=image.real_shape,
-                                   noise_sd=self.noise_sd)
+            while n < cuts[i]:
+                stats.tries += 1
+                target = self.select_fg_target(image, has_fg, has_fg_vec, n,
+                                               rng=rng)
+                with stats.time("grid"):
+                    if target is not None:
+                        # Place the box around the selected FG voxel with a
+                        # random shift of up to 1/4 box, which keeps the
+                        # voxel inside the box also after rotation about the
+                        # box center
+                        shift = rng.uniform(-0.25, 0.25, 3) * self.real_box_dim
+                        placement = target[1] - self.real_box_dim / 2 + shift
+                        mgrid = sample_box_at(real_placement=placement,
+                                              sample_dim=self.sample_dim,
+                                              real_box_dim=self.real_box_dim,
+                                              noise_sd=self.noise_sd,
+                                              test_mode=False,
+                                              rng=rng)
+                    else:
+                        # Get grid and interpolate
+                        mgrid = sample_box(sample_dim=self.sample_dim,
+                                           real_box_dim=self.real_box_dim,
+                                           real_dims=image.geometry.real_shape,
+                                           noise_sd=self.noise_sd,
+                                           rng=rng)
+
+                # Deform the grid with the grid augmenters (e.g. elastic
+                # deformations), the sample is then interpolated only once
+                with stats.time("augment"):
+                    mgrid, intrp_kw, aug_weight = self.deform_grid(mgrid, rng)
+
+                # Reject on the coarse label preview before interpolating
+                # the labels at full resolution. The preview is only valid
+                # for undeformed (affine) grids, deformed samples are tested
+                # on the full resolution labels only
+                rejected = not intrp_kw and self.reject_on_preview(
+                    image, mgrid, has_fg, has_fg_vec, n,
+                    check_vec=self.force_all_fg and tries < max_tries,
+                    check_fg=tries <= max_tries
+                )
+                if rejected:
+                    tries += int(rejected == "fg_vec")
+                    stats.reject("validate_lab_vec" if rejected == "fg_vec"
+                                 else "validate_lab")
+                    continue
 
                 # Get interpolated labels
-                lab = image.interpolator.intrp_labels(mgrid)
-                valid_lab, fg_change = self.validate_lab(lab, has_fg, len(batch_y))
+                with stats.time("labels"):
+                    lab = self.interpolate_labels(image, mgrid,
+                                                  out=batch_y[n], **intrp_kw)
+                valid_lab, fg_change = self.validate_lab(lab, has_fg, n)
 
                 if self.force_all_fg and tries < max_tries:
-                    valid, has_fg_vec = self.validate_lab_vec(lab,
-                                                              has_fg_vec,
-                                                              len(batch_y))
+                    valid, has_fg_vec = self.validate_lab_vec(lab, has_fg_vec,
+                                                              n)
                     if not valid:
                         tries += 1
+                        stats.reject("validate_lab_vec")
                         continue
 
                 if valid_lab or tries > max_tries:
                     # Get interpolated image
-                    im = image.interpolator.intrp_image(mgrid)
+                    with stats.time("image"):
+                        im = image.interpolator.intrp_image(mgrid,
+                                                            out=batch_x[n],
+                                                            **intrp_kw)
 
                     if tries > max_tries or self.is_valid_im(im, image.bg_value):
                         # Update foreground counter
@@ -153,22 +205,31 @@ class IsotrophicLiveViewSequence3D(IsotrophicLiveViewSequence):
                         # Save bg value if needed in potential augmenters
                         bg_values.append(image.bg_value)
 
-                        # Add to batches
-                        batch_x.append(im)
-                        batch_y.append(lab)
-                        batch_w.append(image.sample_weight)
+                        # Keep the sample at index n
+                        batch_w[n] = image.sample_weight if aug_weight is None \
+                            else aug_weight
+                        n += 1
+                    else:
+                        stats.reject("is_valid_im")
+                else:
+                    stats.reject("validate_lab")
 
         # Apply augmentation if specified
-        batch_x, batch_y, batch_w = self.augment(batch_x, batch_y,
-                                                 batch_w, bg_values)
+        with stats.time("augment"):
+            batch_x, batch_y, batch_w = self.augment(batch_x, batch_y,
+                                                     batch_w, bg_values,
+                                                     rng=rng, stats=stats)
 
         # Normalize images
-        batch_x = self.scale(batch_x, scalers)
+        with stats.time("scale"):
+            batch_x = self.scale(batch_x, scalers)
 
         # Reshape, one-hot encode etc.
-        batch_x, batch_y, batch_w = self.prepare_batches(batch_x,
-                                                         batch_y,
-                                                         batch_w)
+        with stats.time("prepare"):
+            batch_x, batch_y, batch_w = self.prepare_batches(batch_x,
+                                                             batch_y,
+                                                             batch_w)
+        self.sampling_stats.add(stats)
 
         assert len(batch_x) == self.batch_size
         return batch_x, batch_y, batch_w
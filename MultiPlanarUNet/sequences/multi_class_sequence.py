@@ -1,6 +1,86 @@
 from tensorflow.keras.utils import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
 from MultiPlanarUNet.logging import ScreenLogger
 import numpy as np
+import queue
+import time
+import os
+
+
+class _TaskPrefetcher(object):
+    """
+    Produces batches from a single task sequence in a background thread into
+    a queue of at most 'depth' batches. Batch k produced by the thread is
+    sequence[k].
+    """
+    def __init__(self, sequence, depth, stats):
+        self.sequence = sequence
+        self.queue = queue.Queue(maxsize=depth)
+        self.stats = stats
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        idx = 0
+        while not self.stop_event.is_set():
+            t0 = time.time()
+            try:
+                batch = self.sequence[idx]
+            except Exception as e:
+                batch = e
+            self.stats.add_sample(time.time() - t0)
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            idx += 1
+
+    def get(self):
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class _TaskStats(object):
+    """
+    Thread-safe counters of the sampling time of a task and of the time
+    spent waiting for its batches in MultiTaskSequence.__getitem__
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.n_sampled = 0
+        self.sample_time = 0.
+        self.max_sample_time = 0.
+        self.n_waited = 0
+        self.wait_time = 0.
+
+    def add_sample(self, t):
+        with self.lock:
+            self.n_sampled += 1
+            self.sample_time += t
+            self.max_sample_time = max(self.max_sample_time, t)
+
+    def add_wait(self, t):
+        with self.lock:
+            self.n_waited += 1
+            self.wait_time += t
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "n_batches": self.n_sampled,
+                "mean_sample_ms": 1000 * self.sample_time / max(self.n_sampled, 1),
+                "max_sample_ms": 1000 * self.max_sample_time,
+                "mean_wait_ms": 1000 * self.wait_time / max(self.n_waited, 1)
+            }
 
 
 class MultiTaskSequence(Sequence):
@@ -9,12 +89,52 @@ class MultiTaskSequence(Sequence):
     of them to create batches for each Sequence (typically different 'tasks')
     and returns three lists, stroing iamges, labels and weights, each of
     length equal to the number of wrapped Sequencers.
+
+    The task batches are fetched concurrently in a pool of threads. Tasks
+    with a prefetch depth > 0 are instead sampled continuously by a
+    background thread into a queue of that many batches, so that slow tasks
+    are sampled ahead of time. Prefetched task batches are produced with
+    their own running batch index (see BaseSequence.get_rng), independently
+    of the index passed to __getitem__.
+
+    Threads do not survive a fork, the pool and prefetch threads are created
+    lazily in each process that fetches batches.
     """
-    def __init__(self, sequencers, task_names, logger=None):
+    def __init__(self, sequencers, task_names, logger=None, n_threads=None,
+                 prefetch=None, report_every=None):
+        """
+        Args:
+            sequencers:   List of MultiPlanarUNet.sequence objects, one per task
+            task_names:   List of task names
+            logger:       A MultiPlanarUNet logger object
+            n_threads:    Number of threads fetching task batches concurrently,
+                          defaults to the number of tasks
+            prefetch:     Integer or list of integers, the number of batches
+                          prefetched for each task. 0 or None to disable.
+            report_every: Log the per-task latency report (see
+                          get_latency_report) every report_every batches
+                          (in each process), None to disable
+        """
         super().__init__()
         self.logger = logger or ScreenLogger()
         self.task_names = task_names
         self.sequencers = sequencers
+        self.n_threads = int(n_threads or len(sequencers))
+        if not isinstance(prefetch, (list, tuple)):
+            prefetch = [prefetch] * len(sequencers)
+        if len(prefetch) != len(sequencers):
+            raise ValueError("Got %i prefetch depths for %i tasks"
+                             % (len(prefetch), len(sequencers)))
+        self.prefetch = [int(p or 0) for p in prefetch]
+        self.report_every = report_every
+
+        # Per-process thread pool, prefetchers and stats, see _get_workers
+        self._pid = None
+        self._pool = None
+        self._prefetchers = None
+        self._stats = None
+        self._n_batches = 0
+        self._lock = Lock()
         self.log()
 
         # Redirect setattrs to the sub-sequencers
@@ -24,6 +144,8 @@ class MultiTaskSequence(Sequence):
         self.logger("--- MultiTaskSequence sequencer --- ",
                     print_calling_method=True)
         self.logger("N tasks:  %i" % len(self.sequencers))
+        self.logger("Threads:  %i" % self.n_threads)
+        self.logger("Prefetch: %s" % dict(zip(self.task_names, self.prefetch)))
 
     def __iter__(self):
         for s in self.sequencers:
@@ -55,12 +177,99 @@ class MultiTaskSequence(Sequence):
         """
         return sum([len(seq) for seq in self.sequencers])
 
+    def on_epoch_end(self):
+        for s in self:
+            s.on_epoch_end()
+
+    def _get_workers(self):
+        """
+        Returns the thread pool, prefetchers and stats of this process,
+        started on first use in each process
+        """
+        with self.__dict__["_lock"]:
+            if self.__dict__["_pid"] != os.getpid():
+                stats = [_TaskStats() for _ in self.sequencers]
+                prefetchers = []
+                for seq, depth, task_stats in zip(self.sequencers,
+                                                  self.prefetch, stats):
+                    if depth <= 0:
+                        prefetchers.append(None)
+                        continue
+                    # Pooled output buffers of the task sequence (if any) must
+                    # outlive the queued batches
+                    slots = getattr(seq, "buffer_slots", None)
+                    if slots:
+                        seq.buffer_slots = max(slots, depth + 2)
+                    prefetchers.append(_TaskPrefetcher(seq, depth, task_stats))
+                self.__dict__.update({
+                    "_pid": os.getpid(),
+                    "_pool": ThreadPoolExecutor(max_workers=self.n_threads),
+                    "_prefetchers": prefetchers,
+                    "_stats": stats,
+                    "_n_batches": 0
+                })
+        return (self.__dict__["_pool"], self.__dict__["_prefetchers"],
+                self.__dict__["_stats"])
+
     def __getitem__(self, index):
+        pool, prefetchers, stats = self._get_workers()
+
+        def _fetch(seq, task_stats):
+            t0 = time.time()
+            batch = seq[index]
+            task_stats.add_sample(time.time() - t0)
+            return batch
+
+        # Submit all non-prefetched tasks, then collect in task order
+        futures = [None if p else pool.submit(_fetch, seq, task_stats)
+                   for seq, p, task_stats in zip(self.sequencers,
+                                                 prefetchers, stats)]
         batches_x, batches_y, batches_w = [], [], []
-        for seq in self.sequencers:
-            x, y, w = seq[0]
+        for future, prefetcher, task_stats in zip(futures, prefetchers, stats):
+            t0 = time.time()
+            x, y, w = prefetcher.get() if prefetcher else future.result()
+            task_stats.add_wait(time.time() - t0)
             batches_x.append(x)
             batches_y.append(y)
             batches_w.append(w)
 
+        if self.report_every:
+            with self.__dict__["_lock"]:
+                self.__dict__["_n_batches"] += 1
+                report = self.__dict__["_n_batches"] % self.report_every == 0
+            if report:
+                self.log_latency_report()
+
         return batches_x, batches_y, batches_w
+
+    def get_latency_report(self):
+        """
+        Returns a dictionary mapping each task name to a dictionary of the
+        number of task batches sampled, the mean and max sampling time and
+        the mean time __getitem__ waited for the task batch (in ms) in this
+        process
+        """
+        stats = self.__dict__["_stats"]
+        if stats is None:
+            return {}
+        return {name: s.as_dict() for name, s in zip(self.task_names, stats)}
+
+    def log_latency_report(self):
+        for name, report in self.get_latency_report().items():
+            self.logger("[MultiTask] %-15s %6i batches, sample: %8.1f ms "
+                        "(max %8.1f ms), wait: %8.1f ms" % (
+                name, report["n_batches"], report["mean_sample_ms"],
+                report["max_sample_ms"], report["mean_wait_ms"]
+            ))
+
+    def stop(self):
+        """
+        Stop the prefetch threads and thread pool of this process
+        """
+        if self.__dict__["_pid"] != os.getpid():
+            return
+        for prefetcher in self.__dict__["_prefetchers"]:
+            if prefetcher:
+                prefetcher.stop()
+        self.__dict__["_pool"].shutdown(wait=False)
+        self.__dict__["_pid"] = None
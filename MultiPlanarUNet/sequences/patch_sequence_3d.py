@@ -2,37 +2,67 @@ from MultiPlanarUNet.sequences import BaseSequence
 from MultiPlanarUNet.preprocessing import one_hot_encode_y
 from MultiPlanarUNet.logging import ScreenLogger
 from MultiPlanarUNet.interpolation.linalg import mgrid_to_points
+from MultiPlanarUNet.utils.rng import get_rng
+from MultiPlanarUNet.sequences.sampling_stats import SamplingStats
 import numpy as np
-
-
-def center_expand(im, target_dim, bg_value, random=True):
-    if im.ndim == 4:
-        cim = np.empty(shape=(target_dim, target_dim, target_dim, im.shape[-1]),
-                       dtype=im.dtype)
-    else:
-        cim = np.empty(shape=(target_dim, target_dim, target_dim),
-                       dtype=im.dtype)
-    cim.fill(bg_value)
-
-    # Calculate size difference and starting positions in new volume
-    diff = np.asarray(cim.shape[:3]) - im.shape[:3]
-    if random and np.any(diff):
-        start = [np.random.randint(0, max(d, 1), 1)[0] for d in diff]
-    else:
-        start = diff//2
-
-    cim[start[0]:start[0] + im.shape[0],
-        start[1]:start[1] + im.shape[1],
-        start[2]:start[2] + im.shape[2]] = im
-
-    return cim
+from numpy.lib.stride_tricks import as_strided
+
+
+def extract_box(volume, corner, offset, dim, out, fill_value=0):
+    """
+    Copy the box of side 'dim' at voxel 'corner' of 'volume' into the
+    preallocated array 'out' of shape [dim, dim, dim, (channels)].
+
+    Along axes where the volume is smaller than 'dim', the volume is placed at
+    position 'offset' in 'out' and the remaining voxels are set to
+    'fill_value'. 'out' is only filled if the box crosses the volume border.
+
+    Args:
+        volume:     ndarray of shape [s1, s2, s3, (channels)]
+        corner:     ndarray of shape [3], start of the box in 'volume'
+        offset:     ndarray of shape [3], start of the volume in 'out'
+        dim:        Integer side length of the box
+        out:        ndarray of shape [dim, dim, dim, (channels)]
+        fill_value: Value (or values per channel) of voxels outside 'volume'
+    """
+    src, dst, crosses = [], [], False
+    for c, o, s in zip(corner, offset, volume.shape[:3]):
+        n = min(s - c, dim)
+        if n < dim:
+            crosses = True
+            src.append(slice(c, c + n))
+            dst.append(slice(o, o + n))
+        else:
+            src.append(slice(c, c + dim))
+            dst.append(slice(0, dim))
+    if crosses:
+        out[...] = fill_value
+    out[tuple(dst)] = volume[tuple(src)]
+
+
+def get_box_windows(volume, dim):
+    """
+    Returns a read-only view of shape [s1-dim+1, s2-dim+1, s3-dim+1, dim, dim,
+    dim, (channels)] of all boxes of side 'dim' in 'volume', indexed by their
+    corner voxel. No data is copied.
+
+    Returns None if the volume is smaller than 'dim' along any axis.
+    """
+    shape = np.asarray(volume.shape[:3])
+    if np.any(shape < dim):
+        return None
+    windows_shape = tuple(shape - dim + 1) + (dim,) * 3 + volume.shape[3:]
+    strides = volume.strides[:3] + volume.strides
+    return as_strided(volume, shape=windows_shape, strides=strides,
+                      writeable=False)
 
 
 class PatchSequence3D(BaseSequence):
     def __init__(self, image_pair_loader, dim, n_classes, batch_size, is_validation=False,
                  label_crop=None, fg_batch_fraction=0.33, logger=None, bg_val=0.,
-                 sparse=False, no_log=False, **kwargs):
-        super().__init__()
+                 sparse=False, no_log=False, use_fg_index=True, seed=None,
+                 **kwargs):
+        super().__init__(seed=seed)
 
         # Set logger or default print
         self.logger = logger or ScreenLogger()
@@ -52,6 +82,14 @@ class PatchSequence3D(BaseSequence):
         # How many foreground slices should be in each batch?
         self.fg_batch_fraction = fg_batch_fraction
 
+        # Place FG boxes directly on indexed FG voxels (see
+        # ImagePair.fg_index) instead of relying on rejection sampling
+        self.use_fg_index = use_fg_index
+
+        # Tries, rejections and stage timings of the sampled batches
+        # See MultiPlanarUNet.sequences.sampling_stats
+        self.sampling_stats = SamplingStats()
+
         # Foreground label settings
         self.fg_classes = np.arange(1, self.n_classes)
         if self.fg_classes.shape[0] == 0:
@@ -86,12 +124,13 @@ class PatchSequence3D(BaseSequence):
         else:
             return int(np.ceil(self.batch_size * self.fg_batch_fraction))
 
-    def get_N_random_patches_from(self, image, N):
+    def get_N_random_patches_from(self, image, N, rng=None):
         if N > 0:
             # Sample N patches from X
+            rng = get_rng(rng)
             X = image.image
             for i in range(N):
-                xc, yc, zc = self.get_random_box_coords(X)
+                xc, yc, zc = self.get_random_box_coords(X, rng=rng)
                 patch = X[xc:xc + self.dim, yc:yc + self.dim, zc:zc + self.dim]
                 yield image.scaler.transform(patch), (xc, yc, zc)
         else:
@@ -101,7 +140,7 @@ class PatchSequence3D(BaseSequence):
         X = image.image
 
         # Calculate positions
-        sample_space = np.asarray([max(i, self.dim) for i in image.shape[:3]])
+        sample_space = np.asarray([max(i, self.dim) for i in image.geometry.shape[:3]])
         d = (sample_space - self.dim)
         min_cov = [np.ceil(sample_space[i]/self.dim).astype(np.int) for i in range(3)]
         ds = [np.linspace(0, d[i], min_cov[i], dtype=np.int) for i in range(3)]
@@ -121,6 +160,49 @@ class PatchSequence3D(BaseSequence):
         for num, (p, coords) in enumerate(self.get_N_random_patches_from(image, n_extra)):
             yield p, coords, "   Predicting on extra patches (%i)" % (num+1)
 
+    def get_box_corners(self, shape, k, rng=None):
+        """
+        Returns k random box corners (ndarray of shape [k, 3]) in a volume of
+        voxel shape 'shape'. Overwritten in SlidingPatchSequence3D to sample
+        from a fixed set of corners.
+        """
+        max_corner = np.maximum(np.asarray(shape[:3]) - self.dim, 0)
+        return get_rng(rng).integers(0, max_corner + 1, size=(k, 3))
+
+    def draw_boxes(self, image, has_fg, cur_batch_size, k, rng=None):
+        """
+        Draw k box corners in 'image' and k offsets of the image within the
+        boxes (non-zero only along axes where the image is smaller than the
+        box).
+
+        As many of the corners as are still needed to fill the FG requirement
+        of the batch are placed around random voxels of the foreground index
+        of 'image' (see ImagePair.fg_index), if use_fg_index is set.
+
+        Returns:
+            Two ndarrays of shape [k, 3], the corners and offsets
+        """
+        rng = get_rng(rng)
+        shape = image.geometry.shape[:3]
+        max_corner = np.maximum(shape - self.dim, 0)
+        n_fg = min(max(self.n_fg_slices - has_fg, 0), k)
+        n_fg = min(n_fg, self.batch_size - cur_batch_size)
+        fg_corners = []
+        if self.use_fg_index and n_fg:
+            for _ in range(n_fg):
+                target = image.fg_index.sample(rng=rng)
+                if target is None:
+                    break
+                cords = target[0] - rng.integers(0, self.dim, 3)
+                fg_corners.append(np.clip(cords, 0, max_corner))
+        corners = self.get_box_corners(shape, k - len(fg_corners), rng=rng)
+        if fg_corners:
+            corners = np.concatenate([np.asarray(fg_corners, dtype=np.int64),
+                                      corners])
+        offsets = rng.integers(0, np.maximum(self.dim - shape, 0) + 1,
+                               size=(k, 3))
+        return corners, offsets
+
     def validate_lab(self, lab, has_fg, cur_batch_size):
         valid = np.any(np.isin(self.fg_classes, lab))
         if valid:
@@ -134,17 +216,11 @@ class PatchSequence3D(BaseSequence):
             # minimum requirement. Discard the slice and sample again.
             return False, has_fg
 
-    def get_random_box_coords(self, im):
+    def get_random_box_coords(self, im, rng=None):
         dim = [max(0, s-self.dim) for s in im.shape[:3]]
-        cords = np.round((dim * np.random.rand(3)).astype(np.uint16))
+        cords = np.round((dim * get_rng(rng).random(3)).astype(np.uint16))
         return cords
 
-    def get_box_coords(self, im):
-        """
-        Overwritten in SlidingPatchSequence3D to provide deterministic sampling
-        """
-        return self.get_random_box_coords(im)
-
     def __getitem__(self, idx, image_id=None):
         """
         Used by keras.fit_generator to fetch mini-batches during training
@@ -152,49 +228,64 @@ class PatchSequence3D(BaseSequence):
         # If multiprocessing, set unique seed for this particular process
         self.seed()
 
+        # All random numbers of the batch are drawn from its own generator
+        rng = self.get_rng(idx)
+        stats = self.sampling_stats.new_batch()
+
         # Store how many slices has fg so far
         has_fg = 0
 
-        # Interpolate on a random index for each sample image to generate batch
-        batch_x, batch_y, batch_w = [], [], []
-
-        with self.image_pair_loader.get_random() as image:
-            while len(batch_x) < self.batch_size:
-
-                # Fetch image, labels and weights
-                X, y, w = image.image, image.labels, image.sample_weight
-
-                # Sample a random box in the volume
-                xc, yc, zc = self.get_box_coords(X)
-
-                # Slice volume
-                im = X[xc:xc+self.dim, yc:yc+self.dim, zc:zc+self.dim]
-                lab = y[xc:xc+self.dim, yc:yc+self.dim, zc:zc+self.dim]
-
-                # Make sure the box is of sufficient size
-                im = center_expand(im, self.dim, self.bg_value, random=True)
-                lab = center_expand(lab, self.dim, self.bg_value, random=True)
-
-                # Validate label volume
-                valid, has_fg = self.validate_lab(lab, has_fg, len(batch_y))
-                if valid:
-                    # Normalize image
-                    im = image.scaler.transform(im)
-
-                    batch_x.append(im)
-                    batch_y.append(lab)
-                    batch_w.append(w)
-
-        # Reshape X (and one-hot encode y)
-        batch_x = np.asarray(batch_x)
-
-        if self.n_classes > 1 and not self.sparse:
-            batch_y = one_hot_encode_y(batch_y, n_classes=self.n_classes)
-        else:
-            batch_y = np.asarray(batch_y)
-            batch_y = batch_y.reshape(batch_y.shape + (1,))
-
-        return batch_x, batch_y, np.asarray(batch_w)
+        images = self.image_pair_loader.get_random(N=1, rng=rng)
+        for image in stats.timed_iter(images, "queue_wait"):
+            X, y = image.image, image.labels
+
+            # Preallocate the batch, boxes are written directly into it
+            batch_x = np.empty((self.batch_size,) + (self.dim,) * 3 +
+                               (X.shape[-1],), dtype=np.float32)
+            batch_y = np.empty((self.batch_size,) + (self.dim,) * 3,
+                               dtype=y.dtype)
+            n = 0
+            while n < self.batch_size:
+                # Draw the boxes still needed at once, around FG voxels if
+                # more FG boxes are needed
+                with stats.time("grid"):
+                    corners, offsets = self.draw_boxes(image, has_fg, n,
+                                                       self.batch_size - n,
+                                                       rng=rng)
+                for corner, offset in zip(corners, offsets):
+                    if n == self.batch_size:
+                        break
+                    stats.tries += 1
+                    with stats.time("labels"):
+                        extract_box(y, corner, offset, self.dim,
+                                    out=batch_y[n], fill_value=0)
+
+                    # Validate label volume
+                    valid, has_fg = self.validate_lab(batch_y[n], has_fg, n)
+                    if valid:
+                        with stats.time("image"):
+                            extract_box(X, corner, offset, self.dim,
+                                        out=batch_x[n],
+                                        fill_value=self.bg_value)
+                        n += 1
+                    else:
+                        stats.reject("validate_lab")
+
+            # Normalize all boxes at once
+            with stats.time("scale"):
+                image.scaler.transform(batch_x, in_place=True)
+            batch_w = np.full(self.batch_size, image.sample_weight,
+                              dtype=np.float32)
+
+        # One-hot encode y if needed
+        with stats.time("prepare"):
+            if self.n_classes > 1 and not self.sparse:
+                batch_y = one_hot_encode_y(batch_y, n_classes=self.n_classes)
+            else:
+                batch_y = batch_y.reshape(batch_y.shape + (1,))
+        self.sampling_stats.add(stats)
+
+        return batch_x, batch_y, batch_w
 
     def log(self):
         self.logger("Sequence Generator: %s" % self.__class__.__name__)
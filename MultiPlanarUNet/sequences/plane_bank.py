@@ -0,0 +1,283 @@
+"""
+Materialised bank of training planes for the 2D iso-live model.
+
+Planes are sampled with the IsotrophicLiveViewSequence2D sampler (random
+image, view, offset and noise) ahead of time and stored normalized with
+their labels in memory-mapped files on disk. Training batches are then drawn
+from the bank and only (optionally) augmented, which is much cheaper than
+interpolating every plane live. A configurable fraction of the bank is
+re-sampled by a background process at the end of each epoch.
+"""
+
+import os
+import multiprocessing as mp
+import numpy as np
+from numpy.lib.format import open_memmap
+from MultiPlanarUNet.sequences.isotrophic_live_view_sequence_2d import IsotrophicLiveViewSequence2D
+from MultiPlanarUNet.sequences.batch_producer import _restart_image_queues
+
+
+class PlaneBank(object):
+    """
+    Memory-mapped storage of a fixed number of normalized planes, their
+    labels, sample weights, (normalized) background values and whether they
+    contain foreground.
+
+    The arrays are stored as .npy files in 'folder' and mapped in shared mode,
+    so that entries written by forked processes are visible to all processes.
+    """
+    def __init__(self, folder, n_planes, dim, n_channels, n_classes):
+        """
+        Args:
+            folder:     Folder in which to store the bank files
+            n_planes:   Number of planes in the bank
+            dim:        The planes are of shape [dim, dim]
+            n_channels: Number of image channels
+            n_classes:  Number of classes, determines the label dtype
+        """
+        self.folder = os.path.abspath(folder)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        n = int(n_planes)
+        lab_dtype = np.uint8 if n_classes <= 256 else np.int32
+
+        def _map(name, dtype, shape):
+            return open_memmap(os.path.join(self.folder, "%s.npy" % name),
+                               mode="w+", dtype=dtype, shape=shape)
+        self.X = _map("X", np.float32, (n, dim, dim, n_channels))
+        self.y = _map("y", lab_dtype, (n, dim, dim))
+        self.w = _map("w", np.float32, (n,))
+        self.bg = _map("bg", np.float32, (n, n_channels))
+        self.fg = _map("fg", np.bool_, (n,))
+
+    def __len__(self):
+        return len(self.X)
+
+    def __str__(self):
+        return "PlaneBank(folder=%s, n_planes=%i, plane_shape=%s)" % (
+            self.folder, len(self), self.X.shape[1:]
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.X, self.y, self.w,
+                                      self.bg, self.fg))
+
+    def write(self, ind, im, lab, weight, bg, fg):
+        """
+        Store a normalized plane 'im' with labels 'lab', sample weight
+        'weight', normalized background value(s) 'bg' and FG indicator 'fg'
+        at entry 'ind'
+        """
+        self.X[ind] = im
+        self.y[ind] = lab.reshape(self.y.shape[1:])
+        self.w[ind] = weight
+        self.bg[ind] = bg
+        self.fg[ind] = fg
+
+    def flush(self):
+        for a in (self.X, self.y, self.w, self.bg, self.fg):
+            a.flush()
+
+
+# Key stream of the generators used to fill and refresh the bank, see
+# BaseSequence.get_rng
+_BANK_STREAM = 1
+
+
+def _sample_into_bank(sequence, inds, rng, done_event=None):
+    """
+    Process target function, samples planes into entries 'inds' of the bank
+    of 'sequence' (a PlaneBankSequence2D) and sets 'done_event' when done
+    """
+    _restart_image_queues(sequence)
+    sequence.seed()
+    sequence.sample_into_bank(inds, rng)
+    if done_event is not None:
+        done_event.set()
+
+
+class PlaneBankSequence2D(IsotrophicLiveViewSequence2D):
+    """
+    IsotrophicLiveViewSequence2D drawing training batches from a PlaneBank
+    filled with its own (un-augmented) plane sampler.
+
+    Each batch holds n_fg_slices planes drawn from the bank entries with
+    foreground and a remainder drawn from all entries. The force_all_fg
+    requirement is not enforced on batches drawn from the bank.
+    """
+    def __init__(self, image_pair_loader, views, plane_bank, no_log=False,
+                 **kwargs):
+        """
+        Args:
+            image_pair_loader: See IsotrophicLiveViewSequence2D
+            views:             See IsotrophicLiveViewSequence2D
+            plane_bank:        Dictionary of bank settings:
+                               folder:           Folder to store the bank in
+                               n_planes:         Number of planes in the bank
+                               refresh_fraction: Fraction of the bank
+                                                 re-sampled at each refresh
+                               n_workers:        Number of processes used
+                                                 for the initial fill
+            no_log:            See IsotrophicLiveViewSequence2D
+            **kwargs:          See IsotrophicLiveViewSequence2D
+        """
+        # The bank stores un-augmented planes, all augmenters are applied to
+        # the batches drawn from the bank
+        kwargs["elastic_on_grid"] = False
+        super().__init__(image_pair_loader, views, no_log=True, **kwargs)
+        self.refresh_fraction = float(plane_bank.get("refresh_fraction", 0.1))
+        self.ctx = mp.get_context("fork")
+        self.bank = PlaneBank(folder=plane_bank.get("folder", "plane_bank"),
+                              n_planes=plane_bank["n_planes"],
+                              dim=self.sample_dim,
+                              n_channels=self.images[0].n_channels,
+                              n_classes=self.n_classes)
+
+        # Entries being re-sampled in the background, excluded from batches
+        # until _refresh_done is set
+        self._refresh_process = None
+        self._refresh_inds = np.empty(0, dtype=np.int64)
+        self._refresh_done = self.ctx.Event()
+        self._refresh_done.set()
+        self._n_refreshes = 0
+
+        self.fill(n_workers=plane_bank.get("n_workers") or 1)
+        if not no_log:
+            self.log()
+
+    def log(self):
+        super().log()
+        self.logger("Plane bank:                  %s" % self.bank)
+        self.logger("Plane bank size:             %.2f GB" % (
+            self.bank.nbytes / 1024 ** 3))
+        self.logger("Refresh fraction:            %s" % self.refresh_fraction)
+
+    def sample_into_bank(self, inds, rng=None):
+        """
+        Sample planes with the live sampler (see sample_planes) from the
+        np.random.Generator 'rng', normalize them and store them at bank
+        entries 'inds'
+        """
+        i = 0
+        while i < len(inds):
+            batch = self.sample_planes(rng)
+            for im, lab, w, scaler, bg_value in zip(*batch):
+                if i == len(inds):
+                    break
+                bg = np.full((1, im.shape[-1]), bg_value, dtype=np.float32)
+                fg = np.any(np.isin(self.fg_classes, lab))
+                self.bank.write(inds[i], scaler.transform(im), lab, w,
+                                scaler.transform(bg)[0], fg)
+                i += 1
+        self.bank.flush()
+
+    def fill(self, n_workers=1):
+        """
+        Fill the whole bank, in n_workers forked processes if > 1. Chunk i of
+        the bank is sampled from generator (epoch=0, idx=i) of the bank key
+        stream.
+        """
+        self.logger("Filling plane bank of %i planes..." % len(self.bank))
+        chunks = np.array_split(np.arange(len(self.bank)), n_workers)
+        rngs = [self.get_rng(i, epoch=0, worker_id=0, stream=_BANK_STREAM)
+                for i in range(len(chunks))]
+        if n_workers <= 1:
+            self.sample_into_bank(chunks[0], rngs[0])
+            return
+        processes = []
+        for i, chunk in enumerate(chunks):
+            p = self.ctx.Process(target=_sample_into_bank,
+                                 name="PlaneBankFill-%i" % i,
+                                 args=(self, chunk, rngs[i]))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError("Plane bank fill process %s failed with "
+                                   "exit code %s" % (p.name, p.exitcode))
+
+    def refresh(self):
+        """
+        Start re-sampling a random refresh_fraction of the bank entries in a
+        background process. Skipped if the previous refresh has not finished.
+        Refresh number k is drawn from generator (epoch=k, idx=0) of the bank
+        key stream.
+        """
+        if self._refresh_process is not None:
+            if self._refresh_process.is_alive():
+                self.logger("[PlaneBank] Previous refresh not finished, "
+                            "skipping refresh")
+                return
+            self._refresh_process.join()
+        n = int(len(self.bank) * self.refresh_fraction)
+        if n == 0:
+            return
+        self._n_refreshes += 1
+        rng = self.get_rng(0, epoch=self._n_refreshes, worker_id=0,
+                           stream=_BANK_STREAM)
+        self._refresh_inds = rng.choice(len(self.bank), n, replace=False)
+        self._refresh_done.clear()
+        self._refresh_process = self.ctx.Process(
+            target=_sample_into_bank, name="PlaneBankRefresh",
+            args=(self, self._refresh_inds, rng, self._refresh_done),
+            daemon=True
+        )
+        self._refresh_process.start()
+
+    def _draw(self, candidates, n, rng):
+        if n <= 0 or len(candidates) == 0:
+            return np.empty(0, dtype=np.int64)
+        return candidates[rng.integers(0, len(candidates), n)]
+
+    def __getitem__(self, idx):
+        """
+        Used by keras.fit_generator to fetch mini-batches during training
+        """
+        # If multiprocessing, set unique seed for this particular process
+        self.seed()
+
+        # All random numbers of the batch are drawn from its own generator
+        # The batch also depends on the bank contents at the time
+        rng = self.get_rng(idx)
+        stats = self.sampling_stats.new_batch()
+
+        # Exclude entries currently being re-sampled
+        available = np.ones(len(self.bank), dtype=np.bool_)
+        if not self._refresh_done.is_set():
+            available[self._refresh_inds] = False
+
+        # Draw FG entries first, then fill up with random entries
+        fg_inds = self._draw(np.nonzero(available & self.bank.fg)[0],
+                             self.n_fg_slices, rng)
+        inds = np.concatenate([fg_inds, self._draw(np.nonzero(available)[0],
+                                                   self.batch_size - len(fg_inds),
+                                                   rng)])
+
+        batch_x, batch_y, batch_w = self.get_batch_buffers()
+        with stats.time("image"):
+            np.take(self.bank.X, inds, axis=0, out=batch_x, mode="clip")
+        with stats.time("labels"):
+            np.take(self.bank.y, inds, axis=0, out=batch_y, mode="clip")
+        np.take(self.bank.w, inds, axis=0, out=batch_w, mode="clip")
+        bg_values = list(self.bank.bg[inds])
+
+        # Apply augmentation if specified (planes are already normalized)
+        with stats.time("augment"):
+            batch_x, batch_y, batch_w = self.augment(batch_x, batch_y,
+                                                     batch_w, bg_values,
+                                                     rng=rng, stats=stats)
+
+        # Reshape, one-hot encode etc.
+        with stats.time("prepare"):
+            batch_x, batch_y, batch_w = self.prepare_batches(batch_x,
+                                                             batch_y,
+                                                             batch_w)
+        self.sampling_stats.add(stats)
+
+        assert len(batch_x) == self.batch_size
+        return batch_x, batch_y, batch_w
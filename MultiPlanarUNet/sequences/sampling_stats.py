@@ -0,0 +1,201 @@
+"""
+Instrumentation of the batch samplers.
+
+Each batch is recorded in a BatchStats object: the number of sampling tries,
+the number of candidates rejected by each test and the time spent in each
+stage of the batch creation. SamplingStats aggregates the batches of a
+sequence (per epoch, see the SamplingStatsLogger callback).
+
+Stages:
+    queue_wait: Fetching images from the ImagePairLoader (incl. ImageQueue
+                waits)
+    grid:       Generation of the sampling grids
+    labels:     Label interpolation/extraction
+    image:      Image interpolation/extraction
+    augment:    Augmentation
+    scale:      Normalization
+    prepare:    Batch preparation (cropping, one-hot encoding etc.)
+
+Sequences with augmenters add a stage per augmenter (see
+MultiPlanarUNet.augmentation.pipeline), e.g. aug_elastic2d. These are
+included in the 'augment' stage.
+
+Rejections (candidates rejected on the label preview of an image count
+towards the test that rejected them, see reject_on_preview):
+    validate_lab:     Too few FG samples left to fill the batch
+    validate_lab_vec: FG classes missing from the batch
+    is_valid_im:      Image sample is all background
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+STAGES = ("queue_wait", "grid", "labels", "image", "augment", "scale",
+          "prepare")
+REJECTIONS = ("validate_lab", "validate_lab_vec", "is_valid_im")
+
+
+class BatchStats(object):
+    """
+    Tries, rejections and per-stage timings of a single batch
+    """
+    def __init__(self, stages=STAGES):
+        self.tries = 0
+        self.rejected = dict.fromkeys(REJECTIONS, 0)
+        self.times = dict.fromkeys(stages, 0.)
+        self.total_time = 0.
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage):
+        """ Context manager adding the time spent in its block to 'stage' """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.perf_counter() - t0
+
+    def add_time(self, stage, t):
+        self.times[stage] = self.times.get(stage, 0.) + t
+
+    def timed_iter(self, iterable, stage="queue_wait"):
+        """
+        Yields the items of 'iterable', adding the time spent fetching each
+        item to 'stage'
+        """
+        iterator = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.times[stage] += time.perf_counter() - t0
+            yield item
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self._start
+
+    def as_dict(self):
+        d = {"tries": self.tries, "batch_ms": 1000 * self.total_time}
+        d.update({"rejected_" + r: n for r, n in self.rejected.items()})
+        d.update({s + "_ms": 1000 * t for s, t in self.times.items()})
+        return d
+
+
+class SamplingStats(object):
+    """
+    Thread-safe aggregate of the BatchStats of a sequence since the last
+    reset. The last 'keep_batches' batch records are kept in 'recent'.
+    'extra_stages' are recorded in addition to STAGES (e.g. per augmenter).
+
+    Batches produced in worker processes (see SharedBatchProducer) are added
+    to the stats of the main process with merge(pop_state()).
+    """
+    def __init__(self, keep_batches=100, extra_stages=()):
+        self.stages = STAGES + tuple(extra_stages)
+        self.lock = Lock()
+        self.recent = deque(maxlen=keep_batches)
+        self._clear()
+
+    def _clear(self):
+        self.n_batches = 0
+        self.tries = 0
+        self.rejected = dict.fromkeys(REJECTIONS, 0)
+        self.times = dict.fromkeys(self.stages, 0.)
+        self.total_time = 0.
+        self.recent.clear()
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+
+    def new_batch(self):
+        return BatchStats(self.stages)
+
+    def add(self, batch):
+        """ Add the finished BatchStats object 'batch' """
+        batch.finish()
+        with self.lock:
+            self.n_batches += 1
+            self.tries += batch.tries
+            for r, n in batch.rejected.items():
+                self.rejected[r] += n
+            for s, t in batch.times.items():
+                self.times[s] = self.times.get(s, 0.) + t
+            self.total_time += batch.total_time
+            self.recent.append(batch.as_dict())
+
+    def _state(self):
+        return {"n_batches": self.n_batches, "tries": self.tries,
+                "rejected": dict(self.rejected), "times": dict(self.times),
+                "total_time": self.total_time, "recent": list(self.recent)}
+
+    def get_state(self):
+        with self.lock:
+            return self._state()
+
+    def pop_state(self):
+        """ Returns the state (see merge) and resets the stats """
+        with self.lock:
+            state = self._state()
+            self._clear()
+            return state
+
+    def merge(self, state):
+        """ Add a state returned by get_state/pop_state of another process """
+        with self.lock:
+            self.n_batches += state["n_batches"]
+            self.tries += state["tries"]
+            for r, n in state["rejected"].items():
+                self.rejected[r] += n
+            for s, t in state["times"].items():
+                self.times[s] = self.times.get(s, 0.) + t
+            self.total_time += state["total_time"]
+            self.recent.extend(state["recent"])
+
+    def summary(self):
+        """
+        Returns a dictionary of the mean number of tries per batch, the
+        fraction of tries rejected by each test and the mean time per batch
+        spent in each stage (in ms) since the last reset
+        """
+        with self.lock:
+            n = max(self.n_batches, 1)
+            tries = max(self.tries, 1)
+            d = {"n_batches": self.n_batches, "tries": self.tries / n,
+                 "batch_ms": 1000 * self.total_time / n}
+            d.update({"reject_rate_" + r: c / tries
+                      for r, c in self.rejected.items()})
+            d.update({s + "_ms": 1000 * t / n for s, t in self.times.items()})
+            return d
+
+    def __str__(self):
+        s = self.summary()
+        times = ", ".join("%s: %.1f" % (st, s[st + "_ms"])
+                          for st in self.stages)
+        rejects = ", ".join("%s: %.1f%%" % (r, 100 * s["reject_rate_" + r])
+                            for r in REJECTIONS)
+        return ("%i batches, %.1f tries/batch, %.1f ms/batch\n"
+                "Rejected:  %s\nStage ms:  %s" % (s["n_batches"], s["tries"],
+                                                  s["batch_ms"], rejects,
+                                                  times))
+
+
+def get_sampling_stats(sequence):
+    """
+    Returns a list of the SamplingStats objects of 'sequence' (one per task
+    of a MultiTaskSequence), empty if the sequence is not instrumented
+    """
+    stats = getattr(sequence, "sampling_stats", None)
+    if stats is None:
+        return []
+    if not isinstance(stats, (list, tuple)):
+        stats = [stats]
+    return [s for s in stats if s is not None]
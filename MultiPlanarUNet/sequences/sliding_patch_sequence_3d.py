@@ -1,5 +1,7 @@
 from . import PatchSequence3D
+from .patch_sequence_3d import get_box_windows
 from MultiPlanarUNet.interpolation.linalg import mgrid_to_points
+from MultiPlanarUNet.utils.rng import get_rng
 import numpy as np
 
 
@@ -13,48 +15,64 @@ def standardize_strides(strides):
 
 
 class SlidingPatchSequence3D(PatchSequence3D):
-    def __init__(self, strides, no_log=False, *args, **kwargs):
+    def __init__(self, image_pair_loader, strides, no_log=False, **kwargs):
         """
         strides: tuple (s1, s2, s3) of strides or integer s --> (s, s, s)
         """
-        super().__init__(no_log=True, *args, **kwargs)
+        super().__init__(image_pair_loader, no_log=True, **kwargs)
 
         # Stride attribute gives the number pixel distance between
         # patch samples in 3 dimensions
         self.strides = standardize_strides(strides)
-        self.corners = self.get_patch_corners().astype(np.uint16)
-        self.ind = np.arange(self.corners.shape[0])
+
+        # Patch corners are computed once per image shape
+        self._corners = {}
 
         if not self.is_validation and not no_log:
             self.log()
 
-    @property
-    def n_samples(self):
-        return self.corners.shape[0] * len(self.data)
-
-    def get_patch_corners(self):
-        xc = np.linspace(0, self.dim_r[0], self.strides[0]).astype(np.int)
-        yc = np.linspace(0, self.dim_r[1], self.strides[1]).astype(np.int)
-        zc = np.linspace(0, self.dim_r[2], self.strides[2]).astype(np.int)
-
-        return mgrid_to_points(np.meshgrid(xc, yc, zc))
+    def get_patch_corners(self, shape):
+        """
+        Returns the corners (ndarray of shape [N, 3]) of all tiles of side
+        self.dim placed with self.strides in a volume of voxel shape 'shape'.
+        The last tile along each axis is aligned with the volume border.
+        """
+        shape = tuple(int(s) for s in shape[:3])
+        if shape not in self._corners:
+            axes = []
+            for s, stride in zip(shape, self.strides):
+                max_corner = max(s - self.dim, 0)
+                c = np.arange(0, max_corner + 1, max(int(stride), 1))
+                if c[-1] != max_corner:
+                    c = np.append(c, max_corner)
+                axes.append(c)
+            self._corners[shape] = mgrid_to_points(np.meshgrid(*axes))
+        return self._corners[shape]
 
-    def get_box_coords(self):
-        return self.corners[np.random.choice(self.ind)]
+    def get_box_corners(self, shape, k, rng=None):
+        corners = self.get_patch_corners(shape)
+        return corners[get_rng(rng).integers(0, len(corners), k)]
 
-    def get_base_patches(self, image_id):
-        # Get sliding windows for X
-        X = self.data[image_id][0]
-        for xc, yc, zc in self.corners:
-            patch = X[xc:xc + self.dim, yc:yc + self.dim, zc:zc + self.dim]
-            yield patch, (xc, yc, zc)
+    def get_base_patches(self, image):
+        """
+        Yields the normalized tiles of 'image' and their corners. The tiles are
+        taken from a strided view of the volume, only the yielded (normalized)
+        patches are copies.
+        """
+        X = image.image
+        windows = get_box_windows(X, self.dim)
+        for corner in self.get_patch_corners(X.shape):
+            if windows is not None:
+                patch = windows[tuple(corner)]
+            else:
+                patch = X[corner[0]:corner[0]+self.dim,
+                          corner[1]:corner[1]+self.dim,
+                          corner[2]:corner[2]+self.dim]
+            yield image.scaler.transform(patch), corner
 
     def log(self):
         self.logger("Sequence Generator: %s" % self.__class__.__name__)
         self.logger("Box dimensions:     %s" % self.dim)
-        self.logger("Image dimensions:   %s" % self.im_dim)
-        self.logger("Sample space dim:   %s" % self.dim_r)
         self.logger("Strides:            %s" % list(self.strides))
-        self.logger("N boxes:            %s" % self.corners.shape[0])
         self.logger("Batch size:         %s" % self.batch_size)
         self.logger("N fg slices/batch:  %s" % self.n_fg_slices)
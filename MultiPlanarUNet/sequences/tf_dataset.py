@@ -0,0 +1,189 @@
+"""
+tf.data adapter for the MultiPlanarUNet.sequence objects.
+
+Batches are produced by the sequence in threads of the TensorFlow runtime
+(via tf.numpy_function) instead of forked worker processes. A number of
+independent batch streams are interleaved in parallel, each producing
+batches from random images of the sequence, and the result is prefetched so
+that batch production overlaps with training on the accelerator.
+
+Batch i of the dataset is sequence[i] with the epoch of the sequence at the
+time the dataset is iterated, i.e. the batch keys (epoch, i, worker_id) are
+unique over the (infinite) dataset.
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from multiprocessing import cpu_count
+from MultiPlanarUNet.logging import ScreenLogger
+from MultiPlanarUNet.sequences.batch_producer import _flatten, _unflatten
+
+# Not available in older TensorFlow versions
+_numpy_function = getattr(tf, "numpy_function", None) or tf.py_func
+
+
+def _as_tuples(structure):
+    """
+    tf.data treats lists as tensors, convert a _flatten structure description
+    to use tuples only
+    """
+    if structure is None:
+        return None
+    _, items = structure
+    return tuple, [(start, _as_tuples(s)) for start, s in items]
+
+
+def get_dataset(sequence, n_parallel=None, prefetch=None, cache_batches=None,
+                logger=None):
+    """
+    Returns a tf.data.Dataset of batches from a MultiPlanarUNet.sequence
+    object (IsotrophicLiveViewSequence2D/3D, PatchSequence3D,
+    MultiTaskSequence etc.)
+
+    The shapes and dtypes of the batches are determined from a single batch
+    produced at call time; integer arrays (e.g. sparse labels, which may have
+    different dtypes across images) are cast to int32.
+
+    Args:
+        sequence:      A MultiPlanarUNet.sequence object
+        n_parallel:    Number of batch streams interleaved in parallel,
+                       defaults to the number of CPUs - 1
+        prefetch:      Number of batches to prefetch, defaults to AUTOTUNE
+        cache_batches: Optional integer. If set, only the first cache_batches
+                       batches are produced, cached in memory and repeated.
+                       Useful for a fixed set of validation batches.
+        logger:        A MultiPlanarUNet logger object
+
+    Returns:
+        An (infinite) tf.data.Dataset of batches with the same (possibly
+        nested) structure as returned by the sequence, lists are returned as
+        tuples.
+    """
+    logger = logger or ScreenLogger()
+    autotune = tf.data.experimental.AUTOTUNE
+    n_parallel = int(n_parallel or max(cpu_count() - 1, 1))
+
+    # Probe the sequence for the batch structure
+    arrays, structure = _flatten(sequence[0])
+    structure = _as_tuples(structure)
+    np_dtypes = [np.dtype(np.int32) if np.issubdtype(a.dtype, np.integer)
+                 else a.dtype for a in arrays]
+    tf_dtypes = [tf.as_dtype(d) for d in np_dtypes]
+    shapes = [a.shape for a in arrays]
+
+    def _get_batch(idx):
+        # The sequences use the batch index as the key of the batch only
+        # (see BaseSequence.get_rng), so the running index is passed as is to
+        # avoid repeating batches every len(sequence) batches
+        batch, _ = _flatten(sequence[int(idx)])
+        return [np.asarray(a, dtype=d) for a, d in zip(batch, np_dtypes)]
+
+    def _map(idx):
+        batch = _numpy_function(_get_batch, [idx], tf_dtypes)
+        for tensor, shape in zip(batch, shapes):
+            tensor.set_shape(shape)
+        return _unflatten(batch, structure)
+
+    def _stream(stream_idx):
+        # Batch indices stream_idx, stream_idx + n_parallel, ...
+        inds = tf.data.Dataset.range(stream_idx, np.iinfo(np.int64).max,
+                                     n_parallel)
+        return inds.map(_map)
+
+    dataset = tf.data.Dataset.range(n_parallel).interleave(
+        _stream, cycle_length=n_parallel, block_length=1,
+        num_parallel_calls=n_parallel
+    )
+    if cache_batches:
+        dataset = dataset.take(int(cache_batches)).cache().repeat()
+    dataset = dataset.prefetch(prefetch or autotune)
+
+    logger("tf.data batches: %i parallel streams, prefetch %s%s" % (
+        n_parallel, prefetch or "AUTOTUNE",
+        ", %i cached batches" % cache_batches if cache_batches else ""
+    ))
+    return dataset
+
+
+def _iterate_dataset(dataset, n_batches):
+    """
+    Pull n_batches batches from 'dataset' in eager or graph mode
+    """
+    if tf.executing_eagerly():
+        for _ in dataset.take(n_batches):
+            pass
+    else:
+        from tensorflow.keras import backend as K
+        get_next = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+        session = K.get_session()
+        for _ in range(n_batches):
+            session.run(get_next)
+
+
+def benchmark_batch_sources(sequence, n_batches=100, n_workers=None,
+                            logger=None):
+    """
+    Time the production of n_batches batches from 'sequence' with each of
+    the available batch sources on the CPU:
+        - 'sequence':  Sequentially in the main process
+        - 'enqueuer':  tf.keras OrderedEnqueuer with multiprocessing, as used
+                       by fit_generator(use_multiprocessing=True)
+        - 'producer':  SharedBatchProducer (see batch_producer), yielding
+                       copies as in training
+        - 'tf_data':   get_dataset
+
+    Args:
+        sequence:  A MultiPlanarUNet.sequence object
+        n_batches: Number of batches to time for each source
+        n_workers: Number of worker processes/parallel streams, defaults to
+                   the number of CPUs - 1
+        logger:    A MultiPlanarUNet logger object
+
+    Returns:
+        A dictionary mapping source names to batches per second
+    """
+    from tensorflow.keras.utils import OrderedEnqueuer
+    from MultiPlanarUNet.sequences.batch_producer import SharedBatchProducer
+    logger = logger or ScreenLogger()
+    n_workers = int(n_workers or max(cpu_count() - 1, 1))
+
+    def _time(func):
+        t0 = time.time()
+        func()
+        return n_batches / (time.time() - t0)
+
+    def _sequence():
+        for i in range(n_batches):
+            sequence[i % len(sequence)]
+
+    def _enqueuer():
+        enqueuer = OrderedEnqueuer(sequence, use_multiprocessing=True)
+        enqueuer.start(workers=n_workers, max_queue_size=10)
+        try:
+            output = enqueuer.get()
+            for _ in range(n_batches):
+                next(output)
+        finally:
+            enqueuer.stop()
+
+    def _producer():
+        producer = SharedBatchProducer(sequence, n_workers=n_workers,
+                                       copy=True, logger=logger)
+        producer.start()
+        try:
+            for _ in range(n_batches):
+                next(producer)
+        finally:
+            producer.stop()
+
+    def _tf_data():
+        dataset = get_dataset(sequence, n_parallel=n_workers, logger=logger)
+        _iterate_dataset(dataset, n_batches)
+
+    results = {}
+    for name, func in (("sequence", _sequence), ("enqueuer", _enqueuer),
+                       ("producer", _producer), ("tf_data", _tf_data)):
+        results[name] = _time(func)
+        logger("%-10s %.2f batches/s" % (name, results[name]))
+    return results
@@ -0,0 +1,113 @@
+"""
+Frozen set of validation batches stored in memory-mapped files.
+
+The batches are sampled once from a validation sequence (whose batches are
+fixed by its seed, see BaseSequence.get_rng) and stored with sparse labels.
+Later validation epochs only read the cached batches.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.format import open_memmap
+from MultiPlanarUNet.logging import ScreenLogger
+from MultiPlanarUNet.sequences.batch_producer import _flatten, _unflatten
+
+
+def _to_sparse(y, n_classes):
+    """
+    Returns sparse labels of shape [..., 1] of one-hot or sparse labels 'y'
+    """
+    y = np.asarray(y)
+    if y.shape[-1] > 1:
+        y = np.argmax(y, axis=-1)[..., None]
+    dtype = np.uint8 if n_classes <= 256 else np.int32
+    return y.astype(dtype, copy=False)
+
+
+class ValidationCache(object):
+    """
+    Stores n_batches batches of a MultiPlanarUNet.sequence object (including
+    MultiTaskSequence objects) in .npy memmaps in 'folder'.
+
+    Images are stored in their dtype, labels as sparse uint8 (int32 if more
+    than 256 classes) of shape [..., 1]. Sample weights are not stored.
+    """
+    def __init__(self, sequence, n_batches, folder, n_threads=7, logger=None):
+        """
+        Args:
+            sequence:  A MultiPlanarUNet.sequence object
+            n_batches: Number of batches to cache
+            folder:    Folder in which to store the cache files
+            n_threads: Number of threads sampling the batches
+            logger:    A MultiPlanarUNet logger object
+        """
+        self.logger = logger or ScreenLogger()
+        self.folder = os.path.abspath(folder)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.n_batches = int(n_batches)
+        n_classes = sequence.n_classes
+        if not isinstance(n_classes, (list, tuple)):
+            n_classes = [n_classes]
+        self.n_classes = n_classes
+
+        self.X, self.y = None, None
+        self.X_structure, self.y_structure = None, None
+        self._fill(sequence, n_threads)
+
+    def __len__(self):
+        return self.n_batches
+
+    def __str__(self):
+        return "ValidationCache(folder=%s, n_batches=%i, %.2f GB)" % (
+            self.folder, len(self), self.nbytes / 1024 ** 3
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.X + self.y)
+
+    def _map(self, name, i, batch_array, dtype):
+        path = os.path.join(self.folder, "%s_%i.npy" % (name, i))
+        return open_memmap(path, mode="w+", dtype=dtype,
+                           shape=(self.n_batches,) + batch_array.shape)
+
+    def _fill(self, sequence, n_threads):
+        self.logger("Caching %i validation batches in %s..." % (
+            self.n_batches, self.folder))
+        pool = ThreadPoolExecutor(max_workers=n_threads)
+        try:
+            batches = pool.map(sequence.__getitem__, np.arange(self.n_batches))
+            for i, (X, y, _) in enumerate(batches):
+                X, X_structure = _flatten(X)
+                y, y_structure = _flatten(y)
+                y = [_to_sparse(a, n) for a, n in zip(y, self.n_classes)]
+                if self.X is None:
+                    self.X_structure, self.y_structure = X_structure, y_structure
+                    self.X = [self._map("X", j, a, a.dtype)
+                              for j, a in enumerate(X)]
+                    self.y = [self._map("y", j, a, a.dtype)
+                              for j, a in enumerate(y)]
+                for dst, src in zip(self.X + self.y, X + y):
+                    dst[i] = src
+        finally:
+            pool.shutdown()
+        for a in self.X + self.y:
+            a.flush()
+        self.logger(str(self))
+
+    def __getitem__(self, idx):
+        """
+        Returns the images and sparse labels of cached batch 'idx' (with the
+        structure of the sequence batches) as views of the memmaps
+        """
+        if idx < 0 or idx >= self.n_batches:
+            raise IndexError("Batch index %i out of range [0, %i)"
+                             % (idx, self.n_batches))
+        X = _unflatten([a[idx] for a in self.X], self.X_structure)
+        y = _unflatten([a[idx] for a in self.y], self.y_structure)
+        return X, y
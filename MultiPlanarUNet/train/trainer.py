@@ -3,7 +3,8 @@ from MultiPlanarUNet.callbacks import init_callback_objects
 from MultiPlanarUNet.logging import ScreenLogger
 from MultiPlanarUNet.evaluate import loss_functions
 from MultiPlanarUNet.evaluate import metrics as custom_metrics
-from MultiPlanarUNet.callbacks import SavePredictionImages, Validation, FGBatchBalancer, DividerLine, SaveOutputAs2DImage, PrintLayerWeights
+from MultiPlanarUNet.callbacks import SavePredictionImages, Validation, FGBatchBalancer, BatchProducerRefresh, PlaneBankRefresh, DividerLine, SaveOutputAs2DImage, PrintLayerWeights, SamplingStatsLogger
+from MultiPlanarUNet.sequences import SharedBatchProducer, PlaneBankSequence2D
 from tensorflow.keras import optimizers, losses
 from tensorflow.keras import metrics as TF_metrics
 import matplotlib.pyplot as plt
@@ -150,6 +151,12 @@ class Trainer(object):
         # batch size)
         train.batch_size = batch_size
 
+        # Continue the batch keys of the resumed epoch (see
+        # BaseSequence.get_rng) instead of repeating those of epoch 0
+        train.epoch = init_epoch
+        if val is not None:
+            val.epoch = init_epoch
+
         # Get number of steps per train epoch
         train_steps = int(train_im_per_epoch/batch_size)
 
@@ -169,9 +176,15 @@ class Trainer(object):
             # IMPORTANT: Should be first in callbacks list as other CBs may
             # depend on the validation metrics/loss
             validation = Validation(val, val_steps, logger=self.logger,
-                                    verbose=verbose)
+                                    verbose=verbose,
+                                    cache_folder=hparams["fit"].get("val_cache"))
             callbacks = [validation] + callbacks
 
+        # Add sampling stats of the training batches to the logs
+        # Should follow Validation and precede e.g. CSVLogger
+        callbacks.insert(int(val is not None),
+                         SamplingStatsLogger(train, logger=self.logger))
+
         # Add save layer output
         # callbacks.append(SaveOutputAs2DImage(self.model.layers[8], train,
         #                                      self.model,
@@ -186,10 +199,44 @@ class Trainer(object):
             # Add save images cb
             callbacks.append(SavePredictionImages(train, val))
 
+        # Get the source of training batches
+        #   'producer': Worker processes writing into shared memory buffers,
+        #               see MultiPlanarUNet.sequences.batch_producer
+        #   'tf_data':  tf.data pipeline producing batches in parallel threads,
+        #               see MultiPlanarUNet.sequences.tf_dataset
+        batch_source = hparams["fit"].get("batch_source") or "producer"
+        n_workers = hparams["fit"].get("batch_workers") or max(cpu_count()-1, 1)
+        producer, dataset = None, None
+        if batch_source == "producer":
+            # Each batch is copied to shared memory right after it is
+            # produced, so the sequence may reuse its output buffers
+            if hasattr(train, "buffer_slots"):
+                train.buffer_slots = 1
+            # fit_generator wraps the producer in a tf.data pipeline which
+            # prefetches an unbounded number of batches and may wrap them in
+            # tensors without copying, so the producer yields copies
+            producer = SharedBatchProducer(train, n_workers=n_workers,
+                                           n_buffers=hparams["fit"].get("batch_buffers"),
+                                           copy=True, logger=self.logger)
+        elif batch_source == "tf_data":
+            from MultiPlanarUNet.sequences.tf_dataset import get_dataset
+            dataset = get_dataset(train, n_parallel=n_workers,
+                                  logger=self.logger)
+        else:
+            raise ValueError("Invalid batch source '%s', must be 'producer' "
+                             "or 'tf_data'" % batch_source)
+
         # Get FGBatchBalancer callbacks, etc.
+        # The plane bank refresh is started and the producer is refreshed
+        # after FGBatchBalancer updates the sequence
         FGbalancer = FGBatchBalancer(train, logger=self.logger)
         line = DividerLine(self.logger)
-        callbacks = callbacks + [FGbalancer, line]
+        callbacks = callbacks + [FGbalancer]
+        if isinstance(train, PlaneBankSequence2D):
+            callbacks.append(PlaneBankRefresh(train, logger=self.logger))
+        if producer is not None:
+            callbacks.append(BatchProducerRefresh(producer, logger=self.logger))
+        callbacks.append(line)
 
         # Get initialized callback objects
         callbacks, cb_dict = init_callback_objects(callbacks, self.logger)
@@ -205,15 +252,28 @@ class Trainer(object):
         self.logger.active_log_file = "training"
         self.logger.print_calling_method = False
 
-        self.model.fit_generator(generator=train,
-                                 steps_per_epoch=train_steps,
-                                 epochs=n_epochs,
-                                 verbose=verbose,
-                                 callbacks=callbacks,
-                                 initial_epoch=init_epoch,
-                                 use_multiprocessing=True,
-                                 workers=cpu_count()-1,
-                                 max_queue_size=10)
+        if dataset is not None:
+            self.model.fit(dataset,
+                           steps_per_epoch=train_steps,
+                           epochs=n_epochs,
+                           verbose=verbose,
+                           callbacks=callbacks,
+                           initial_epoch=init_epoch)
+            return
+
+        # Batches are consumed directly from the producer in the main thread
+        producer.start()
+        try:
+            self.model.fit_generator(generator=iter(producer),
+                                     steps_per_epoch=train_steps,
+                                     epochs=n_epochs,
+                                     verbose=verbose,
+                                     callbacks=callbacks,
+                                     initial_epoch=init_epoch,
+                                     use_multiprocessing=False,
+                                     workers=0)
+        finally:
+            producer.stop()
 
     def save_metadata_trace(self, save_path):
         if not self.metadata:
@@ -1,4 +1,7 @@
 from .fuse_and_predict import predict_volume, \
                               predict_3D_patches, predict_3D_patches_binary, \
-                              map_real_space_pred, pred_3D_iso, predict_single
+                              map_real_space_pred, map_real_space_pred_nearest, \
+                              map_view_pred, pred_3D_iso, predict_single
 from .fusion_training import stack_collections, predict_and_map
+from .view_pipeline import predict_views
+from .streaming import StreamingFusion
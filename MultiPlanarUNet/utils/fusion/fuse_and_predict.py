@@ -3,7 +3,8 @@ from MultiPlanarUNet.interpolation.regular_grid_interpolator import RegularGridI
 
 from MultiPlanarUNet.preprocessing import reshape_add_axis
 from MultiPlanarUNet.interpolation.linalg import mgrid_to_points, points_to_mgrid
-from MultiPlanarUNet.interpolation.sample_grid import get_voxel_grid, get_voxel_axes_real_space, get_voxel_grid_real_space
+from MultiPlanarUNet.interpolation.sample_grid import get_voxel_grid, get_voxel_axes_real_space, get_voxel_grid_real_space, \
+    get_voxel_real_space_affine
 
 
 def predict_single(image, model, hparams, verbose=1):
@@ -45,9 +46,6 @@ def predict_single(image, model, hparams, verbose=1):
         # Get sequence object
         sequence = image_pair_loader.get_sequencer(**kwargs)
 
-        # Get voxel grid in real space
-        voxel_grid_real_space = get_voxel_grid_real_space(image)
-
         # Prepare tensor to store combined prediction
         d = image.image.shape
         predicted = np.empty(shape=(len(kwargs["views"]), d[0], d[1], d[2], n_classes),
@@ -65,9 +63,8 @@ def predict_single(image, model, hparams, verbose=1):
 
             # Map the real space coordiante predictions to nearest
             # real space coordinates defined on voxel grid
-            predicted[n_view] = map_real_space_pred(pred, grid, inv_basis,
-                                                    voxel_grid_real_space,
-                                                    method="nearest")
+            predicted[n_view] = map_view_pred(pred, grid, inv_basis, image,
+                                              method="nearest")
     else:
         predicted = pred_3D_iso(model=model, sequence=image_pair_loader.get_sequencer(**kwargs),
                                 image=image, extra_boxes="3x", min_coverage=None)
@@ -158,6 +155,103 @@ def map_real_space_pred(pred, grid, inv_basis, voxel_grid_real_space, method="ne
     return mapped
 
 
+def map_real_space_pred_nearest(pred, grid, inv_basis, vox_to_real_affine,
+                                shape, chunk_size=2**21):
+    """
+    Nearest neighbour version of map_real_space_pred computed directly from
+    the voxel indices.
+
+    The position of voxel v in the (uniform) grid of 'pred' is an affine
+    function of v: inv_basis composed with 'vox_to_real_affine' (see
+    interpolation.sample_grid.get_voxel_real_space_affine) and the grid
+    origins and spacings. The nearest grid indices are computed from this
+    affine for 'chunk_size' voxels at a time and the predictions gathered
+    from them directly, so the real space voxel grid is never stored.
+    Rounding and bounds follow RegularGridInterpolator (points on the grid
+    border are inside, ties are rounded down), voxels outside the grid are
+    set to background (1.0 for class 0).
+
+    Args:
+        pred:               ndarray of shape [*grid shape, n_classes]
+        grid:               Tuple of 3 uniformly spaced, increasing grid axes
+        inv_basis:          3x3 matrix mapping real space to grid coordinates
+        vox_to_real_affine: 4x4 affine mapping voxel indices to real space
+        shape:              Spatial shape of the image
+        chunk_size:         Approx. number of voxels mapped at a time
+
+    Returns:
+        ndarray of shape [*shape, n_classes] of dtype pred.dtype
+    """
+    print("Mapping to real coordinate space...")
+    shape = tuple(int(s) for s in shape[:3])
+    n_classes = pred.shape[-1]
+    grid_shape = np.asarray(pred.shape[:3])
+
+    # Affine from voxel indices to (continuous) indices into the grid
+    origin, spacing = [], []
+    for g in grid:
+        g = np.asarray(g, dtype=np.float64)
+        step = (g[-1] - g[0]) / (len(g) - 1) if len(g) > 1 else 1.
+        if step <= 0 or not np.allclose(np.diff(g), step, rtol=1e-4):
+            raise ValueError("map_real_space_pred_nearest requires uniformly "
+                             "spaced, increasing grid axes. Use "
+                             "map_real_space_pred.")
+        origin.append(g[0])
+        spacing.append(step)
+    vox_to_real_affine = np.asarray(vox_to_real_affine, dtype=np.float64)
+    mat = np.asarray(inv_basis).dot(vox_to_real_affine[:3, :3])
+    mat /= np.asarray(spacing)[:, None]
+    offset = (np.asarray(inv_basis).dot(vox_to_real_affine[:3, 3]) -
+              origin) / spacing
+
+    # Contributions of the 2nd and 3rd voxel index, shared by all chunks
+    j = np.arange(shape[1], dtype=np.float64)[:, None]
+    k = np.arange(shape[2], dtype=np.float64)[None]
+    jk = [(mat[a, 1] * j + mat[a, 2] * k + offset[a]).astype(np.float32)
+          for a in range(3)]
+
+    # Flat indices into the [n_grid_points, n_classes] predictions
+    index_dtype = np.int32 if np.prod(grid_shape) < 2**31 else np.int64
+    strides = [int(np.prod(grid_shape[a+1:])) for a in range(3)]
+    pred = np.ascontiguousarray(pred).reshape(-1, n_classes)
+
+    # Fill value vector, we set this to 1.0 background
+    fill = np.zeros(shape=n_classes, dtype=pred.dtype)
+    fill[0] = 1.0
+
+    mapped = np.empty(shape + (n_classes,), dtype=pred.dtype)
+    rows = max(1, chunk_size // (shape[1] * shape[2]))
+    for start in range(0, shape[0], rows):
+        i = np.arange(start, min(start + rows, shape[0]), dtype=np.float32)
+        index = np.zeros((len(i),) + shape[1:], dtype=index_dtype)
+        out_of_bounds = np.zeros((len(i),) + shape[1:], dtype=np.bool_)
+        for a in range(3):
+            coords = jk[a][None] + (np.float32(mat[a, 0]) * i)[:, None, None]
+            out_of_bounds |= (coords < 0) | (coords > grid_shape[a] - 1)
+            inds = np.clip(np.ceil(coords - 0.5), 0, grid_shape[a] - 1)
+            index += inds.astype(index_dtype) * index_dtype(strides[a])
+        chunk = mapped[start:start + len(i)]
+        np.take(pred, index, axis=0, out=chunk)
+        chunk[out_of_bounds] = fill
+    return mapped
+
+
+def map_view_pred(pred, grid, inv_basis, image, method="nearest"):
+    """
+    Map the prediction 'pred' of a view (see get_view_from) to the voxel grid
+    of the ImagePair 'image'. Nearest neighbour mapping is computed directly
+    from the image affine (map_real_space_pred_nearest), other methods
+    interpolate at the real space voxel grid (map_real_space_pred).
+    """
+    if method == "nearest":
+        return map_real_space_pred_nearest(pred, grid, inv_basis,
+                                           get_voxel_real_space_affine(image),
+                                           image.shape[:3])
+    voxel_grid_real_space = get_voxel_grid_real_space(image)
+    return map_real_space_pred(pred, grid, inv_basis, voxel_grid_real_space,
+                               method=method)
+
+
 def predict_3D_patches_binary(model, patches, image_id, N_extra=0, logger=None):
     # Get box dim and image dim
     d = patches.dim
@@ -1,6 +1,6 @@
 import numpy as np
 
-from MultiPlanarUNet.utils.fusion import map_real_space_pred
+from MultiPlanarUNet.utils.fusion import map_real_space_pred, map_view_pred
 from MultiPlanarUNet.evaluate import dice_all
 
 
@@ -47,7 +47,9 @@ def predict_and_map(model, seq, image, view, batch_size=None,
         image:
         view:
         batch_size:
-        voxel_grid_real_space:
+        voxel_grid_real_space: Optional real space voxel grid of the image,
+                               mapped to with map_real_space_pred. If None,
+                               the mapping is computed from the image affine.
         targets:
         n_planes:
         torch:
@@ -73,12 +75,13 @@ def predict_and_map(model, seq, image, view, batch_size=None,
 
     # Map the real space coordiante predictions to nearest
     # real space coordinates defined on voxel grid
+    # Without a passed voxel grid the mapping is computed directly from the
+    # image affine (see map_real_space_pred_nearest)
     if voxel_grid_real_space is None:
-        from MultiPlanarUNet.interpolation.sample_grid import get_voxel_grid_real_space
-        voxel_grid_real_space = get_voxel_grid_real_space(image)
-
-    # Map the predicted volume to real space
-    mapped = map_real_space_pred(pred, grid, inv_basis, voxel_grid_real_space)
+        mapped = map_view_pred(pred, grid, inv_basis, image, method="nearest")
+    else:
+        mapped = map_real_space_pred(pred, grid, inv_basis,
+                                     voxel_grid_real_space)
 
     # Print dice scores
     if targets is not None and np.random.rand(1)[0] <= eval_prob:
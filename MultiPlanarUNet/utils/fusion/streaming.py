@@ -0,0 +1,101 @@
+"""
+Streaming fusion of view predictions.
+
+All supported fusion methods are sums over the views of (weighted) mapped
+predictions followed by an optional activation:
+
+    sum:   sum_v P_v
+    model: activation(sum_v W[v] * P_v + b)
+
+with P_v the [X, Y, Z, n_classes] prediction of view v mapped to the voxel
+grid and W [n_views, n_classes], b [n_classes] the weights of the fusion
+layer (see models.FusionModel.get_fusion_weights). StreamingFusion adds each
+view into a single [X, Y, Z, n_classes] buffer as soon as it is mapped, so
+memory use does not scale with the number of views.
+"""
+
+import numpy as np
+
+
+class StreamingFusion(object):
+    """
+    Accumulates the mapped predictions of each view into one buffer and
+    returns the fused prediction (see module docstring)
+    """
+    def __init__(self, shape, n_classes, weights=None, bias=None,
+                 activation=None, dtype=np.float32):
+        """
+        Args:
+            shape:      Spatial shape of the image
+            n_classes:  Number of classes
+            weights:    Optional [n_views, n_classes] per-view, per-class
+                        weights, None to sum the views unweighted
+            bias:       Optional [n_classes] bias added to the weighted sum
+            activation: 'softmax' or None, applied to the fused prediction
+            dtype:      dtype of the buffer
+        """
+        if activation not in ("softmax", None):
+            raise ValueError("Invalid activation '%s', must be 'softmax' or "
+                             "None" % activation)
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.n_classes = int(n_classes)
+        self.weights = None if weights is None else \
+            np.asarray(weights, dtype=dtype).reshape(-1, self.n_classes)
+        self.bias = None if bias is None else \
+            np.asarray(bias, dtype=dtype).reshape(self.n_classes)
+        self.activation = activation
+        self.buffer = np.zeros(self.shape + (self.n_classes,), dtype=dtype)
+        self.n_added = 0
+
+    def __str__(self):
+        return ("StreamingFusion(shape=%s, n_classes=%i, weighted=%s, "
+                "activation=%s, %i views added)" % (
+            self.shape, self.n_classes, self.weights is not None,
+            self.activation, self.n_added
+        ))
+
+    def __repr__(self):
+        return str(self)
+
+    def add(self, mapped, n_view=None, chunk_size=2**21):
+        """
+        Add the mapped prediction of view number 'n_view' (only needed with
+        weights), 'chunk_size' voxels at a time
+
+        Args:
+            mapped:     ndarray of shape [*shape, n_classes]
+            n_view:     Index of the view into the weights
+            chunk_size: Approx. number of voxels processed at a time
+        """
+        if mapped.shape != self.buffer.shape:
+            raise ValueError("Mapped prediction of shape %s does not match "
+                             "the fusion buffer of shape %s"
+                             % (mapped.shape, self.buffer.shape))
+        if self.weights is None:
+            self.buffer += mapped
+        else:
+            if n_view is None:
+                raise ValueError("Must pass 'n_view' to weighted fusion")
+            weights = self.weights[n_view]
+            rows = max(1, chunk_size // (self.shape[1] * self.shape[2]))
+            for start in range(0, self.shape[0], rows):
+                self.buffer[start:start+rows] += \
+                    mapped[start:start+rows] * weights
+        self.n_added += 1
+
+    def result(self, chunk_size=2**21):
+        """
+        Returns the fused prediction. The bias and activation are applied to
+        the buffer in place, 'chunk_size' voxels at a time, so result should
+        only be called once.
+        """
+        if self.bias is not None:
+            self.buffer += self.bias
+        if self.activation == "softmax":
+            rows = max(1, chunk_size // (self.shape[1] * self.shape[2]))
+            for start in range(0, self.shape[0], rows):
+                chunk = self.buffer[start:start+rows]
+                chunk -= chunk.max(axis=-1, keepdims=True)
+                np.exp(chunk, out=chunk)
+                chunk /= chunk.sum(axis=-1, keepdims=True)
+        return self.buffer
@@ -0,0 +1,118 @@
+"""
+Pipelined multi-view prediction.
+
+Predicting an image along a view runs three stages: sampling the planes
+along the view (CPU, IsotrophicLiveViewSequence2D.get_view_from),
+predicting on the planes (model, predict_volume) and mapping the
+predictions to the voxel grid of the image (CPU, map_view_pred).
+predict_views overlaps the stages across views: while the model predicts
+on view k, the planes of the following views are sampled by a background
+thread and the predictions of the previous views are mapped by a pool of
+threads. The model is only called from the calling thread.
+"""
+
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+from .fuse_and_predict import predict_volume, map_view_pred
+
+
+class _ViewSampler(object):
+    """
+    Samples the planes of each view in order in a background thread into a
+    queue of at most 'depth' views
+    """
+    def __init__(self, seq, image_id, views, n_planes, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run,
+                             args=(seq, image_id, views, n_planes),
+                             daemon=True)
+        self.thread.start()
+
+    def _run(self, seq, image_id, views, n_planes):
+        for view in views:
+            try:
+                sampled = seq.get_view_from(image_id, view, n_planes=n_planes)
+            except Exception as e:
+                sampled = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(sampled, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if self.stop_event.is_set() or isinstance(sampled, Exception):
+                return
+
+    def get(self):
+        sampled = self.queue.get()
+        if isinstance(sampled, Exception):
+            raise sampled
+        return sampled
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def predict_views(model, seq, image, views, batch_size=8,
+                  n_planes="same+20", n_workers=2, depth=1, method="nearest"):
+    """
+    Predict on 'image' along each of 'views' and map the predictions to the
+    voxel grid of the image (see module docstring).
+
+    Args:
+        model:                 The model to predict with
+        seq:                   A IsotrophicLiveViewSequence2D storing 'image'
+        image:                 The ImagePair to predict on
+        views:                 List or ndarray of view vectors
+        batch_size:            Batch size of the model predictions
+        n_planes:              Number of planes sampled per view, see
+                               get_view_from
+        n_workers:             Number of threads mapping predictions, the
+                               predictions of at most n_workers + 1 views are
+                               kept in memory at a time. 0 to run all stages
+                               sequentially in the calling thread.
+        depth:                 Max. number of views sampled ahead of the model
+        method:                Interpolation method of map_view_pred
+
+    Yields:
+        For each view, in order: the view index, the view, the labels sampled
+        along the view (None in predict mode), the prediction along the view
+        and the mapped prediction
+    """
+    if not n_workers:
+        for n_view, view in enumerate(views):
+            X, y, grid, inv_basis = seq.get_view_from(image.id, view,
+                                                      n_planes=n_planes)
+            pred = predict_volume(model, X, axis=2, batch_size=batch_size)
+            mapped = map_view_pred(pred, grid, inv_basis, image,
+                                   method=method)
+            yield n_view, view, y, pred, mapped
+        return
+
+    sampler = _ViewSampler(seq, image.id, views, n_planes, depth)
+    pool = ThreadPoolExecutor(max_workers=n_workers)
+    pending = deque()
+    try:
+        for n_view, view in enumerate(views):
+            X, y, grid, inv_basis = sampler.get()
+            pred = predict_volume(model, X, axis=2, batch_size=batch_size)
+            del X
+            future = pool.submit(map_view_pred, pred, grid, inv_basis, image,
+                                 method=method)
+            pending.append((n_view, view, y, pred, future))
+
+            # Yield the mapped views in order, wait for the oldest view if
+            # more than n_workers views are being mapped
+            while pending and (len(pending) > n_workers or
+                               pending[0][-1].done()):
+                n, v, y_, p, f = pending.popleft()
+                yield n, v, y_, p, f.result()
+        while pending:
+            n, v, y_, p, f = pending.popleft()
+            yield n, v, y_, p, f.result()
+    finally:
+        sampler.stop()
+        pool.shutdown(wait=False)
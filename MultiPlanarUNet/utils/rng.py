@@ -0,0 +1,51 @@
+"""
+Explicit random number generators for the sequences, samplers and
+augmenters.
+
+Each batch is produced with a np.random.Generator derived from the key
+(seed, epoch, batch index, worker id) of the batch, see get_batch_rng. Any
+batch may thus be regenerated from its key alone, independently of the
+process or thread that originally produced it and of what was sampled
+before it.
+"""
+
+import numpy as np
+
+
+def new_seed():
+    """
+    Returns a new random (entropy based) integer seed for use with
+    get_batch_rng
+    """
+    return int(np.random.SeedSequence().entropy % 2**63)
+
+
+def get_batch_rng(seed, epoch=0, idx=0, worker=0, stream=0):
+    """
+    Returns the np.random.Generator of batch 'idx' of epoch 'epoch' produced
+    by worker 'worker' of a sequence with seed 'seed'.
+
+    Args:
+        seed:   Non-negative integer, the global seed
+        epoch:  Non-negative integer, the epoch
+        idx:    Non-negative integer, the batch index
+        worker: Non-negative integer, the id of the producing worker
+        stream: Non-negative integer, separates keys used for different
+                purposes (e.g. training batches and filling a plane bank)
+
+    Returns:
+        A np.random.Generator
+    """
+    key = [int(seed), int(stream), int(epoch), int(idx), int(worker)]
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(key)))
+
+
+def get_rng(rng=None):
+    """
+    Returns 'rng' if passed, otherwise a np.random.Generator seeded from the
+    global NumPy RNG (so that np.random.seed still applies to callers that do
+    not pass a Generator).
+    """
+    if rng is not None:
+        return rng
+    return np.random.default_rng(np.random.randint(0, 2**32, dtype=np.int64))
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+
+
+def _write_dataset(folder, n_images=3):
+    """
+    Write n_images small random volumes with two box-shaped foreground classes
+    to folder/images and folder/labels
+    """
+    rng = np.random.RandomState(0)
+    for sub in ("images", "labels"):
+        os.makedirs(os.path.join(folder, sub))
+    for i in range(n_images):
+        shape = (40 + 4 * i, 44, 36)
+        im = rng.rand(*shape).astype(np.float32) * 100
+        lab = np.zeros(shape, np.uint8)
+        lab[12:20, 18:24, 8:28] = 1
+        lab[26:32, 6:14, 14:20] = 2
+        im[lab > 0] += 50
+        affine = np.diag([1., 1.3, 2., 1.])
+        if i == 1:
+            # An image not aligned with the voxel axes
+            affine[:2, :2] = [[1.2, 0.3], [-0.3, 1.2]]
+        for sub, arr in (("images", im), ("labels", lab)):
+            nib.save(nib.Nifti1Image(arr, affine),
+                     os.path.join(folder, sub, "im%i.nii.gz" % i))
+
+
+@pytest.fixture(scope="session")
+def data_dir(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("data"))
+    _write_dataset(folder)
+    return folder
+
+
+@pytest.fixture
+def get_sequence(data_dir):
+    """
+    Returns a function creating a 2D iso-live training sequence of the test
+    dataset, keyword arguments are passed to get_sequencer
+    """
+    from MultiPlanarUNet.image import ImagePairLoader
+
+    def _get(intrp_style="iso_live", **kwargs):
+        views = np.array([[0, 0, 1], [1, 0, 0], [0.3, 0.4, 0.8]])
+        views = views / np.linalg.norm(views, axis=1, keepdims=True)
+        options = dict(bg_value=0., bg_class=0, scaler="RobustScaler",
+                       n_classes=3, dim=32, real_space_span=60, views=views,
+                       batch_size=4, seed=42, no_log=True)
+        options.update(kwargs)
+        loader = ImagePairLoader(data_dir, no_log=True)
+        return loader.get_sequencer(intrp_style, **options)
+    return _get
+
+
+def assert_batches_equal(a, b):
+    from MultiPlanarUNet.sequences.batch_producer import _flatten
+    a, _ = _flatten(a)
+    b, _ = _flatten(b)
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        np.testing.assert_array_equal(x, y)
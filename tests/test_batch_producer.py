@@ -0,0 +1,120 @@
+import time
+import numpy as np
+import pytest
+from conftest import assert_batches_equal
+from MultiPlanarUNet.sequences.base_sequence import BaseSequence
+from MultiPlanarUNet.sequences.batch_producer import SharedBatchProducer
+
+AUGMENTERS = [
+    {"cls_name": "Elastic2D",
+     "kwargs": {"alpha": [0, 450], "sigma": [20, 30], "apply_prob": 0.5}},
+    {"cls_name": "ScaleShift", "kwargs": {"apply_prob": 0.5}}
+]
+
+
+class KeySequence(BaseSequence):
+    """ Batches of random constants drawn from the generator of each key """
+    def __len__(self):
+        return 1000
+
+    def __getitem__(self, idx):
+        value = self.get_rng(idx).random()
+        time.sleep(0.001)
+        return (np.full((4, 64, 64, 1), value, np.float32),
+                np.full((4, 64, 64, 1), value, np.float32))
+
+
+def _regenerate(sequence, key):
+    sequence.epoch, idx, sequence.worker_id = key
+    return sequence[idx]
+
+
+def _consume(producer, n_batches):
+    batches = []
+    try:
+        for _ in range(n_batches):
+            batch = next(producer)
+            batches.append((producer.last_key, [a.copy() for a in
+                                                 (batch[0], batch[1])]))
+    finally:
+        producer.stop()
+    return batches
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_batches_match_keys(get_sequence, copy):
+    """ Each produced batch equals sequence[idx] under its key """
+    seq = get_sequence(augmenters=AUGMENTERS)
+    seq.buffer_slots = 1
+    batches = _consume(SharedBatchProducer(seq, n_workers=2, copy=copy), 12)
+    keys = [key for key, _ in batches]
+    assert len(set(keys)) == len(keys)
+    assert {key[2] for key in keys} <= {1, 2}
+    for key, batch in batches:
+        assert_batches_equal(batch, _regenerate(seq, key)[:2])
+
+
+def test_new_keys_after_restart(get_sequence):
+    seq = get_sequence()
+    producer = SharedBatchProducer(seq, n_workers=2)
+    first = [key for key, _ in _consume(producer, 6)]
+    seq.epoch = 1
+    producer.restart()
+    second = [key for key, _ in _consume(producer, 6)]
+    assert all(key[0] == 0 for key in first)
+    assert all(key[0] == 1 for key in second)
+
+
+def test_held_slots_not_overwritten():
+    """ The n_held last yielded batches stay valid while more are produced """
+    n_held = 3
+    # A single free slot, which the workers fill while the consumer waits
+    producer = SharedBatchProducer(KeySequence(seed=1), n_workers=2,
+                                   n_buffers=n_held + 1, n_held=n_held)
+    held = []
+    try:
+        for _ in range(30):
+            batch = next(producer)
+            held.append((batch, batch[0][0, 0, 0, 0]))
+            held = held[-n_held:]
+            time.sleep(0.01)
+            for (x, y), value in held:
+                assert np.all(x == value) and np.all(y == value)
+    finally:
+        producer.stop()
+
+
+def test_too_few_buffers():
+    with pytest.raises(ValueError):
+        SharedBatchProducer(KeySequence(seed=1), n_workers=1, n_buffers=2,
+                            n_held=2)
+
+
+def test_keras_generator_adapter():
+    """
+    Batches consumed through the Keras generator adapter (as used by
+    fit_generator in training) equal the batches yielded by the producer
+    """
+    data_adapter = pytest.importorskip("keras.src.engine.data_adapter")
+    producer = SharedBatchProducer(KeySequence(seed=1), n_workers=3,
+                                   copy=True)
+    yielded = []
+
+    def _generator():
+        while True:
+            batch = next(producer)
+            yielded.append(batch[0][0, 0, 0, 0])
+            yield batch
+
+    adapter = data_adapter.GeneratorDataAdapter(_generator(), workers=0)
+    consumed = []
+    try:
+        for x, y in adapter.get_dataset().take(100):
+            x, y = x.numpy(), y.numpy()
+            # Let the workers run ahead of the consumer
+            time.sleep(0.005)
+            assert np.all(x == x[0, 0, 0, 0]) and np.all(y == x[0, 0, 0, 0])
+            consumed.append(x[0, 0, 0, 0])
+    finally:
+        producer.stop()
+    assert consumed == yielded[:len(consumed)]
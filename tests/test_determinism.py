@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from conftest import assert_batches_equal
+from test_batch_producer import KeySequence
+from MultiPlanarUNet.callbacks import Validation
+from MultiPlanarUNet.sequences import MultiTaskSequence, PlaneBankSequence2D
+
+
+def _copy(batch):
+    return [np.array(a) for a in batch]
+
+
+def test_batches_are_functions_of_their_key(get_sequence):
+    seq, other = get_sequence(), get_sequence()
+    batch = _copy(seq[3])
+    assert_batches_equal(batch, other[3])
+    assert_batches_equal(batch, seq[3])
+    for key in ((1, 3, 0), (0, 4, 0), (0, 3, 1)):
+        other.epoch, idx, other.worker_id = key
+        assert not np.array_equal(batch[0], other[idx][0])
+
+
+def test_multi_task_prefetch(get_sequence, data_dir):
+    """
+    Prefetched task batch k equals sequence[k] of the task, non-prefetched
+    task batches equal sequence[index]
+    """
+    tasks = MultiTaskSequence([get_sequence(), get_sequence(seed=7)],
+                              task_names=["a", "b"], prefetch=[0, 2])
+    refs = [get_sequence(), get_sequence(seed=7)]
+    try:
+        for k, index in enumerate((5, 2, 9)):
+            X, y, w = tasks[index]
+            assert_batches_equal((X[0], y[0], w[0]), refs[0][index])
+            assert_batches_equal((X[1], y[1], w[1]), refs[1][k])
+    finally:
+        tasks.stop()
+
+
+def test_plane_bank_fill_and_refresh(get_sequence, tmp_path):
+    def _bank_sequence(name):
+        return get_sequence(plane_bank={"folder": str(tmp_path / name),
+                                        "n_planes": 40,
+                                        "refresh_fraction": 0.25})
+    seq, other = _bank_sequence("a"), _bank_sequence("b")
+    np.testing.assert_array_equal(seq.bank.X, other.bank.X)
+    np.testing.assert_array_equal(seq.bank.y, other.bank.y)
+    before = np.array(seq.bank.X)
+
+    seq.refresh()
+    seq._refresh_process.join()
+    assert seq._refresh_done.is_set()
+
+    # Batches drawn while a refresh is in progress exclude its entries
+    drawn = []
+
+    def _record(candidates, n, rng):
+        out = PlaneBankSequence2D._draw(seq, candidates, n, rng)
+        drawn.extend(out)
+        return out
+    seq._draw = _record
+    seq._refresh_done.clear()
+    seq[0]
+    seq._refresh_done.set()
+    assert len(drawn) == seq.batch_size
+    assert not set(seq._refresh_inds) & set(drawn)
+
+    # Only the refreshed entries changed, the refresh is deterministic
+    other.refresh()
+    other._refresh_process.join()
+    unchanged = np.setdiff1d(np.arange(len(seq.bank)), seq._refresh_inds)
+    np.testing.assert_array_equal(seq.bank.X[unchanged], before[unchanged])
+    assert not np.array_equal(seq.bank.X[seq._refresh_inds],
+                              before[seq._refresh_inds])
+    np.testing.assert_array_equal(seq.bank.X, other.bank.X)
+
+
+def test_tf_data_keys_do_not_repeat(get_sequence):
+    """ Batch i of the dataset is sequence[i], also beyond len(sequence) """
+    tf = pytest.importorskip("tensorflow")
+    if not tf.executing_eagerly():
+        pytest.skip("Requires eager execution")
+    from MultiPlanarUNet.sequences.tf_dataset import get_dataset
+
+    class ShortSequence(KeySequence):
+        def __len__(self):
+            return 3
+
+    seq = ShortSequence(seed=1)
+    values = [x.numpy()[0, 0, 0, 0] for x, _ in
+              get_dataset(seq, n_parallel=2).take(8)]
+    assert len(set(values)) == len(values)
+    assert sorted(values) == sorted(seq[i][0][0, 0, 0, 0] for i in range(8))
+
+
+class _RecordingModel(object):
+    """ Records the images passed to predict_on_batch """
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.images = []
+
+    def predict_on_batch(self, X):
+        self.images.append(np.array(X))
+        return np.zeros(X.shape[:-1] + (self.n_classes,), np.float32)
+
+
+def _validation_images(sequence, epochs, cache_folder=None):
+    validation = Validation(sequence, steps=2, verbose=False,
+                            cache_folder=cache_folder)
+    validation.model = _RecordingModel(sequence.n_classes)
+    images = []
+    for epoch in epochs:
+        validation.on_epoch_end(epoch, {})
+        images.append(validation.model.images[-2:])
+        assert sequence.epoch == (0 if cache_folder else epoch)
+    return images
+
+
+def test_validation_batches_per_epoch(get_sequence, tmp_path):
+    # New batches each epoch, the same batches for the same epoch on resume
+    first, second = _validation_images(get_sequence(), [0, 1])
+    resumed = _validation_images(get_sequence(), [1])[0]
+    assert not np.array_equal(first[0], second[0])
+    assert_batches_equal(second, resumed)
+
+    # Fixed (epoch 0) batches when cached
+    cached = _validation_images(get_sequence(), [1, 2], str(tmp_path))
+    assert_batches_equal(cached[0], first)
+    assert_batches_equal(cached[1], first)
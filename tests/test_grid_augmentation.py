@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from conftest import assert_batches_equal
+
+ELASTIC = {"cls_name": "Elastic2D",
+           "kwargs": {"alpha": [200, 450], "sigma": [20, 30],
+                      "apply_prob": 1.0}}
+
+
+@pytest.mark.parametrize("apply_prob", [0.0, 1.0])
+def test_preview_only_on_undeformed_grids(get_sequence, apply_prob):
+    """
+    Deformed grids are interpolated without the axis-aligned plan and are
+    never tested on the (affine only) label preview, also when the sample
+    weights are kept (aug_weight None)
+    """
+    elastic = {"cls_name": "Elastic2D",
+               "kwargs": dict(ELASTIC["kwargs"], apply_prob=apply_prob)}
+    seq = get_sequence(augmenters=[elastic], label_preview_factor=4)
+    seq.grid_augmenters[0].weight = None
+    deform_grid, reject_on_preview = seq.deform_grid, seq.reject_on_preview
+    deformed, previewed = [], []
+
+    def _deform_grid(mgrid, rng=None):
+        mgrid, intrp_kw, weight = deform_grid(mgrid, rng)
+        deformed.append(bool(intrp_kw))
+        return mgrid, intrp_kw, weight
+
+    def _reject_on_preview(*args, **kwargs):
+        previewed.append(True)
+        return reject_on_preview(*args, **kwargs)
+
+    seq.deform_grid = _deform_grid
+    seq.reject_on_preview = _reject_on_preview
+    X, y, w = seq[0]
+    assert deformed and all(d == bool(apply_prob) for d in deformed)
+    assert len(previewed) == (0 if apply_prob else len(deformed))
+    np.testing.assert_array_equal(w, 1)
+
+
+def test_deformed_batches_are_functions_of_their_key(get_sequence):
+    seq = get_sequence(augmenters=[ELASTIC], label_preview_factor=4)
+    other = get_sequence(augmenters=[ELASTIC], label_preview_factor=4)
+    batch = [np.array(a) for a in seq[2]]
+    assert_batches_equal(batch, other[2])
+    assert not np.array_equal(batch[0], get_sequence()[2][0])
+
+
+def test_field_bank_evicts_least_used_sets():
+    from MultiPlanarUNet.augmentation.field_bank import DisplacementFieldBank
+    bank = DisplacementFieldBank(size=4, sigma_step=5, max_mb=0.4,
+                                 refresh_interval=None, seed=1)
+    set_mb = 4 * 2 * 64 * 64 * 4 / 1024 ** 2
+    for sigma in (20, 21, 26, 24, 29):
+        bank.get((64, 64), 100, sigma)
+    assert sorted(s for _, s in bank.fields) == [20, 25, 30]
+    bank.get((64, 64), 100, 40)
+    assert sorted(s for _, s in bank.fields) == [20, 25, 40]
+    assert bank.nbytes <= 0.4 * 1024 ** 2
+    assert np.isclose(bank.nbytes / 1024 ** 2, 3 * set_mb)